@@ -1,26 +1,47 @@
 """
 NEVOX FARMA - Sistema de Control de Asistencia
-Aplicacion Flask para Vercel con Supabase (REST API directo).
+Aplicacion Flask para Vercel con Supabase (REST API directo), o en un equipo
+local con SQLite (ALMACEN=sqlite).
 Archivo unico: database + QR + rutas.
 """
 
 import os
 import hashlib
+import heapq
 import hmac
 import json
 import secrets
+import sqlite3
 import time
 import io
 import base64
+import bisect
+import contextvars
+import csv
+import cProfile
+import logging
+import pstats
+import re
+import sys
+import tempfile
+import threading
 import traceback
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
 from io import BytesIO
 from functools import wraps
+from types import MappingProxyType, SimpleNamespace
+from typing import Any, Mapping
 from datetime import datetime, date, timedelta, timezone
 
 import requests as _http
+from requests.adapters import HTTPAdapter
 from flask import (
-    Flask, request, render_template, jsonify, session,
-    redirect, url_for, send_file,
+    Flask, Response, g, request, render_template, jsonify, session,
+    redirect, url_for, send_file, stream_with_context,
 )
 import qrcode
 from PIL import Image
@@ -82,7 +103,584 @@ def _sb_headers(prefer=None):
     return h
 
 
-def _sb_get(table, select="*", filters=None, order=None, limit=None):
+# ------------------------------------------------------------
+# CLIENTE HTTP DE SUPABASE
+# Un check-in son 8-10 idas y vueltas a Supabase. Con requests.get/post
+# sueltos cada una abria su propia conexion TCP+TLS, y a las 7:00 eso era casi
+# toda la latencia del escaneo. Ahora todas pasan por un cliente compartido que
+# deja las conexiones vivas y las reutiliza. Si estan instalados httpx y h2 se
+# usa HTTP/2 (una sola conexion multiplexada); si no, una Session de requests
+# con su pool de conexiones.
+# ------------------------------------------------------------
+SB_POOL_SIZE = int(os.environ.get("SUPABASE_POOL_SIZE", "10"))
+SB_TIMEOUT_CONEXION = float(os.environ.get("SUPABASE_TIMEOUT_CONEXION", "3.05"))  # segundos
+SB_TIMEOUT_LECTURA = float(os.environ.get("SUPABASE_TIMEOUT_LECTURA", "20"))      # segundos
+SB_HTTP2 = os.environ.get("SUPABASE_HTTP2", "1") != "0"
+
+_sb_lock = threading.Lock()
+_sb_cliente = None
+_sb_usa_httpx = False
+_sb_stats = {"peticiones": 0, "errores": 0, "http2": 0}
+
+
+def _sb_nuevo_cliente():
+    global _sb_usa_httpx
+    if SB_HTTP2:
+        try:
+            import httpx
+            import h2  # noqa: F401  sin este paquete httpx se queda en HTTP/1.1
+        except ImportError:
+            pass
+        else:
+            _sb_usa_httpx = True
+            return httpx.Client(
+                http2=True,
+                limits=httpx.Limits(max_connections=SB_POOL_SIZE,
+                                    max_keepalive_connections=SB_POOL_SIZE),
+                timeout=httpx.Timeout(SB_TIMEOUT_LECTURA, connect=SB_TIMEOUT_CONEXION),
+            )
+    _sb_usa_httpx = False
+    s = _http.Session()
+    # pool_block=False: si se acaba el pool se abre una conexion extra en vez
+    # de dejar el check-in esperando; esa conexion no se guarda al terminar.
+    adaptador = HTTPAdapter(pool_connections=2, pool_maxsize=SB_POOL_SIZE, pool_block=False)
+    s.mount("https://", adaptador)
+    s.mount("http://", adaptador)
+    return s
+
+
+def _sb_client():
+    global _sb_cliente
+    if _sb_cliente is None:
+        with _sb_lock:
+            if _sb_cliente is None:
+                _sb_cliente = _sb_nuevo_cliente()
+    return _sb_cliente
+
+
+# ------------------------------------------------------------
+# ALMACEN
+# Los db_* no arman consultas: le piden a _almacen() lo que necesitan (la
+# configuracion, un empleado, las marcas de un rango por paginas, guardar o
+# mover una marca, el check-in entero). Hay dos implementaciones con los
+# mismos metodos: _AlmacenSupabase, el default, lo traduce a PostgREST por el
+# cliente HTTP compartido; _AlmacenSqlite (ALMACEN=sqlite) lo resuelve con SQL
+# contra un archivo local, para las instalaciones en la oficina donde ir a
+# internet por cada consulta sobra. Las dos devuelven las filas con la forma
+# de PostgREST: fecha_hora en UTC como texto ISO y el empleado de una marca
+# embebido en "empleados". Estadisticas, metricas y traza quedan de este lado
+# (_anotar_llamada) y valen para las dos.
+# ------------------------------------------------------------
+ALMACEN = os.environ.get("ALMACEN", "supabase")
+SQLITE_RUTA = os.environ.get("SQLITE_RUTA", os.path.join("data", "nevox_farma.db"))
+
+_almacen_actual = None
+
+
+def _almacen():
+    global _almacen_actual
+    if _almacen_actual is None:
+        with _sb_lock:
+            if _almacen_actual is None:
+                _almacen_actual = _AlmacenSqlite(SQLITE_RUTA) if ALMACEN == "sqlite" else _AlmacenSupabase()
+    return _almacen_actual
+
+
+def _anotar_llamada(verbo, tabla, status, dur, filas, nbytes):
+    """Una ida al almacen (peticion a Supabase o sentencia de SQLite) en las
+    estadisticas, las metricas y la traza. Una escritura descarta lo que el
+    memo de la peticion tenga de esa tabla."""
+    if verbo != "GET":
+        memo = _memo_peticion.get()
+        if memo is not None:
+            # rpc/... puede tocar cualquier tabla: ahi se descarta todo.
+            memo.invalidar(None if tabla.startswith("rpc/") else tabla)
+    with _sb_lock:
+        _sb_stats["peticiones"] += 1
+        if status >= 400:
+            _sb_stats["errores"] += 1
+    _metricas.contar("nevox_supabase_llamadas_total", tabla=tabla, verbo=verbo)
+    _metricas.observar("nevox_supabase_duracion_segundos", dur, tabla=tabla)
+    if status >= 400:
+        _metricas.contar("nevox_supabase_errores_total", tabla=tabla, verbo=verbo, status=status)
+    traza = _traza.get()
+    if traza is not None:
+        traza.llamada(verbo, tabla, status, dur, filas, nbytes)
+        _hilo.fuera = getattr(_hilo, "fuera", 0.0) + dur  # ver _fase
+
+
+def _sb_request(method, path, params=None, json=None, prefer=None):
+    """Unico punto de salida hacia Supabase REST. Devuelve el JSON de la
+    respuesta (None si vino vacia) y lanza HTTPError si falla."""
+    t0 = time.perf_counter()
+    kwargs = {"params": params, "json": json, "headers": _sb_headers(prefer)}
+    if not _sb_usa_httpx:
+        kwargs["timeout"] = (SB_TIMEOUT_CONEXION, SB_TIMEOUT_LECTURA)
+    r = _sb_client().request(method, f"{SUPABASE_URL}/rest/v1/{path}", **kwargs)
+    if getattr(r, "http_version", "") == "HTTP/2":
+        with _sb_lock:
+            _sb_stats["http2"] += 1
+    # Se mira el status y no raise_for_status: con httpx esa lanza
+    # httpx.HTTPStatusError, que no es un HTTPError de requests. Asi los dos
+    # clientes cuentan el error y lanzan lo mismo.
+    error = None
+    if r.status_code >= 400:
+        error = _http.HTTPError(f"{r.status_code} Error for url: {r.url}", response=r)
+    datos = r.json() if r.content and error is None else None
+    filas = len(datos) if isinstance(datos, list) else int(datos is not None)
+    _anotar_llamada(method, path.split("?", 1)[0], r.status_code, time.perf_counter() - t0,
+                    filas, len(r.content))
+    if error is not None:
+        raise error
+    return datos
+
+
+def sb_pool_stats():
+    """Cuantas peticiones se hicieron y cuantas conexiones hubo que abrir para
+    ellas. Con el pool funcionando, conexiones es mucho menor que peticiones."""
+    almacen = _almacen()
+    with _sb_lock:
+        stats = dict(_sb_stats)
+    stats["almacen"] = almacen.nombre
+    if almacen.nombre == "sqlite":
+        stats.update(almacen.stats())
+        return stats
+    cliente = _sb_client()
+    stats.update({
+        "cliente": "httpx" if _sb_usa_httpx else "requests",
+        "pool_size": SB_POOL_SIZE,
+        "timeout": {"conexion": SB_TIMEOUT_CONEXION, "lectura": SB_TIMEOUT_LECTURA},
+    })
+    if not _sb_usa_httpx:
+        conexiones = peticiones = 0
+        for adaptador in set(cliente.adapters.values()):
+            if not hasattr(adaptador, "poolmanager"):
+                continue  # adaptadores sin pool de urllib3 (p. ej. el de bench/)
+            pools = adaptador.poolmanager.pools
+            for clave in list(pools.keys()):
+                pool = pools.get(clave)
+                if pool is not None:
+                    conexiones += pool.num_connections
+                    peticiones += pool.num_requests
+        stats["conexiones_abiertas"] = conexiones
+        stats["reutilizadas"] = max(0, peticiones - conexiones)
+    return stats
+
+
+# ------------------------------------------------------------
+# MEMO POR PETICION
+# Exportar el Excel completo pedia db_registros_rango(desde, hasta) tres
+# veces (directo, dentro de db_resumen_periodo y dentro de db_retardos) y la
+# lista de empleados otras dos. Mientras dure una peticion de Flask, una
+# consulta identica (tabla, select, filtros, orden, limite) se responde con lo
+# que ya se bajo; si dos hilos la piden a la vez, el segundo espera al primero
+# en vez de repetirla. Las paginas de _sb_get_paginado no entran, una por una
+# llenaban el memo con todo lo que se paginaba; db_registros_rango guarda su
+# rango entero. Cualquier escritura a una tabla descarta lo guardado de esa
+# tabla. Fuera de una peticion (scripts, hilos de fondo) no hay memo.
+# ------------------------------------------------------------
+MEMO_MAX_FILAS = int(os.environ.get("MEMO_MAX_FILAS", "200000"))
+
+_memo_peticion = contextvars.ContextVar("memo_peticion", default=None)
+
+
+class _MemoConsultas:
+    def __init__(self, max_filas=MEMO_MAX_FILAS):
+        self._lock = threading.Lock()
+        self._datos = {}  # clave -> [threading.Event, filas, error]
+        self._filas = 0
+        self._max_filas = max_filas
+
+    def obtener(self, clave, cargar):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            propia = entrada is None
+            if propia:
+                entrada = self._datos[clave] = [threading.Event(), None, None]
+        _metricas.contar("nevox_cache_total", cache="memo", resultado="miss" if propia else "hit")
+        if propia:
+            try:
+                entrada[1] = cargar()
+            except BaseException as e:
+                entrada[2] = e
+                self._soltar(clave, entrada)
+                raise
+            finally:
+                entrada[0].set()
+            with self._lock:
+                # Un rango de un ano no se guarda entero: el memo es para
+                # ahorrar idas a Supabase, no para llenar la memoria.
+                self._filas += len(entrada[1])
+                if self._filas > self._max_filas:
+                    self._filas -= len(entrada[1])
+                    if self._datos.get(clave) is entrada:
+                        del self._datos[clave]
+        else:
+            entrada[0].wait()
+            if entrada[2] is not None:
+                raise entrada[2]
+        # Copia por fila: _flatten_registros y _fix_activo modifican lo que
+        # reciben, y la siguiente consulta identica debe ver los datos crudos.
+        return [dict(f) for f in entrada[1]]
+
+    def _soltar(self, clave, entrada):
+        with self._lock:
+            if self._datos.get(clave) is entrada:
+                del self._datos[clave]
+
+    def invalidar(self, tabla=None):
+        with self._lock:
+            for clave in [c for c in self._datos if tabla is None or c[0] == tabla]:
+                entrada = self._datos.pop(clave)
+                if entrada[1] is not None:
+                    self._filas -= len(entrada[1])
+
+
+# ------------------------------------------------------------
+# TRAZA POR PETICION
+# Para saber por que un reporte o un check-in tarda sin enganchar un profiler
+# en produccion: cada peticion de Flask anota sus llamadas a Supabase (tabla,
+# verbo, status, duracion, filas y bytes) y el tiempo de las fases locales
+# marcadas con _fase. Al responder se agrega la cabecera Server-Timing, que se
+# ve en la pestana Network del navegador, y se escribe una linea JSON en el
+# log. Las tareas de _en_paralelo heredan la traza de la peticion, asi que las
+# fases pueden sumar mas que el total. El tiempo de una fase es propio: se le
+# descuenta lo que en el mismo hilo se fue en llamadas al almacen y en fases
+# anidadas. Sin eso "jornadas" incluia la bajada de las marcas, porque
+# _jornadas_por_dia recorre un generador que pide las paginas a medida que
+# avanza. TRAZA=0 la apaga; TRAZA_LOG_MS deja en el log solo las peticiones
+# mas lentas que eso.
+# ------------------------------------------------------------
+TRAZA = os.environ.get("TRAZA", "1") != "0"
+TRAZA_LOG_MS = float(os.environ.get("TRAZA_LOG_MS", "0"))
+
+_traza = contextvars.ContextVar("traza", default=None)
+
+log_traza = logging.getLogger("nevox.traza")
+if not log_traza.handlers:
+    _h = logging.StreamHandler()
+    _h.setFormatter(logging.Formatter("%(message)s"))
+    log_traza.addHandler(_h)
+    log_traza.setLevel(logging.INFO)
+    log_traza.propagate = False
+
+
+class _Traza:
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self._lock = threading.Lock()
+        self.llamadas = []  # (verbo, tabla, status, segundos, filas, bytes)
+        self.fases = {}     # nombre -> [veces, segundos]
+
+    def llamada(self, verbo, tabla, status, segundos, filas, nbytes):
+        with self._lock:
+            self.llamadas.append((verbo, tabla, status, segundos, filas, nbytes))
+
+    def fase(self, nombre, segundos):
+        with self._lock:
+            f = self.fases.setdefault(nombre, [0, 0.0])
+            f[0] += 1
+            f[1] += segundos
+
+    def por_tabla(self):
+        tablas = {}
+        with self._lock:
+            for verbo, tabla, status, seg, filas, nbytes in self.llamadas:
+                t = tablas.setdefault(tabla, {"llamadas": 0, "ms": 0.0, "filas": 0,
+                                              "bytes": 0, "errores": 0, "verbos": {}})
+                t["llamadas"] += 1
+                t["ms"] += seg * 1000
+                t["filas"] += filas
+                t["bytes"] += nbytes
+                t["errores"] += status >= 400
+                t["verbos"][verbo] = t["verbos"].get(verbo, 0) + 1
+        return tablas
+
+    def server_timing(self, total_ms):
+        partes = [f'total;dur={total_ms:.1f}']
+        tablas = self.por_tabla()
+        if tablas:
+            n = sum(t["llamadas"] for t in tablas.values())
+            ms = sum(t["ms"] for t in tablas.values())
+            partes.append(f'sb;desc="{n} llamadas";dur={ms:.1f}')
+        for tabla, t in tablas.items():
+            verbos = " ".join(f"{v}x{c}" for v, c in t["verbos"].items())
+            nombre = "sb-" + tabla.replace("/", "-")
+            partes.append(f'{nombre};desc="{verbos} {t["filas"]} filas {t["bytes"]} B";dur={t["ms"]:.1f}')
+        with self._lock:
+            fases = list(self.fases.items())
+        for nombre, (veces, seg) in fases:
+            partes.append(f'{nombre};desc="x{veces}";dur={seg * 1000:.1f}')
+        return ", ".join(partes)
+
+
+def _sumar_fase(nombre, segundos):
+    traza = _traza.get()
+    if traza is not None:
+        traza.fase(nombre, segundos)
+
+
+@contextmanager
+def _fase(nombre):
+    """Mide un tramo local en la traza de la peticion. Sirve tambien como
+    decorador: @_fase("jornadas")."""
+    if _traza.get() is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    fuera0 = getattr(_hilo, "fuera", 0.0)
+    try:
+        yield
+    finally:
+        total = time.perf_counter() - t0
+        _sumar_fase(nombre, total - (getattr(_hilo, "fuera", 0.0) - fuera0))
+        _hilo.fuera = fuera0 + total  # para la fase que envuelve a esta
+
+
+# ------------------------------------------------------------
+# METRICAS
+# Contadores e histogramas en memoria, por instancia, para /api/metrics en
+# formato de texto de Prometheus: peticiones por ruta, llamadas y errores a
+# Supabase por tabla, resultado de cada check-in, QR generados y aciertos de
+# los caches (memo, ajustes, _hoy y QR). Anotar es un lock y una suma, asi que
+# queda siempre encendido. En Vercel cada instancia tiene sus propios numeros
+# y empiezan de cero en cada arranque en frio (nevox_inicio_segundos).
+# ------------------------------------------------------------
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+METRICAS_INFO = {
+    "nevox_http_peticiones_total": ("counter", "Peticiones HTTP atendidas"),
+    "nevox_http_duracion_segundos": ("histogram", "Duracion de las peticiones HTTP"),
+    "nevox_supabase_llamadas_total": ("counter", "Llamadas a Supabase REST"),
+    "nevox_supabase_errores_total": ("counter", "Llamadas a Supabase con status >= 400"),
+    "nevox_supabase_duracion_segundos": ("histogram", "Duracion de las llamadas a Supabase"),
+    "nevox_checkin_total": ("counter", "Escaneos de check-in por resultado"),
+    "nevox_qr_generados_total": ("counter", "Imagenes QR codificadas"),
+    "nevox_cache_total": ("counter", "Consultas a los caches por resultado"),
+}
+
+
+class _Metricas:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contadores = {}   # (nombre, etiquetas) -> n
+        self._histogramas = {}  # (nombre, etiquetas) -> [cuenta por bucket..., suma, total]
+        self.inicio = time.time()
+
+    def contar(self, nombre, n=1, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + n
+
+    def observar(self, nombre, valor, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        i = bisect.bisect_left(BUCKETS_SEGUNDOS, valor)
+        with self._lock:
+            h = self._histogramas.get(clave)
+            if h is None:
+                h = self._histogramas[clave] = [0] * (len(BUCKETS_SEGUNDOS) + 2)
+            if i < len(BUCKETS_SEGUNDOS):
+                h[i] += 1
+            h[-2] += valor
+            h[-1] += 1
+
+    def texto(self, extras=()):
+        """Exposicion en formato Prometheus; extras: [(nombre, tipo, ayuda, valor)]."""
+        with self._lock:
+            contadores = sorted(self._contadores.items())
+            histogramas = sorted((k, list(v)) for k, v in self._histogramas.items())
+        lineas, vistos = [], set()
+
+        def cabecera(nombre, tipo=None, ayuda=None):
+            if nombre not in vistos:
+                vistos.add(nombre)
+                tipo_info, ayuda_info = METRICAS_INFO.get(nombre, (tipo, ayuda))
+                lineas.append(f"# HELP {nombre} {ayuda or ayuda_info}")
+                lineas.append(f"# TYPE {nombre} {tipo or tipo_info}")
+
+        for (nombre, etiquetas), n in contadores:
+            cabecera(nombre)
+            lineas.append(f"{nombre}{_etiquetas(etiquetas)} {n}")
+        for (nombre, etiquetas), h in histogramas:
+            cabecera(nombre)
+            acumulado = 0
+            for le, n in zip(BUCKETS_SEGUNDOS, h):
+                acumulado += n
+                lineas.append(f"{nombre}_bucket{_etiquetas(etiquetas + (('le', str(le)),))} {acumulado}")
+            lineas.append(f"{nombre}_bucket{_etiquetas(etiquetas + (('le', '+Inf'),))} {h[-1]}")
+            lineas.append(f"{nombre}_sum{_etiquetas(etiquetas)} {h[-2]:.6f}")
+            lineas.append(f"{nombre}_count{_etiquetas(etiquetas)} {h[-1]}")
+        for nombre, tipo, ayuda, valor in extras:
+            cabecera(nombre, tipo, ayuda)
+            lineas.append(f"{nombre} {valor}")
+        return "\n".join(lineas) + "\n"
+
+
+def _etiquetas(pares):
+    if not pares:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pares) + "}"
+
+
+_metricas = _Metricas()
+
+
+# ------------------------------------------------------------
+# PERFILADO BAJO DEMANDA
+# Un reporte largo puede ir lento por Supabase, por _flatten_registros, por
+# _jornadas_por_dia o por el estilo de las celdas de openpyxl, y la traza solo
+# dice cuanto tardo cada fase. Con ?perfil=cprofile (o la cabecera
+# X-Perfil: cprofile) el admin perfila esa sola peticion con cProfile y se
+# guarda un .pstats; con perfil=muestreo un hilo toma la pila cada
+# PERFIL_INTERVALO_MS y se guarda en formato "collapsed" (una linea por pila,
+# listo para flamegraph.pl o speedscope). En muestreo las tareas de
+# _en_paralelo entran en el mismo perfil. cProfile, desde Python 3.12, va por
+# sys.monitoring y solo puede haber uno activo en todo el proceso: se usa uno
+# solo, para una peticion a la vez, y si ya esta tomado la peticion se perfila
+# por muestreo. Los archivos quedan en PERFIL_DIR (en Vercel solo /tmp
+# es escribible y dura lo que la instancia) y se bajan desde
+# /api/admin/perfiles. No sirve para el stream SSE, que sigue despues de
+# responder.
+# ------------------------------------------------------------
+PERFIL_DIR = os.environ.get("PERFIL_DIR", "/tmp/nevox-perfiles")
+PERFIL_INTERVALO_MS = float(os.environ.get("PERFIL_INTERVALO_MS", "5"))
+PERFIL_MAX = int(os.environ.get("PERFIL_MAX", "20"))  # archivos que se conservan
+PERFIL_MODOS = ("cprofile", "muestreo")
+_PERFIL_NOMBRE = re.compile(r"^[\w.-]+\.(pstats|collapsed)$")
+
+_perfil = contextvars.ContextVar("perfil", default=None)
+_cprofile_lock = threading.Lock()  # el unico cProfile activo del proceso
+
+
+class _Perfil:
+    def __init__(self, modo, etiqueta):
+        self.modo = modo
+        self.nombre = f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}-{etiqueta}"
+        self._lock = threading.Lock()
+        self._perfiles = []        # el cProfile.Profile de la peticion
+        self._hilos = set()        # hilos que se muestrean
+        self._pilas = Counter()    # "a;b;c" -> muestras
+        self._fin = threading.Event()
+        self._muestreador = None
+
+    def _entrar(self):
+        """Empieza a perfilar el hilo actual; devuelve lo que necesita _salir."""
+        if self.modo == "cprofile":
+            p = self._tomar_cprofile()
+            if p is not None:
+                return p
+            self.modo = "muestreo"
+        with self._lock:
+            self._hilos.add(threading.get_ident())
+        return threading.get_ident()
+
+    def _tomar_cprofile(self):
+        """Un cProfile.Profile ya activo, o None si hay otro en el proceso."""
+        if not _cprofile_lock.acquire(blocking=False):
+            return None
+        p = cProfile.Profile()
+        try:
+            p.enable()
+        except ValueError:
+            # "Another profiling tool is already active": un debugger u otro
+            # profiler fuera de la app.
+            _cprofile_lock.release()
+            return None
+        self._perfiles.append(p)
+        return p
+
+    def _salir(self, marca):
+        if isinstance(marca, cProfile.Profile):
+            marca.disable()
+            _cprofile_lock.release()
+        else:
+            with self._lock:
+                self._hilos.discard(marca)
+
+    def envolver(self, tarea):
+        """La tarea perfilada en el hilo donde corra (para _en_paralelo). Con
+        cProfile no se envuelve: no puede haber un segundo perfil activo."""
+        if self.modo == "cprofile":
+            return tarea
+
+        def perfilada():
+            marca = self._entrar()
+            try:
+                return tarea()
+            finally:
+                self._salir(marca)
+        return perfilada
+
+    def iniciar(self):
+        self._marca = self._entrar()
+        if self.modo == "muestreo":
+            self._muestreador = threading.Thread(target=self._muestrear, daemon=True)
+            self._muestreador.start()
+
+    def _muestrear(self):
+        intervalo = PERFIL_INTERVALO_MS / 1000
+        while not self._fin.wait(intervalo):
+            frames = sys._current_frames()
+            with self._lock:
+                hilos = list(self._hilos)
+            for tid in hilos:
+                f = frames.get(tid)
+                pila = []
+                while f is not None:
+                    c = f.f_code
+                    pila.append(f"{c.co_name} ({os.path.basename(c.co_filename)}:{c.co_firstlineno})")
+                    f = f.f_back
+                if pila:
+                    self._pilas[";".join(reversed(pila))] += 1
+
+    def detener(self):
+        self._salir(self._marca)
+        self._fin.set()
+        if self._muestreador is not None:
+            self._muestreador.join()
+
+    def guardar(self):
+        """Escribe el archivo y devuelve su nombre."""
+        os.makedirs(PERFIL_DIR, exist_ok=True)
+        if self.modo == "cprofile":
+            nombre = f"{self.nombre}.pstats"
+            stats = pstats.Stats(self._perfiles[0])
+            for p in self._perfiles[1:]:
+                stats.add(p)
+            stats.dump_stats(os.path.join(PERFIL_DIR, nombre))
+        else:
+            nombre = f"{self.nombre}.collapsed"
+            with open(os.path.join(PERFIL_DIR, nombre), "w", encoding="utf-8") as f:
+                for pila, n in self._pilas.most_common():
+                    f.write(f"{pila} {n}\n")
+        _podar_perfiles()
+        return nombre
+
+
+def _listar_perfiles():
+    if not os.path.isdir(PERFIL_DIR):
+        return []
+    archivos = []
+    for nombre in os.listdir(PERFIL_DIR):
+        if _PERFIL_NOMBRE.match(nombre):
+            st = os.stat(os.path.join(PERFIL_DIR, nombre))
+            archivos.append({"nombre": nombre, "bytes": st.st_size, "creado": st.st_mtime})
+    archivos.sort(key=lambda a: a["creado"], reverse=True)
+    return archivos
+
+
+def _podar_perfiles():
+    for viejo in _listar_perfiles()[PERFIL_MAX:]:
+        try:
+            os.remove(os.path.join(PERFIL_DIR, viejo["nombre"]))
+        except OSError:
+            pass
+
+
+def _sb_params(select="*", filters=None, order=None, limit=None):
     params = [("select", select)]
     if filters:
         params.extend(filters)
@@ -90,63 +688,804 @@ def _sb_get(table, select="*", filters=None, order=None, limit=None):
         params.append(("order", order))
     if limit:
         params.append(("limit", str(limit)))
-    r = _http.get(f"{SUPABASE_URL}/rest/v1/{table}", params=params, headers=_sb_headers())
-    r.raise_for_status()
-    return r.json()
+    return params
 
 
-def _sb_post(table, data, prefer="return=representation"):
-    r = _http.post(f"{SUPABASE_URL}/rest/v1/{table}", json=data, headers=_sb_headers(prefer))
-    r.raise_for_status()
-    return r.json() if prefer and "return" in prefer else None
+def _sb_get(table, select="*", filters=None, order=None, limit=None):
+    params = _sb_params(select, filters, order, limit)
+    memo = _memo_peticion.get()
+    if memo is None:
+        return _sb_request("GET", table, params=params)
+    return memo.obtener(
+        (table, tuple(params)),
+        lambda: _sb_request("GET", table, params=params),
+    )
 
 
-def _sb_upsert(table, data):
-    r = _http.post(
-        f"{SUPABASE_URL}/rest/v1/{table}", json=data,
-        headers=_sb_headers("resolution=merge-duplicates,return=representation"),
+# PostgREST corta cada respuesta en max-rows (1000 en Supabase) sin avisar: un
+# mes de registros de 50 personas ya no cabe y los reportes salian con totales
+# de menos. Las consultas de rango se piden por paginas con keyset sobre
+# (fecha_hora, id), que a diferencia de offset no se salta ni repite filas si
+# entra un registro mientras se pagina. SUPABASE_PAGINA no debe pasar del
+# max-rows del proyecto: una pagina mas corta que esto se toma como la ultima.
+SB_PAGINA = int(os.environ.get("SUPABASE_PAGINA", "1000"))
+
+
+def _sb_get_paginado(table, select="*", filters=None, desc=False, pagina=None, claves=("fecha_hora", "id")):
+    """Genera paginas (listas) de filas ordenadas por claves (una columna y
+    un entero que desempata; fecha_hora e id salvo que se diga otra cosa).
+    Las paginas no pasan por el memo de la peticion: quien pagina es porque
+    no quiere el rango entero en memoria (ver db_registros_rango)."""
+    pagina = pagina or SB_PAGINA
+    sentido, comp = ("desc", "lt") if desc else ("asc", "gt")
+    col, desempate = claves
+    cursor = []
+    while True:
+        filas = _sb_request("GET", table, params=_sb_params(
+            select, list(filters or []) + cursor, f"{col}.{sentido},{desempate}.{sentido}", pagina)) or []
+        ultima = len(filas) < pagina
+        if not ultima:
+            # El cursor se arma antes de entregar la pagina, porque quien la
+            # recibe reescribe fecha_hora a hora local. Comillas: el timestamp
+            # lleva ':' y '.', y un nombre puede llevar comas o parentesis,
+            # que PostgREST lee como separadores en or=(...).
+            fh = '"' + str(filas[-1][col]).replace("\\", "\\\\").replace('"', '\\"') + '"'
+            ult = filas[-1][desempate]
+            cursor = [("or", f"({col}.{comp}.{fh},and({col}.eq.{fh},{desempate}.{comp}.{ult}))")]
+        if filas:
+            yield filas
+        if ultima:
+            return
+
+
+def _sb_post(table, data, prefer="return=representation", select=None):
+    params = [("select", select)] if select else None
+    datos = _sb_request("POST", table, params=params, json=data, prefer=prefer)
+    return datos if prefer and "return" in prefer else None
+
+
+def _sb_upsert(table, data, devolver=True):
+    return _sb_request(
+        "POST", table, json=data,
+        prefer="resolution=merge-duplicates," + ("return=representation" if devolver else "return=minimal"),
     )
-    r.raise_for_status()
-    return r.json()
 
 
-def _sb_patch(table, data, filters):
-    r = _http.patch(
-        f"{SUPABASE_URL}/rest/v1/{table}", json=data,
-        params=filters, headers=_sb_headers("return=representation"),
-    )
-    r.raise_for_status()
-    return r.json()
+def _sb_patch(table, data, filters, select=None):
+    params = list(filters) + ([("select", select)] if select else [])
+    return _sb_request("PATCH", table, params=params, json=data,
+                       prefer="return=representation")
 
 
-def _sb_delete(table, filters):
-    r = _http.delete(
-        f"{SUPABASE_URL}/rest/v1/{table}",
-        params=filters, headers=_sb_headers(),
-    )
-    r.raise_for_status()
+def _sb_delete(table, filters, devolver=False):
+    """Con devolver=True responde las filas borradas."""
+    datos = _sb_request("DELETE", table, params=filters,
+                        prefer="return=representation" if devolver else None)
+    return datos if devolver else None
 
 
 def _sb_rpc(fn_name, data):
-    r = _http.post(
-        f"{SUPABASE_URL}/rest/v1/rpc/{fn_name}", json=data,
-        headers=_sb_headers(),
-    )
-    r.raise_for_status()
-    return r.json()
+    return _sb_request("POST", f"rpc/{fn_name}", json=data)
+
+
+class _AlmacenSupabase:
+    """El almacen sobre PostgREST de Supabase (ver ALMACEN)."""
+
+    nombre = "supabase"
+
+    # --- configuracion ---
+
+    def config(self):
+        """Toda la tabla configuracion, clave -> valor."""
+        return {f["clave"]: f["valor"] for f in _sb_get("configuracion", select="clave,valor")}
+
+    def config_valor(self, clave):
+        filas = _sb_get("configuracion", select="valor", filters=[("clave", f"eq.{clave}")])
+        return filas[0]["valor"] if filas else None
+
+    def guardar_config(self, valores):
+        _sb_upsert("configuracion", [{"clave": k, "valor": v} for k, v in valores.items()], devolver=False)
+
+    # --- empleados ---
+
+    def crear_empleado(self, fila):
+        return _sb_post("empleados", fila)[0]
+
+    def empleado(self, emp_id):
+        filas = _sb_get("empleados", filters=[("id", f"eq.{emp_id}")])
+        return filas[0] if filas else None
+
+    def empleado_por_token(self, token):
+        filas = _sb_get("empleados", filters=[("token_dispositivo", f"eq.{token}"), ("activo", "eq.true")])
+        return filas[0] if filas else None
+
+    def paginas_empleados(self, solo_activos=True):
+        """Paginas de empleados por (nombre, id)."""
+        filters = [("activo", "eq.true")] if solo_activos else []
+        return _sb_get_paginado("empleados", filters=filters, claves=("nombre", "id"))
+
+    def actualizar_empleado(self, emp_id, campos):
+        _sb_patch("empleados", campos, [("id", f"eq.{emp_id}")])
+
+    def borrar_empleados(self):
+        _sb_delete("empleados", [("id", "neq.0")])
+
+    # --- registros ---
+
+    def insertar_registro(self, fila):
+        """La marca guardada, con el join de empleados."""
+        filas = _sb_post("registros", fila, select=SELECT_REGISTROS)
+        return filas[0] if filas else None
+
+    def registro(self, reg_id):
+        filas = _sb_get("registros", filters=[("id", f"eq.{reg_id}")])
+        return filas[0] if filas else None
+
+    def actualizar_registro(self, reg_id, campos):
+        """Las marcas cambiadas (una, o ninguna si no existe), con el join."""
+        return _sb_patch("registros", campos, [("id", f"eq.{reg_id}")], select=SELECT_REGISTROS) or []
+
+    def borrar_registro(self, reg_id, devolver=False):
+        """Con devolver=True responde las marcas borradas."""
+        return _sb_delete("registros", [("id", f"eq.{reg_id}")], devolver=devolver)
+
+    def borrar_registros(self):
+        _sb_delete("registros", [("id", "neq.0")])
+
+    def marcas_empleado(self, emp_id, ini, fin, desc=False, limite=None):
+        """Marcas del empleado entre ini y fin (UTC), sin el join."""
+        sentido = "desc" if desc else "asc"
+        return _sb_get("registros", filters=[
+            ("empleado_id", f"eq.{emp_id}"),
+            ("fecha_hora", f"gte.{ini}"),
+            ("fecha_hora", f"lte.{fin}"),
+        ], order=f"fecha_hora.{sentido},id.{sentido}", limit=limite)
+
+    def paginas_registros(self, ini=None, fin=None, emp_id=None, desc=False):
+        """Paginas de marcas con el join, por (fecha_hora, id); ini y fin en UTC."""
+        filters = []
+        if ini:
+            filters.append(("fecha_hora", f"gte.{ini}"))
+        if fin:
+            filters.append(("fecha_hora", f"lte.{fin}"))
+        if emp_id:
+            filters.append(("empleado_id", f"eq.{emp_id}"))
+        return _sb_get_paginado("registros", select=SELECT_REGISTROS, filters=filters, desc=desc)
+
+    def checkin(self, empleado_id, token_dispositivo, token_qr, desde, hasta, antirrebote,
+                salida_programada, margen_salida, hora_corte, duplicado_max, utc_offset_min):
+        """Decision y escritura del check-in: sql/checkin_decidir.sql."""
+        return _sb_rpc("checkin_decidir", {
+            "p_empleado_id": empleado_id,
+            "p_token_dispositivo": token_dispositivo,
+            "p_token_qr": token_qr,
+            "p_desde": desde, "p_hasta": hasta,
+            "p_antirrebote": antirrebote,
+            "p_salida_programada": salida_programada,
+            "p_margen_salida": margen_salida,
+            "p_hora_corte": hora_corte,
+            "p_duplicado_max": duplicado_max,
+            "p_utc_offset_min": utc_offset_min,
+        })
+
+    # --- jornadas_dia (ROLLUPS=1) ---
+
+    def fechas_cubiertas(self, desde, hasta):
+        return {f["fecha"] for f in _sb_get("jornadas_cobertura", select="fecha", filters=[
+            ("fecha", f"gte.{desde}"), ("fecha", f"lte.{hasta}"),
+        ])}
+
+    def cubrir(self, fechas):
+        _sb_upsert("jornadas_cobertura", [{"fecha": f} for f in fechas], devolver=False)
+
+    def descubrir(self, fechas):
+        """Quita la cobertura de esas fechas; devuelve las que la tenian."""
+        filas = _sb_delete("jornadas_cobertura", [("fecha", f"in.({','.join(fechas)})")], devolver=True)
+        return [f["fecha"] for f in filas or []]
+
+    def guardar_jornadas(self, filas):
+        # Upsert y no insert: dos reportes pueden estar llenando la misma fecha.
+        for i in range(0, len(filas), ROLLUP_LOTE):
+            _sb_upsert("jornadas_dia", filas[i:i + ROLLUP_LOTE], devolver=False)
+
+    def borrar_jornadas(self, desde, hasta, emp_id=None):
+        filters = [("fecha", f"gte.{desde}"), ("fecha", f"lte.{hasta}")]
+        if emp_id:
+            filters.append(("empleado_id", f"eq.{emp_id}"))
+        _sb_delete("jornadas_dia", filters)
+
+    def paginas_jornadas(self, desde, hasta, emp_id=None):
+        """Paginas de jornadas_dia con el join, por (fecha, empleado_id)."""
+        filters = [("fecha", f"gte.{desde}"), ("fecha", f"lte.{hasta}")]
+        if emp_id:
+            filters.append(("empleado_id", f"eq.{emp_id}"))
+        return _sb_get_paginado("jornadas_dia", select=SELECT_JORNADAS, filters=filters,
+                                claves=("fecha", "empleado_id"))
+
+    def vaciar_jornadas(self):
+        _sb_delete("jornadas_cobertura", [("fecha", "not.is.null")])
+        _sb_delete("jornadas_dia", [("empleado_id", "neq.0")])
+
+
+# ------------------------------------------------------------
+# ALMACEN LOCAL EN SQLITE (ALMACEN=sqlite)
+# Los mismos metodos que _AlmacenSupabase, con SQL directo sobre un archivo
+# local. Las escrituras van en una transaccion que toma el lock de escritura
+# al empezar (BEGIN IMMEDIATE), que hace las veces del FOR UPDATE de
+# Postgres; el check-in entero (leer las marcas de hoy, decidir y escribir)
+# corre dentro de una sola. Con WAL los lectores no esperan a quien escribe.
+# Una conexion por hilo. Las paginas son keyset por las mismas claves que en
+# Supabase, asi un rango largo no queda entero en memoria.
+#
+# Los timestamptz se guardan como texto UTC de ancho fijo
+# ("2024-05-02T12:00:00.000000+00:00"): comparar y ordenar ese texto es
+# comparar y ordenar las fechas, y los limites de los rangos se pasan al
+# mismo formato. Los booleanos van como 0/1 y el jsonb como texto JSON.
+# ------------------------------------------------------------
+SQLITE_ESPERA = float(os.environ.get("SQLITE_ESPERA_SEGUNDOS", "5"))
+
+SQLITE_ESQUEMA = """
+create table if not exists empleados (
+    id                integer primary key autoincrement,
+    nombre            text    not null,
+    departamento      text    not null default '',
+    hora_entrada      text    not null default '09:00',
+    hora_salida       text    not null default '18:00',
+    token_dispositivo text,
+    activo            integer not null default 1
+);
+-- El check-in y el registro de dispositivo buscan por token.
+create index if not exists empleados_token_idx on empleados (token_dispositivo);
+
+create table if not exists registros (
+    id          integer primary key autoincrement,
+    empleado_id integer not null references empleados(id),
+    tipo        text    not null,
+    fecha_hora  text    not null,
+    token_usado text
+);
+-- Las marcas de hoy de un empleado (check-in) y los rangos paginados por
+-- (fecha_hora, id) de los reportes.
+create index if not exists registros_empleado_fecha_idx on registros (empleado_id, fecha_hora);
+create index if not exists registros_fecha_idx on registros (fecha_hora, id);
+
+create table if not exists configuracion (
+    clave text primary key,
+    valor text
+);
+
+-- sql/jornadas_dia.sql (ROLLUPS=1)
+create table if not exists jornadas_dia (
+    empleado_id         integer not null references empleados(id) on delete cascade,
+    fecha               text    not null,
+    marcas              integer not null,
+    entradas_sin_salida integer not null default 0,
+    salidas_sin_entrada integer not null default 0,
+    trabajado_min       real    not null default 0,
+    pares               text    not null default '[]',
+    primera_entrada     text,
+    ultima_salida       text,
+    abierta_desde       text,
+    primera_marca       text    not null,
+    primera_marca_id    integer not null,
+    actualizado         text    not null,
+    primary key (empleado_id, fecha)
+);
+create index if not exists jornadas_dia_fecha_idx on jornadas_dia (fecha, empleado_id);
+
+create table if not exists jornadas_cobertura (
+    fecha     text primary key,
+    calculado text not null
+);
+"""
+
+# Columnas que no son texto ni numero tal cual. Las "ts" que no vengan en un
+# insert se llenan con la hora actual, como el default now() de Postgres.
+_SQLITE_TIPOS = {
+    ("empleados", "activo"): "bool",
+    ("registros", "fecha_hora"): "ts",
+    ("jornadas_dia", "pares"): "json",
+    ("jornadas_dia", "actualizado"): "ts",
+    ("jornadas_cobertura", "calculado"): "ts",
+}
+
+_SQLITE_REGISTROS = ("select r.id, r.empleado_id, r.tipo, r.fecha_hora, r.token_usado, "
+                     "e.nombre, e.departamento from registros r left join empleados e on e.id = r.empleado_id")
+_SQLITE_JORNADAS = ("select j.*, e.nombre, e.departamento "
+                    "from jornadas_dia j left join empleados e on e.id = j.empleado_id")
+
+
+def _ts_sqlite(v):
+    dt = v if isinstance(v, datetime) else datetime.fromisoformat(v)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)  # como Postgres con la sesion en UTC
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+
+
+def _asignaciones(campos):
+    return ", ".join(f'"{c}" = ?' for c in campos)
+
+
+def _con_empleado(d):
+    """Pasa nombre y departamento del join a "empleados", como el embed de PostgREST."""
+    nombre, departamento = d.pop("nombre"), d.pop("departamento")
+    d["empleados"] = None if nombre is None else {"nombre": nombre, "departamento": departamento}
+    return d
+
+
+class _AlmacenSqlite:
+    """El almacen sobre un archivo SQLite local (ver ALMACEN)."""
+
+    nombre = "sqlite"
+
+    def __init__(self, ruta, reloj=None):
+        self.ruta = ruta
+        self.reloj = reloj or (lambda: datetime.now(timezone.utc))
+        self._hilo = threading.local()
+        carpeta = os.path.dirname(ruta)
+        if carpeta:
+            os.makedirs(carpeta, exist_ok=True)
+        con = self._conexion()
+        con.executescript(SQLITE_ESQUEMA)
+        self._columnas, self._pk = {}, {}
+        for (tabla,) in con.execute("select name from sqlite_master where type = 'table'").fetchall():
+            info = con.execute(f'pragma table_info("{tabla}")').fetchall()
+            self._columnas[tabla] = {c[1] for c in info}
+            self._pk[tabla] = tuple(c[1] for c in sorted(info, key=lambda c: c[5]) if c[5])
+        # Base nueva: los mismos valores iniciales que tenia la version de
+        # escritorio (ver README).
+        with self._escritura():
+            con.executemany("insert or ignore into configuracion (clave, valor) values (?, ?)", [
+                ("admin_password", hashlib.sha256(b"admin123").hexdigest()),
+                ("secret_key", secrets.token_hex(32)),
+                ("tolerancia_minutos", "15"),
+                ("nombre_empresa", "NEVOX FARMA"),
+            ])
+
+    # --- conexion ---
+
+    def _conexion(self):
+        con = getattr(self._hilo, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.ruta, timeout=SQLITE_ESPERA, isolation_level=None)
+            con.row_factory = sqlite3.Row
+            con.execute("pragma journal_mode = wal")
+            con.execute("pragma synchronous = normal")  # en WAL no pierde consistencia
+            con.execute("pragma foreign_keys = on")
+            self._hilo.con = con
+        return con
+
+    @contextmanager
+    def _escritura(self):
+        """Transaccion de escritura. Dentro de otra, es parte de esa."""
+        con = self._conexion()
+        if con.in_transaction:
+            yield con
+            return
+        con.execute("begin immediate")
+        try:
+            yield con
+        except BaseException:
+            con.execute("rollback")
+            raise
+        con.execute("commit")
+
+    def _consulta(self, verbo, tabla, sql, args=()):
+        """Filas de una sentencia, anotada como una llamada al almacen con el
+        verbo de PostgREST que le corresponde."""
+        t0 = time.perf_counter()
+        status, filas = 200, []
+        try:
+            filas = self._conexion().execute(sql, args).fetchall()
+            return filas
+        except sqlite3.IntegrityError:
+            status = 409
+            raise
+        except sqlite3.OperationalError:
+            status = 503  # "database is locked" pasados SQLITE_ESPERA segundos
+            raise
+        finally:
+            self._anotar(verbo, tabla, status, time.perf_counter() - t0, len(filas))
+
+    def _anotar(self, verbo, tabla, status, dur, filas):
+        _anotar_llamada(verbo, tabla, status, dur, filas, 0)
+
+    def stats(self):
+        con = self._conexion()
+        tamano = sum(os.path.getsize(self.ruta + ext) for ext in ("", "-wal")
+                     if os.path.exists(self.ruta + ext))
+        return {
+            "ruta": os.path.abspath(self.ruta),
+            "journal_mode": con.execute("pragma journal_mode").fetchone()[0],
+            "tamano_bytes": tamano,
+        }
+
+    # --- filas ---
+
+    def _a_sqlite(self, tabla, fila, nueva=True):
+        d = {}
+        for c, v in fila.items():
+            if c not in self._columnas[tabla]:
+                raise ValueError(f"column {tabla}.{c} does not exist")
+            tipo = _SQLITE_TIPOS.get((tabla, c))
+            if v is not None and tipo == "ts":
+                v = _ts_sqlite(v)
+            elif v is not None and tipo == "bool":
+                v = 1 if v in (True, 1, "true") else 0
+            elif v is not None and tipo == "json":
+                v = json.dumps(v)
+            d[c] = v
+        if nueva:
+            for (t, c), tipo in _SQLITE_TIPOS.items():
+                if t == tabla and tipo == "ts" and d.get(c) is None:
+                    d[c] = _ts_sqlite(self.reloj())
+        return d
+
+    @staticmethod
+    def _desde_sqlite(tabla, fila):
+        d = dict(fila)
+        for (t, c), tipo in _SQLITE_TIPOS.items():
+            if t == tabla and d.get(c) is not None:
+                if tipo == "bool":
+                    d[c] = bool(d[c])
+                elif tipo == "json":
+                    d[c] = json.loads(d[c])
+        return d
+
+    def _guardar(self, tabla, filas, conflicto=None):
+        """Inserta las filas y las devuelve como quedaron. Con conflicto (las
+        columnas de una clave unica), la fila que ya esta se actualiza solo
+        en las columnas enviadas, como resolution=merge-duplicates."""
+        hechas = []
+        with self._escritura():
+            for fila in filas:
+                fila = self._a_sqlite(tabla, fila)
+                columnas = ", ".join(f'"{c}"' for c in fila)
+                sql = f'insert into "{tabla}" ({columnas}) values ({", ".join("?" * len(fila))})'
+                if conflicto:
+                    pisar = [c for c in fila if c not in conflicto]
+                    sql += " on conflict (" + ", ".join(f'"{c}"' for c in conflicto) + ") do "
+                    sql += ("update set " + ", ".join(f'"{c}" = excluded."{c}"' for c in pisar)) if pisar else "nothing"
+                hechas.extend(self._consulta("POST", tabla, sql + " returning *", list(fila.values())))
+        return [self._desde_sqlite(tabla, f) for f in hechas]
+
+    def _paginas(self, tabla, sql, condiciones, args, claves, desc=False):
+        """Genera paginas de SB_PAGINA filas por keyset sobre claves (columnas
+        con el alias de la consulta)."""
+        sentido, comp = ("desc", "<") if desc else ("asc", ">")
+        orden = " order by " + ", ".join(f"{c} {sentido}" for c in claves) + " limit ?"
+        cursor = ()
+        while True:
+            where = list(condiciones)
+            if cursor:
+                where.append(f"({', '.join(claves)}) {comp} (?, ?)")
+            filas = self._consulta("GET", tabla, sql + (" where " + " and ".join(where) if where else "") + orden,
+                                   [*args, *cursor, SB_PAGINA])
+            if filas:
+                yield filas
+            if len(filas) < SB_PAGINA:
+                return
+            cursor = tuple(filas[-1][c.split(".")[-1]] for c in claves)
+
+    def _registro_por_id(self, reg_id):
+        filas = self._consulta("GET", "registros", f"{_SQLITE_REGISTROS} where r.id = ?", [reg_id])
+        return _con_empleado(dict(filas[0])) if filas else None
+
+    # --- configuracion ---
+
+    def config(self):
+        return {f["clave"]: f["valor"] for f in self._consulta(
+            "GET", "configuracion", "select clave, valor from configuracion")}
+
+    def config_valor(self, clave):
+        filas = self._consulta("GET", "configuracion", "select valor from configuracion where clave = ?", [clave])
+        return filas[0]["valor"] if filas else None
+
+    def guardar_config(self, valores):
+        self._guardar("configuracion", [{"clave": k, "valor": v} for k, v in valores.items()], ("clave",))
+
+    # --- empleados ---
+
+    def crear_empleado(self, fila):
+        return self._guardar("empleados", [fila])[0]
+
+    def empleado(self, emp_id):
+        filas = self._consulta("GET", "empleados", "select * from empleados where id = ?", [emp_id])
+        return self._desde_sqlite("empleados", filas[0]) if filas else None
+
+    def empleado_por_token(self, token):
+        filas = self._consulta("GET", "empleados",
+                               "select * from empleados where token_dispositivo = ? and activo = 1", [token])
+        return self._desde_sqlite("empleados", filas[0]) if filas else None
+
+    def paginas_empleados(self, solo_activos=True):
+        condiciones = ["activo = 1"] if solo_activos else []
+        for pagina in self._paginas("empleados", "select * from empleados", condiciones, [], ("nombre", "id")):
+            yield [self._desde_sqlite("empleados", f) for f in pagina]
+
+    def actualizar_empleado(self, emp_id, campos):
+        campos = self._a_sqlite("empleados", campos, nueva=False)
+        with self._escritura():
+            self._consulta("PATCH", "empleados", f"update empleados set {_asignaciones(campos)} where id = ?",
+                           [*campos.values(), emp_id])
+
+    def borrar_empleados(self):
+        with self._escritura():
+            self._consulta("DELETE", "empleados", "delete from empleados")
+
+    # --- registros ---
+
+    def insertar_registro(self, fila):
+        with self._escritura():
+            rid = self._guardar("registros", [fila])[0]["id"]
+            return self._registro_por_id(rid)
+
+    def registro(self, reg_id):
+        filas = self._consulta("GET", "registros", "select * from registros where id = ?", [reg_id])
+        return dict(filas[0]) if filas else None
+
+    def actualizar_registro(self, reg_id, campos):
+        campos = self._a_sqlite("registros", campos, nueva=False)
+        with self._escritura():
+            filas = self._consulta("PATCH", "registros",
+                                   f"update registros set {_asignaciones(campos)} where id = ? returning id",
+                                   [*campos.values(), reg_id])
+            return [self._registro_por_id(f["id"]) for f in filas]
+
+    def borrar_registro(self, reg_id, devolver=False):
+        with self._escritura():
+            filas = self._consulta("DELETE", "registros", "delete from registros where id = ? returning *", [reg_id])
+        return [dict(f) for f in filas] if devolver else None
+
+    def borrar_registros(self):
+        with self._escritura():
+            self._consulta("DELETE", "registros", "delete from registros")
+
+    def marcas_empleado(self, emp_id, ini, fin, desc=False, limite=None):
+        sentido = "desc" if desc else "asc"
+        sql = ("select * from registros where empleado_id = ? and fecha_hora >= ? and fecha_hora <= ? "
+               f"order by fecha_hora {sentido}, id {sentido} limit ?")
+        return [dict(f) for f in self._consulta(
+            "GET", "registros", sql, [emp_id, _ts_sqlite(ini), _ts_sqlite(fin), limite or -1])]
+
+    def paginas_registros(self, ini=None, fin=None, emp_id=None, desc=False):
+        condiciones, args = [], []
+        if ini:
+            condiciones.append("r.fecha_hora >= ?")
+            args.append(_ts_sqlite(ini))
+        if fin:
+            condiciones.append("r.fecha_hora <= ?")
+            args.append(_ts_sqlite(fin))
+        if emp_id:
+            condiciones.append("r.empleado_id = ?")
+            args.append(emp_id)
+        for pagina in self._paginas("registros", _SQLITE_REGISTROS, condiciones, args,
+                                    ("r.fecha_hora", "r.id"), desc):
+            yield [_con_empleado(dict(f)) for f in pagina]
+
+    def checkin(self, empleado_id, token_dispositivo, token_qr, desde, hasta, antirrebote,
+                salida_programada, margen_salida, hora_corte, duplicado_max, utc_offset_min):
+        """Lo mismo que sql/checkin_decidir.sql, dentro de la transaccion de
+        escritura: nadie mas escribe entre leer las marcas de hoy y guardar
+        la nueva, asi dos escaneos simultaneos no crean dos registros."""
+        with self._escritura():
+            emp = self.empleado(int(empleado_id))
+            if not emp or not emp["activo"]:
+                return {"accion": "rechazado", "motivo": "empleado"}
+            if emp["token_dispositivo"] != token_dispositivo:
+                return {"accion": "rechazado", "motivo": "dispositivo", "nombre": emp["nombre"]}
+            regs = self.marcas_empleado(emp["id"], desde, hasta)
+            ahora = self.reloj().astimezone(timezone(timedelta(minutes=utc_offset_min)))
+            ajustes = SimpleNamespace(
+                antirrebote=antirrebote, margen_salida=margen_salida, hora_corte_entrada=hora_corte,
+                horario={str(ahora.weekday()): {"salida": salida_programada} if salida_programada else None},
+            )
+            d = decidir_checkin(regs, ahora, ajustes, duplicado_max)
+            d["nombre"] = emp["nombre"]
+            registro = None
+            if d["accion"] == "corregido":
+                registro = self.actualizar_registro(d["registro_id"], {
+                    "fecha_hora": ahora, "token_usado": "auto-correccion-duplicado"})[0]
+            elif d["accion"] == "creado":
+                registro = self.insertar_registro({
+                    "empleado_id": emp["id"], "tipo": d["tipo"], "token_usado": token_qr, "fecha_hora": ahora})
+            if registro is not None:
+                d["registro"] = registro
+                d["fecha_hora"] = registro["fecha_hora"]
+            return d
+
+    # --- jornadas_dia (ROLLUPS=1) ---
+
+    def fechas_cubiertas(self, desde, hasta):
+        return {f["fecha"] for f in self._consulta(
+            "GET", "jornadas_cobertura",
+            "select fecha from jornadas_cobertura where fecha >= ? and fecha <= ?", [desde, hasta])}
+
+    def cubrir(self, fechas):
+        self._guardar("jornadas_cobertura", [{"fecha": f} for f in fechas], ("fecha",))
+
+    def descubrir(self, fechas):
+        fechas = list(fechas)
+        with self._escritura():
+            filas = self._consulta("DELETE", "jornadas_cobertura",
+                                   f"delete from jornadas_cobertura where fecha in ({', '.join('?' * len(fechas))}) "
+                                   "returning fecha", fechas)
+        return [f["fecha"] for f in filas]
+
+    def guardar_jornadas(self, filas):
+        self._guardar("jornadas_dia", filas, ("empleado_id", "fecha"))
+
+    def borrar_jornadas(self, desde, hasta, emp_id=None):
+        sql, args = "delete from jornadas_dia where fecha >= ? and fecha <= ?", [desde, hasta]
+        if emp_id:
+            sql, args = sql + " and empleado_id = ?", args + [emp_id]
+        with self._escritura():
+            self._consulta("DELETE", "jornadas_dia", sql, args)
+
+    def paginas_jornadas(self, desde, hasta, emp_id=None):
+        condiciones, args = ["j.fecha >= ?", "j.fecha <= ?"], [desde, hasta]
+        if emp_id:
+            condiciones.append("j.empleado_id = ?")
+            args.append(emp_id)
+        for pagina in self._paginas("jornadas_dia", _SQLITE_JORNADAS, condiciones, args,
+                                    ("j.fecha", "j.empleado_id")):
+            yield [_con_empleado(self._desde_sqlite("jornadas_dia", f)) for f in pagina]
+
+    def vaciar_jornadas(self):
+        with self._escritura():
+            self._consulta("DELETE", "jornadas_cobertura", "delete from jornadas_cobertura")
+            self._consulta("DELETE", "jornadas_dia", "delete from jornadas_dia")
+
+
+# ------------------------------------------------------------
+# CONSULTAS EN PARALELO
+# Los reportes piden configuracion, empleados y registros, que no dependen
+# entre si. Una tras otra la latencia era la suma de todas; lanzadas a la vez
+# es mas o menos la de la mas lenta. Si una tarea ya corre dentro del pool y
+# vuelve a pedir trabajo en paralelo (el Excel llama a db_resumen_periodo, que
+# a su vez reparte), lo hace en su propio hilo: esperar a un pool lleno desde
+# dentro del mismo pool es un bloqueo seguro.
+# ------------------------------------------------------------
+PREFETCH_HILOS = int(os.environ.get("PREFETCH_HILOS", "8"))
+
+_hilo = threading.local()
+
+
+def _marcar_hilo_prefetch():
+    _hilo.en_prefetch = True
+
+
+_prefetch_pool = ThreadPoolExecutor(
+    max_workers=PREFETCH_HILOS, thread_name_prefix="prefetch",
+    initializer=_marcar_hilo_prefetch,
+)
+
+
+def _en_paralelo(*tareas):
+    """Ejecuta las funciones (sin argumentos) a la vez y devuelve sus
+    resultados en el mismo orden. La primera corre en el hilo que llama."""
+    if len(tareas) < 2 or getattr(_hilo, "en_prefetch", False):
+        return [t() for t in tareas]
+    # Cada tarea corre con una copia del contexto para ver el memo de la
+    # peticion en curso.
+    perfil = _perfil.get()
+    if perfil is not None:
+        tareas = [tareas[0]] + [perfil.envolver(t) for t in tareas[1:]]
+    futuros = [_prefetch_pool.submit(contextvars.copy_context().run, t) for t in tareas[1:]]
+    try:
+        primero = tareas[0]()
+    except BaseException:
+        for f in futuros:
+            f.cancel()
+        raise
+    return [primero] + [f.result() for f in futuros]
 
 
 # ============================================================
 # DATABASE FUNCTIONS
 # ============================================================
 
+# ------------------------------------------------------------
+# CONFIGURACION EN MEMORIA
+# Un check-in leia secret_key (dos veces), el anti-rebote, el horario, el
+# margen de salida y la hora de corte, cada uno con su propia consulta. Ahora
+# toda la tabla configuracion se baja de una vez (son pocas filas) a un
+# Ajustes inmutable y ya interpretado, que se reusa durante CONFIG_TTL
+# segundos. db_set_config lo descarta en el acto; en las demas instancias de
+# Vercel el cambio se ve, como mucho, al vencer el TTL.
+# ------------------------------------------------------------
+CONFIG_TTL = int(os.environ.get("CONFIG_TTL_SEGUNDOS", "60"))
+
+
+@dataclass(frozen=True)
+class Ajustes:
+    valores: Mapping[str, str]      # tabla configuracion cruda, clave -> valor
+    horario: Mapping[str, Any]      # ya normalizado, ver normalizar_horario
+    hora_corte_entrada: str
+    margen_salida: int
+    antirrebote: int
+    jornada_minima: int
+    extras_minimo: int
+    extras_redondeo: int
+    tolerancia: int
+    cargado: float                  # time.monotonic() de la carga
+
+
+_ajustes_lock = threading.Lock()
+_ajustes_actual = None
+
+
+def _config_entero(valores, clave, default):
+    """Entero >= 0 de la configuracion, o el default si falta o no es valido."""
+    try:
+        v = int(valores.get(clave))
+        return v if v >= 0 else default
+    except (TypeError, ValueError):
+        return default
+
+
+def _horario_desde(raw):
+    if not raw:
+        return normalizar_horario(HORARIO_SEMANAL_DEFAULT)
+    try:
+        return normalizar_horario(json.loads(raw))
+    except (ValueError, TypeError):
+        return normalizar_horario(HORARIO_SEMANAL_DEFAULT)
+
+
+def _cargar_ajustes():
+    valores = _almacen().config()
+    corte = valores.get("hora_corte_entrada")
+    try:
+        tolerancia = int(valores.get("tolerancia_minutos") or "15")
+    except ValueError:
+        tolerancia = 15
+    return Ajustes(
+        valores=MappingProxyType(valores),
+        horario=MappingProxyType(_horario_desde(valores.get("horario_semanal"))),
+        hora_corte_entrada=corte[:5] if _hhmm_valido(corte) else HORA_CORTE_ENTRADA_DEFAULT,
+        margen_salida=_config_entero(valores, "margen_salida_minutos", MARGEN_SALIDA_DEFAULT),
+        antirrebote=_config_entero(valores, "checkin_antirrebote_segundos", ANTIRREBOTE_DEFAULT),
+        jornada_minima=_config_entero(valores, "jornada_minima_minutos", JORNADA_MINIMA_DEFAULT),
+        extras_minimo=_config_entero(valores, "extras_minimo_minutos", EXTRAS_MINIMO_DEFAULT),
+        extras_redondeo=_config_entero(valores, "extras_redondeo_minutos", EXTRAS_REDONDEO_DEFAULT),
+        tolerancia=tolerancia,
+        cargado=time.monotonic(),
+    )
+
+
+def db_ajustes():
+    """Foto vigente de la configuracion; la recarga si vencio el TTL."""
+    global _ajustes_actual
+    a = _ajustes_actual
+    if a is not None and time.monotonic() - a.cargado < CONFIG_TTL:
+        _metricas.contar("nevox_cache_total", cache="ajustes", resultado="hit")
+        return a
+    with _ajustes_lock:
+        a = _ajustes_actual
+        vencido = a is None or time.monotonic() - a.cargado >= CONFIG_TTL
+        if vencido:
+            a = _ajustes_actual = _cargar_ajustes()
+        _metricas.contar("nevox_cache_total", cache="ajustes", resultado="miss" if vencido else "hit")
+        return a
+
+
+def db_invalidar_ajustes():
+    global _ajustes_actual
+    with _ajustes_lock:
+        _ajustes_actual = None
+
+
 def db_get_config(clave):
-    data = _sb_get("configuracion", select="valor", filters=[("clave", f"eq.{clave}")])
-    return data[0]["valor"] if data else None
+    return db_ajustes().valores.get(clave)
 
 
 def db_set_config(clave, valor):
-    _sb_upsert("configuracion", {"clave": clave, "valor": valor})
+    _almacen().guardar_config({clave: valor})
+    db_invalidar_ajustes()
+    # Horario, tolerancia y reglas cambian los reportes; la huella de la
+    # configuracion ya lo refleja en las otras instancias.
+    _datos_cambiaron(publicar=False)
 
 
 def db_verificar_password(password):
@@ -160,11 +1499,12 @@ def db_cambiar_password(nuevo):
 
 
 def db_crear_empleado(nombre, departamento="", hora_entrada="09:00", hora_salida="18:00"):
-    result = _sb_post("empleados", {
+    emp = _almacen().crear_empleado({
         "nombre": nombre, "departamento": departamento,
         "hora_entrada": hora_entrada, "hora_salida": hora_salida,
     })
-    return result[0]["id"]
+    _datos_cambiaron()
+    return emp["id"]
 
 
 def _fix_activo(row):
@@ -173,21 +1513,19 @@ def _fix_activo(row):
 
 
 def db_obtener_empleado(empleado_id):
-    data = _sb_get("empleados", filters=[("id", f"eq.{empleado_id}")])
-    return _fix_activo(data[0]) if data else None
+    emp = _almacen().empleado(empleado_id)
+    return _fix_activo(emp) if emp else None
 
 
 def db_obtener_empleado_por_token(token):
-    data = _sb_get("empleados", filters=[
-        ("token_dispositivo", f"eq.{token}"), ("activo", "eq.true"),
-    ])
-    return _fix_activo(data[0]) if data else None
+    emp = _almacen().empleado_por_token(token)
+    return _fix_activo(emp) if emp else None
 
 
 def db_listar_empleados(solo_activos=True):
-    filters = [("activo", "eq.true")] if solo_activos else []
-    data = _sb_get("empleados", filters=filters, order="nombre.asc")
-    return [_fix_activo(r) for r in data]
+    # Por paginas, como los registros: en un solo GET la lista se cortaba en
+    # el max-rows de Supabase (1000 filas).
+    return [_fix_activo(r) for pagina in _almacen().paginas_empleados(solo_activos) for r in pagina]
 
 
 def db_actualizar_empleado(emp_id, **kwargs):
@@ -198,30 +1536,34 @@ def db_actualizar_empleado(emp_id, **kwargs):
     if "activo" in kwargs and kwargs["activo"] is not None:
         campos["activo"] = bool(kwargs["activo"])
     if campos:
-        _sb_patch("empleados", campos, [("id", f"eq.{emp_id}")])
+        _almacen().actualizar_empleado(emp_id, campos)
+        _hoy.invalidar()  # las filas de hoy traen nombre y area del empleado
+        _datos_cambiaron()
 
 
 def db_vincular(emp_id, token):
-    _sb_patch("empleados", {"token_dispositivo": token}, [("id", f"eq.{emp_id}")])
+    _almacen().actualizar_empleado(emp_id, {"token_dispositivo": token})
 
 
 def db_desvincular(emp_id):
-    _sb_patch("empleados", {"token_dispositivo": None}, [("id", f"eq.{emp_id}")])
+    _almacen().actualizar_empleado(emp_id, {"token_dispositivo": None})
 
 
 def db_registrar_asistencia(emp_id, tipo, token_usado=None):
-    filas = _sb_post("registros", {"empleado_id": emp_id, "tipo": tipo, "token_usado": token_usado})
-    return filas[0] if filas else None
+    fila = _almacen().insertar_registro({"empleado_id": emp_id, "tipo": tipo, "token_usado": token_usado})
+    _hoy.guardar([fila])
+    _rollup_tocar([fila])
+    _datos_cambiaron(_fechas_de([fila]), publicar=False)
+    return fila
 
 
 def db_ultimo_registro(emp_id, fecha=None):
     fecha = fecha or today_local().isoformat()
+    if fecha == today_local().isoformat():
+        filas = _hoy.del_empleado(emp_id, HOY_TTL)
+        return filas[-1] if filas else None
     ini, fin = local_day_bounds_utc(fecha)
-    data = _sb_get("registros", filters=[
-        ("empleado_id", f"eq.{emp_id}"),
-        ("fecha_hora", f"gte.{ini}"),
-        ("fecha_hora", f"lte.{fin}"),
-    ], order="fecha_hora.desc", limit=1)
+    data = _almacen().marcas_empleado(emp_id, ini, fin, desc=True, limite=1)
     return data[0] if data else None
 
 
@@ -239,8 +1581,7 @@ HORA_CORTE_ENTRADA_DEFAULT = "10:00"
 
 
 def db_get_hora_corte_entrada():
-    v = db_get_config("hora_corte_entrada")
-    return v[:5] if _hhmm_valido(v) else HORA_CORTE_ENTRADA_DEFAULT
+    return db_ajustes().hora_corte_entrada
 
 
 # Cuanto antes de la hora de salida programada se acepta marcar la salida. Con
@@ -251,22 +1592,16 @@ MARGEN_SALIDA_DEFAULT = 60  # minutos
 
 
 def db_get_margen_salida():
-    try:
-        v = int(db_get_config("margen_salida_minutos"))
-        return v if v >= 0 else MARGEN_SALIDA_DEFAULT
-    except (TypeError, ValueError):
-        return MARGEN_SALIDA_DEFAULT
+    return db_ajustes().margen_salida
 
 
 def db_registros_hoy_empleado(emp_id, fecha=None):
-    """Marcas del empleado en el dia local indicado, en orden ascendente."""
+    """Marcas del empleado en el dia local indicado, en orden ascendente.
+    Siempre de la base, no de _hoy: el check-in decide con esto, y una marca
+    de otra instancia que el cache aun no vio lo haria decidir mal."""
     fecha = fecha or today_local().isoformat()
     ini, fin = local_day_bounds_utc(fecha)
-    return _sb_get("registros", filters=[
-        ("empleado_id", f"eq.{emp_id}"),
-        ("fecha_hora", f"gte.{ini}"),
-        ("fecha_hora", f"lte.{fin}"),
-    ], order="fecha_hora.asc")
+    return _almacen().marcas_empleado(emp_id, ini, fin)
 
 
 def tipo_por_hora(momento, corte=None):
@@ -301,15 +1636,63 @@ ANTIRREBOTE_DEFAULT = 90  # segundos
 
 
 def db_get_antirrebote():
-    try:
-        v = int(db_get_config("checkin_antirrebote_segundos"))
-        return v if v >= 0 else ANTIRREBOTE_DEFAULT
-    except (TypeError, ValueError):
-        return ANTIRREBOTE_DEFAULT
+    return db_ajustes().antirrebote
 
 
 
 
+# ------------------------------------------------------------
+# MARCAS YA INTERPRETADAS
+# _flatten_registros pasa fecha_hora a hora local y la vuelve a escribir como
+# texto; despues _jornadas_por_dia, db_retardos, el listado del admin y el
+# Excel la volvian a leer con fromisoformat, a veces dos veces por fila. En un
+# rango de un ano eso es un millon de parseos y un dict por marca. Dentro del
+# pipeline de reportes cada fila es ahora una Marca con el datetime local ya
+# calculado; se pasa a dict solo al responder (a_dict).
+# ------------------------------------------------------------
+class Marca:
+    __slots__ = ("id", "empleado_id", "tipo", "momento", "nombre", "departamento", "token_usado")
+
+    def __init__(self, id, empleado_id, tipo, momento, nombre="", departamento="", token_usado=None):
+        self.id = id
+        self.empleado_id = empleado_id
+        self.tipo = tipo
+        self.momento = momento              # datetime en hora local (LOCAL_TZ)
+        self.nombre = nombre
+        self.departamento = departamento
+        self.token_usado = token_usado
+
+    @classmethod
+    def desde_fila(cls, r):
+        """Fila cruda de registros (fecha_hora en UTC, con el embed de empleados)."""
+        emp = r.get("empleados") or {}
+        return cls(
+            r.get("id"), r.get("empleado_id"), r.get("tipo"), to_local(r["fecha_hora"]),
+            emp.get("nombre", ""), emp.get("departamento", ""), r.get("token_usado"),
+        )
+
+    def get(self, campo, default=None):
+        # Para los helpers que reciben dicts y marcas por igual (agrupar).
+        return getattr(self, campo, default)
+
+    def a_dict(self):
+        """La misma forma que deja _flatten_registros."""
+        return {
+            "id": self.id, "empleado_id": self.empleado_id, "tipo": self.tipo,
+            "fecha_hora": self.momento.isoformat(),
+            "token_usado": self.token_usado,
+            "nombre": self.nombre, "departamento": self.departamento,
+            "hora": self.momento.strftime("%H:%M:%S"),
+            "fecha": self.momento.strftime("%d/%m/%Y"),
+        }
+
+
+@_fase("flatten")
+def _marcas(data):
+    return [Marca.desde_fila(r) for r in data if r.get("fecha_hora")]
+
+
+@_fase("flatten")
 def _flatten_registros(data):
     registros = []
     for r in data:
@@ -327,24 +1710,252 @@ def _flatten_registros(data):
 
 def db_registros_dia(fecha=None):
     fecha = fecha or today_local().isoformat()
+    if fecha == today_local().isoformat():
+        return _flatten_registros(_hoy.filas(HOY_TTL)[::-1])
     ini, fin = local_day_bounds_utc(fecha)
-    data = _sb_get("registros", select="*,empleados(nombre,departamento)", filters=[
-        ("fecha_hora", f"gte.{ini}"),
-        ("fecha_hora", f"lte.{fin}"),
-    ], order="fecha_hora.desc")
-    return _flatten_registros(data)
+    registros = []
+    for pagina in _almacen().paginas_registros(ini, fin, desc=True):
+        registros.extend(_flatten_registros(pagina))
+    return registros
+
+
+def db_iter_registros_rango(desde, hasta, emp_id=None):
+    """Marcas del rango en orden ascendente, pagina por pagina. Los reportes
+    las consumen sobre la marcha, asi un ano de marcas no queda entero en
+    memoria."""
+    ini, fin = local_day_bounds_utc(desde, hasta)
+    for pagina in _almacen().paginas_registros(ini, fin, emp_id):
+        yield from _marcas(pagina)
+
+
+def db_iter_registros_por_area(desde, hasta, emp_id=None, departamento=None):
+    """Marcas del rango en el orden de la hoja de registros del Excel: area
+    (SIN_AREA si no tiene), nombre y hora. Se piden empleado por empleado, asi
+    llegan ya ordenadas y el rango no se junta entero para ordenarlo; los
+    homonimos de una misma area se intercalan por hora, como antes."""
+    grupos = {}
+    for e in db_listar_empleados(solo_activos=False):
+        clave = (e.get("departamento") or SIN_AREA, e.get("nombre") or "")
+        if (emp_id and e["id"] != emp_id) or (departamento and clave[0] != departamento):
+            continue
+        grupos.setdefault(clave, []).append(e["id"])
+    for clave in sorted(grupos):
+        yield from heapq.merge(*(db_iter_registros_rango(desde, hasta, i) for i in grupos[clave]),
+                               key=lambda m: (m.momento, m.id))
 
 
 def db_registros_rango(desde, hasta, emp_id=None):
+    """Las marcas del rango en una lista. Dentro de una peticion el rango
+    entero se guarda en el memo (no cada pagina), asi pedirlo otra vez no
+    vuelve a recorrer el almacen."""
+    memo = _memo_peticion.get()
+    if memo is None:
+        return list(db_iter_registros_rango(desde, hasta, emp_id))
     ini, fin = local_day_bounds_utc(desde, hasta)
-    filters = [
-        ("fecha_hora", f"gte.{ini}"),
-        ("fecha_hora", f"lte.{fin}"),
-    ]
-    if emp_id:
-        filters.append(("empleado_id", f"eq.{emp_id}"))
-    data = _sb_get("registros", select="*,empleados(nombre,departamento)", filters=filters, order="fecha_hora.asc")
-    return _flatten_registros(data)
+    filas = memo.obtener(
+        ("registros", "rango", ini, fin, emp_id),
+        lambda: [f for pagina in _almacen().paginas_registros(ini, fin, emp_id) for f in pagina],
+    )
+    return _marcas(filas)
+
+
+# ------------------------------------------------------------
+# REGISTROS DE HOY EN MEMORIA
+# Cada pantalla del dashboard volvia a bajar el dia completo cada 10 s
+# (registros) y cada 30 s (pendientes). Ahora cada instancia guarda las filas
+# del dia local en curso, indexadas por empleado. Lo que escribe esta
+# instancia (check-in, reubicacion de duplicados, correcciones del admin) se
+# aplica en el acto. Para ver lo que escriben las otras instancias de Vercel:
+#   - pasados HOY_TTL segundos se piden las filas con fecha_hora desde la
+#     conciliacion anterior menos HOY_MARGEN: ahi caen las marcas nuevas
+#     (fecha_hora = hora de la base al insertar, aunque un id menor se guarde
+#     despues) y las salidas reubicadas, que se mueven a la hora real;
+#   - junto con eso se lee datos_version; si otra instancia publico una
+#     correccion del admin (que puede tocar cualquier hora del dia, o borrar)
+#     se baja el dia entero;
+#   - cada HOY_RECARGA segundos, y al cambiar el dia local, tambien.
+# Las consultas corren fuera de _lock (solo una a la vez, en _trayendo) y el
+# resultado se aplica de una vez; lo que guardar/quitar escribio mientras
+# tanto se vuelve a aplicar encima. El check-in no lee de aqui: decide con
+# las marcas del empleado leidas de la base (db_registros_hoy_empleado).
+# ------------------------------------------------------------
+HOY_TTL = float(os.environ.get("HOY_TTL_SEGUNDOS", "10"))
+HOY_RECARGA = float(os.environ.get("HOY_RECARGA_SEGUNDOS", "60"))
+HOY_MARGEN = 15  # segundos: relojes de la instancia y de la base, commits lentos
+
+SELECT_REGISTROS = "*,empleados(nombre,departamento)"
+
+
+def db_datos_version():
+    """datos_version tal como esta en la base, sin pasar por db_ajustes."""
+    return _almacen().config_valor("datos_version")
+
+
+class _RegistrosHoy:
+    def __init__(self):
+        self._lock = threading.RLock()
+        # version sube con cada cambio; el stream del dashboard espera sobre
+        # _cambio en vez de consultar a Supabase por pantalla.
+        self._cambio = threading.Condition(self._lock)
+        self._trayendo = threading.Lock()
+        self.version = 0
+        self._generacion = 0  # sube con invalidar: lo que se estaba trayendo ya no vale
+        self._vaciar()
+
+    def _tocar(self):
+        self.version += 1
+        self._cambio.notify_all()
+
+    def esperar(self, version, timeout):
+        """Espera a que version deje de ser la indicada, o timeout segundos."""
+        with self._lock:
+            self._cambio.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def _vaciar(self):
+        self.fecha = None
+        self._filas = {}       # id -> fila cruda (fecha_hora en UTC)
+        self._claves = {}      # id -> (datetime, id), para ordenar
+        self._por_empleado = {}
+        self._datos_version = None
+        self._desde = None     # inicio (UTC) de la ultima consulta a la base
+        self._recargado = self._conciliado = float("-inf")
+        self._escritas = None  # id -> fila o None, escrito durante una consulta
+
+    def invalidar(self):
+        with self._lock:
+            self._generacion += 1
+            self._vaciar()
+            self._tocar()
+
+    def publicada(self, previa, valor):
+        """Esta instancia cambio datos_version de previa a valor (y ya aplico
+        su correccion). Si previa no es la que se vio, otra instancia publico
+        algo antes: la proxima lectura baja el dia entero."""
+        with self._lock:
+            if previa != self._datos_version:
+                self._recargado = float("-inf")
+            self._datos_version = valor
+
+    def _poner(self, fila):
+        rid = fila["id"]
+        self._quitar(rid)
+        self._filas[rid] = fila
+        self._claves[rid] = (datetime.fromisoformat(fila["fecha_hora"]), rid)
+        self._por_empleado.setdefault(fila["empleado_id"], set()).add(rid)
+
+    def _quitar(self, rid):
+        fila = self._filas.pop(rid, None)
+        if fila is not None:
+            self._claves.pop(rid, None)
+            self._por_empleado.get(fila["empleado_id"], set()).discard(rid)
+
+    def _anotar(self, rid, fila):
+        if self._escritas is not None:
+            self._escritas[rid] = fila
+
+    @staticmethod
+    def _traer(fecha, desde=None):
+        """Filas del dia; con desde (UTC), solo las de ahi en adelante."""
+        ini, fin = local_day_bounds_utc(fecha)
+        filas = []
+        for pagina in _almacen().paginas_registros(max(ini, desde or ini), fin):
+            filas.extend(pagina)
+        return filas
+
+    def _pendiente(self, max_edad, ahora):
+        """"recarga", "delta" o None (al dia)."""
+        if self.fecha != today_local().isoformat() or ahora - self._recargado >= HOY_RECARGA:
+            return "recarga"
+        if ahora - self._conciliado >= max_edad:
+            return "delta"
+        return None
+
+    def _vigente(self, max_edad):
+        if self._pendiente(max_edad, time.monotonic()) is None:
+            _metricas.contar("nevox_cache_total", cache="hoy", resultado="hit")
+            return
+        with self._trayendo:
+            ahora = time.monotonic()
+            with self._lock:
+                paso = self._pendiente(max_edad, ahora)
+                if paso is None:  # lo trajo otro hilo mientras se esperaba
+                    _metricas.contar("nevox_cache_total", cache="hoy", resultado="hit")
+                    return
+                generacion = self._generacion
+                fecha, desde, visto = self.fecha, self._desde, self._datos_version
+                self._escritas = {}
+            inicio = now_local().astimezone(timezone.utc)
+            if paso == "recarga":
+                fecha = today_local().isoformat()
+                filas, version = _en_paralelo(lambda: self._traer(fecha), db_datos_version)
+            else:
+                margen = (desde - timedelta(seconds=HOY_MARGEN)).strftime("%Y-%m-%dT%H:%M:%S")
+                filas, version = _en_paralelo(
+                    lambda: self._traer(fecha, margen), db_datos_version)
+                if version != visto:
+                    paso, filas = "recarga", self._traer(fecha)
+            with self._lock:
+                escritas, self._escritas = self._escritas, None
+                if generacion != self._generacion:
+                    return  # invalidado mientras se traia: lo baja la proxima lectura
+                if paso == "recarga":
+                    self._filas, self._claves, self._por_empleado = {}, {}, {}
+                    self.fecha, self._datos_version, self._recargado = fecha, version, ahora
+                for f in filas:
+                    self._poner(f)
+                for rid, fila in escritas.items():
+                    if fila is None:
+                        self._quitar(rid)
+                    else:
+                        self._poner(fila)
+                self._desde, self._conciliado = inicio, ahora
+                if paso == "recarga" or filas:
+                    self._tocar()
+            _metricas.contar("nevox_cache_total", cache="hoy",
+                             resultado="miss" if paso == "recarga" else "delta")
+
+    def _ordenadas(self, ids):
+        return [dict(self._filas[i]) for i in sorted(ids, key=self._claves.__getitem__)]
+
+    def filas(self, max_edad):
+        """Todas las filas crudas del dia, en orden ascendente (copias)."""
+        self._vigente(max_edad)
+        with self._lock:
+            return self._ordenadas(self._filas)
+
+    def del_empleado(self, emp_id, max_edad):
+        """Filas del empleado como las devuelve select=* (sin el join)."""
+        self._vigente(max_edad)
+        with self._lock:
+            filas = self._ordenadas(self._por_empleado.get(emp_id, ()))
+        for f in filas:
+            f.pop("empleados", None)
+        return filas
+
+    def guardar(self, filas):
+        """Aplica filas recien escritas: entran si son de hoy, salen si no."""
+        with self._lock:
+            fecha = self.fecha or today_local().isoformat()
+            for f in filas or []:
+                hoy = bool(f.get("fecha_hora")) and to_local(f["fecha_hora"]).date().isoformat() == fecha
+                self._anotar(f["id"], f if hoy else None)
+                if self.fecha is None:
+                    continue  # todavia no se cargo: la primera lectura las trae
+                if hoy:
+                    self._poner(f)
+                else:
+                    self._quitar(f["id"])
+            self._tocar()
+
+    def quitar(self, rid):
+        with self._lock:
+            self._anotar(rid, None)
+            self._quitar(rid)
+            self._tocar()
+
+
+_hoy = _RegistrosHoy()
 
 
 # ------------------------------------------------------------
@@ -418,13 +2029,8 @@ def normalizar_horario(raw):
 
 
 def db_get_horario_semanal():
-    raw = db_get_config("horario_semanal")
-    if not raw:
-        return normalizar_horario(HORARIO_SEMANAL_DEFAULT)
-    try:
-        return normalizar_horario(json.loads(raw))
-    except (ValueError, TypeError):
-        return normalizar_horario(HORARIO_SEMANAL_DEFAULT)
+    # Copia: quien la reciba puede modificarla sin tocar la foto compartida.
+    return {k: dict(v) if v else None for k, v in db_ajustes().horario.items()}
 
 
 def db_set_horario_semanal(horario):
@@ -432,51 +2038,40 @@ def db_set_horario_semanal(horario):
 
 
 def db_get_reglas_extras():
-    def _int(clave, default):
-        try:
-            v = int(db_get_config(clave))
-            return v if v >= 0 else default
-        except (TypeError, ValueError):
-            return default
-    return {
-        "minimo": _int("extras_minimo_minutos", EXTRAS_MINIMO_DEFAULT),
-        "redondeo": _int("extras_redondeo_minutos", EXTRAS_REDONDEO_DEFAULT),
-    }
+    a = db_ajustes()
+    return {"minimo": a.extras_minimo, "redondeo": a.extras_redondeo}
 
 
 def db_get_jornada_minima():
-    try:
-        v = int(db_get_config("jornada_minima_minutos"))
-        return v if v >= 0 else JORNADA_MINIMA_DEFAULT
-    except (TypeError, ValueError):
-        return JORNADA_MINIMA_DEFAULT
+    return db_ajustes().jornada_minima
 
 
+@_fase("jornadas")
 def _jornadas_por_dia(registros, jornada_minima=None):
-    """Agrupa los registros (ya en hora local, orden ascendente) en pares
-    entrada/salida por empleado y dia."""
-    if jornada_minima is None:
-        jornada_minima = db_get_jornada_minima()
+    """Agrupa las marcas (orden ascendente) en pares entrada/salida por
+    empleado y dia."""
     dias = {}
-    for r in registros:
-        dt = datetime.fromisoformat(r["fecha_hora"])
-        key = (r["empleado_id"], dt.strftime("%Y-%m-%d"))
-        d = dias.setdefault(key, {
-            "nombre": r.get("nombre", ""),
-            "departamento": r.get("departamento", ""),
-            "pares": [], "pendiente": None, "marcas": 0,
-            "primera_entrada": None, "ultima_salida": None,
-            "entradas_sin_salida": 0, "salidas_sin_entrada": 0,
-        })
+    for m in registros:
+        dt = m.momento
+        key = (m.empleado_id, dt.date())
+        d = dias.get(key)
+        if d is None:
+            d = dias[key] = {
+                "nombre": m.nombre,
+                "departamento": m.departamento,
+                "pares": [], "pendiente": None, "marcas": 0,
+                "primera_entrada": None, "ultima_salida": None,
+                "entradas_sin_salida": 0, "salidas_sin_entrada": 0,
+            }
         d["marcas"] += 1
-        if r["tipo"] == "entrada":
+        if m.tipo == "entrada":
             if d["pendiente"] is not None:
                 # Dos entradas seguidas: a la anterior le falto su salida.
                 d["entradas_sin_salida"] += 1
             d["pendiente"] = dt
             if d["primera_entrada"] is None:
                 d["primera_entrada"] = dt
-        elif r["tipo"] == "salida":
+        elif m.tipo == "salida":
             if d["pendiente"] is not None:
                 d["pares"].append((d["pendiente"], dt))
                 d["pendiente"] = None
@@ -485,33 +2080,43 @@ def _jornadas_por_dia(registros, jornada_minima=None):
                 d["salidas_sin_entrada"] += 1
             d["ultima_salida"] = dt
 
+    # Se lee recien aqui: asi la configuracion puede estar cargandose en otro
+    # hilo mientras llegan los registros.
+    if jornada_minima is None:
+        jornada_minima = db_get_jornada_minima()
     for d in dias.values():
         # La entrada que quedo sin cerrar; sirve para avisar en el dashboard.
         d["abierta_desde"] = d.pop("pendiente")
         if d["abierta_desde"] is not None:
             d["entradas_sin_salida"] += 1
-        d["incompleto"] = bool(d["entradas_sin_salida"] or d["salidas_sin_entrada"])
-        # En NEVOX no se marca el almuerzo: se esperan exactamente 2 marcas al
-        # dia. Mas de dos es una anomalia que hay que revisar aunque el dia
-        # cierre bien (tipico de los escaneos duplicados que ya no ocurren).
-        d["exceso_marcas"] = max(0, d["marcas"] - MARCAS_ESPERADAS)
         d["trabajado_min"] = sum((f - i).total_seconds() for i, f in d["pares"]) / 60
-        # Dia que empareja bien pero dura casi nada: pasaba como limpio y en
-        # realidad es un doble escaneo que se comio la jornada entera.
-        d["jornada_corta"] = bool(d["pares"]) and d["trabajado_min"] < jornada_minima
-
-        faltantes = []
-        if d["entradas_sin_salida"]:
-            faltantes.append("Falta salida")
-        if d["salidas_sin_entrada"]:
-            faltantes.append("Falta entrada")
-        if d["exceso_marcas"]:
-            faltantes.append(f"{d['marcas']} marcas (se esperan {MARCAS_ESPERADAS})")
-        if d["jornada_corta"]:
-            faltantes.append(f"Jornada de {int(round(d['trabajado_min']))} min (revisar)")
-        d["motivo"] = " y ".join(faltantes)
-        d["revisar"] = bool(d["incompleto"] or d["exceso_marcas"] or d["jornada_corta"])
-    return dias
+        _cerrar_dia(d, bool(d["pares"]), jornada_minima)
+    # La fecha se pasa a texto una vez por dia, no una vez por marca.
+    return {(eid, f.isoformat()): d for (eid, f), d in dias.items()}
+
+
+def _cerrar_dia(d, con_pares, jornada_minima):
+    """Banderas y motivo de un dia ya emparejado (comun a los dos motores)."""
+    d["incompleto"] = bool(d["entradas_sin_salida"] or d["salidas_sin_entrada"])
+    # En NEVOX no se marca el almuerzo: se esperan exactamente 2 marcas al
+    # dia. Mas de dos es una anomalia que hay que revisar aunque el dia
+    # cierre bien (tipico de los escaneos duplicados que ya no ocurren).
+    d["exceso_marcas"] = max(0, d["marcas"] - MARCAS_ESPERADAS)
+    # Dia que empareja bien pero dura casi nada: pasaba como limpio y en
+    # realidad es un doble escaneo que se comio la jornada entera.
+    d["jornada_corta"] = con_pares and d["trabajado_min"] < jornada_minima
+
+    faltantes = []
+    if d["entradas_sin_salida"]:
+        faltantes.append("Falta salida")
+    if d["salidas_sin_entrada"]:
+        faltantes.append("Falta entrada")
+    if d["exceso_marcas"]:
+        faltantes.append(f"{d['marcas']} marcas (se esperan {MARCAS_ESPERADAS})")
+    if d["jornada_corta"]:
+        faltantes.append(f"Jornada de {int(round(d['trabajado_min']))} min (revisar)")
+    d["motivo"] = " y ".join(faltantes)
+    d["revisar"] = bool(d["incompleto"] or d["exceso_marcas"] or d["jornada_corta"])
 
 
 def _minutos_extra(pares, salida_prog):
@@ -535,6 +2140,200 @@ def _aplicar_reglas_extras(minutos, reglas):
     return int(minutos)
 
 
+def _salida_programada(turno, fecha_d):
+    """La salida del turno ese dia como datetime local; None si no es laboral."""
+    if not turno:
+        return None
+    h, m = map(int, turno["salida"].split(":"))
+    return datetime.combine(fecha_d, datetime.min.time().replace(hour=h, minute=m), tzinfo=LOCAL_TZ)
+
+
+def _jornadas(marcas, con_extras=False):
+    """_jornadas_por_dia, con el motor columnar si hay numpy. Con con_extras
+    cada dia trae ademas extra_bruto_min: los minutos trabajados despues de la
+    salida programada, antes de aplicar las reglas de extras."""
+    np = _numpy()
+    if np is not None:
+        return _jornadas_columnar(np, marcas, con_extras)
+    dias = _jornadas_por_dia(marcas)
+    if con_extras:
+        horario = db_get_horario_semanal()
+        for (_eid, fecha), d in dias.items():
+            fecha_d = date.fromisoformat(fecha)
+            d["extra_bruto_min"] = _minutos_extra(
+                d["pares"], _salida_programada(horario[str(fecha_d.weekday())], fecha_d))
+    return dias
+
+
+# ------------------------------------------------------------
+# MOTOR COLUMNAR
+# Un ano de marcas de unos cientos de empleados son cientos de miles de
+# vueltas de _jornadas_por_dia, dict por dict, y en Vercel eso es CPU pura.
+# Si numpy esta instalado las marcas se pasan a columnas (empleado,
+# microsegundos de reloj local, tipo), se ordenan una vez por empleado y dia,
+# y los pares, las horas, las extras, las banderas y la primera entrada salen
+# de operaciones por bloque. Da lo mismo que el camino en Python (que sigue
+# siendo la referencia y el que corre sin numpy): todo va en microsegundos
+# enteros y las sumas por dia se hacen con bincount, que acumula en el mismo
+# orden que el bucle. MOTOR_NUMPY=0 lo apaga.
+# ------------------------------------------------------------
+MOTOR_NUMPY = os.environ.get("MOTOR_NUMPY", "1") != "0"
+
+_DIA_US = 86_400_000_000
+_MIN_US = 60_000_000
+_ORIGEN_LOCAL = datetime(1, 1, 1, tzinfo=LOCAL_TZ)
+_TIPO_CODIGO = {"entrada": 1, "salida": 2}
+_np = None
+
+
+def _numpy():
+    """El modulo numpy, o None si no esta instalado o MOTOR_NUMPY lo apaga."""
+    global _np
+    if not MOTOR_NUMPY:
+        return None
+    if _np is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _np = numpy
+    return _np or None
+
+
+def _columnas(np, marcas):
+    """(empleado, t, tipo, nombre, nombres): t en microsegundos de reloj local
+    desde el 0001-01-01, asi restar dos t da lo mismo que restar los datetime;
+    tipo 1 entrada, 2 salida, 0 cualquier otro; nombre es la posicion del
+    (nombre, departamento) de la marca en la lista nombres."""
+    emp, t, tipo, nombre, nombres, vistos = array("q"), array("q"), array("b"), array("q"), [], {}
+    codigo = _TIPO_CODIGO.get
+    for m in marcas:
+        dt = m.momento
+        emp.append(m.empleado_id)
+        t.append(((dt.toordinal() - 1) * 86400 + dt.hour * 3600 + dt.minute * 60 + dt.second)
+                 * 1_000_000 + dt.microsecond)
+        tipo.append(codigo(m.tipo, 0))
+        clave = (m.nombre, m.departamento)
+        i = vistos.get(clave)
+        if i is None:
+            i = vistos[clave] = len(nombres)
+            nombres.append(clave)
+        nombre.append(i)
+    return (np.frombuffer(emp, dtype=np.int64), np.frombuffer(t, dtype=np.int64),
+            np.frombuffer(tipo, dtype=np.int8), np.frombuffer(nombre, dtype=np.int64), nombres)
+
+
+def _local_desde_us(us):
+    return _ORIGEN_LOCAL + timedelta(microseconds=us)
+
+
+def _hhmm_desde_us(us):
+    minutos = (us % _DIA_US) // _MIN_US
+    return f"{minutos // 60:02d}:{minutos % 60:02d}"
+
+
+def _fecha_desde_dia(dia, _cache={}):
+    f = _cache.get(dia)
+    if f is None:
+        f = _cache[dia] = date.fromordinal(dia + 1).isoformat()
+    return f
+
+
+@_fase("jornadas")
+def _jornadas_columnar(np, marcas, con_extras=False):
+    """Igual que _jornadas(marcas, con_extras) pero por bloques. Los dias no
+    traen "pares": lo unico que los usaba (las extras) ya viene calculado."""
+    emp, t, tipo, nombre, nombres = _columnas(np, marcas)
+    jornada_minima = db_get_jornada_minima()
+    horario = db_get_horario_semanal() if con_extras else None
+    if not len(t):
+        return {}
+
+    # Orden estable por (empleado, dia): dentro del dia queda el orden en que
+    # llegaron, que es el que recorre _jornadas_por_dia.
+    dia = t // _DIA_US
+    orden = np.lexsort((dia, emp))
+    emp, dia, t, tipo, nombre = emp[orden], dia[orden], t[orden], tipo[orden], nombre[orden]
+    nuevo = np.empty(len(t), dtype=bool)
+    nuevo[0] = True
+    nuevo[1:] = (emp[1:] != emp[:-1]) | (dia[1:] != dia[:-1])
+    inicio = np.flatnonzero(nuevo)
+    n = len(inicio)
+    grupo = np.cumsum(nuevo) - 1
+    marcas_n = np.bincount(grupo, minlength=n)
+
+    # Solo entradas y salidas mueven el estado. Hay una entrada pendiente
+    # justo cuando la marca anterior del mismo dia fue una entrada.
+    r = np.flatnonzero(tipo)
+    g, rt, rtipo = grupo[r], t[r], tipo[r]
+    es_e, es_s = rtipo == 1, rtipo == 2
+    previa_e = np.zeros(len(r), dtype=bool)
+    previa_e[1:] = (g[1:] == g[:-1]) & es_e[:-1]
+    ultima = np.ones(len(r), dtype=bool)
+    ultima[:-1] = g[1:] != g[:-1]
+    abierta = ultima & es_e
+    ent_sin = np.bincount(g[es_e & previa_e], minlength=n) + np.bincount(g[abierta], minlength=n)
+    sal_sin = np.bincount(g[es_s & ~previa_e], minlength=n)
+
+    fin = np.flatnonzero(es_s & previa_e)
+    g_par, ini_par, fin_par = g[fin], rt[fin - 1], rt[fin]
+    n_pares = np.bincount(g_par, minlength=n)
+    trabajado = np.bincount(g_par, weights=(fin_par - ini_par) / 1e6, minlength=n) / 60
+
+    def por_grupo(mascara, primera):
+        """t de la primera (o ultima) marca de cada grupo que cumple la mascara; -1 si no hay."""
+        i = np.flatnonzero(mascara)
+        gi = g[i]
+        sel = np.ones(len(i), dtype=bool)
+        if primera:
+            sel[1:] = gi[1:] != gi[:-1]
+        else:
+            sel[:-1] = gi[1:] != gi[:-1]
+        out = np.full(n, -1, dtype=np.int64)
+        out[gi[sel]] = rt[i[sel]]
+        return out
+
+    primera_e = por_grupo(es_e, True)
+    ultima_s = por_grupo(es_s, False)
+    abierta_t = np.full(n, -1, dtype=np.int64)
+    abierta_t[g[abierta]] = rt[abierta]
+
+    dia_g = dia[inicio]
+    extra = None
+    if horario is not None:
+        # dia cuenta desde el 0001-01-01, que fue lunes: dia % 7 es weekday().
+        salida_sem = np.array([
+            _minutos_del_dia(horario[str(wd)]["salida"]) if horario[str(wd)] else -1
+            for wd in range(7)
+        ], dtype=np.int64)
+        prog = salida_sem[dia_g % 7]
+        prog_par, laboral = prog[g_par], prog[g_par] >= 0
+        desde = np.where(laboral, np.maximum(ini_par, dia_g[g_par] * _DIA_US + prog_par * _MIN_US), ini_par)
+        seg = (fin_par - desde) / 1e6
+        extra = (np.bincount(g_par, weights=np.where(seg > 0, seg, 0.0), minlength=n) / 60).tolist()
+
+    # Mismo orden de claves que _jornadas_por_dia: el de la primera marca.
+    emp_g, dia_g, nombre_g = emp[inicio].tolist(), dia_g.tolist(), nombre[inicio].tolist()
+    marcas_n, ent_sin, sal_sin = marcas_n.tolist(), ent_sin.tolist(), sal_sin.tolist()
+    n_pares, trabajado = n_pares.tolist(), trabajado.tolist()
+    primera_e, ultima_s, abierta_t = primera_e.tolist(), ultima_s.tolist(), abierta_t.tolist()
+    dias = {}
+    for i in np.argsort(orden[inicio], kind="stable").tolist():
+        d = {
+            "nombre": nombres[nombre_g[i]][0], "departamento": nombres[nombre_g[i]][1], "marcas": marcas_n[i],
+            "primera_entrada": _local_desde_us(primera_e[i]) if primera_e[i] >= 0 else None,
+            "ultima_salida": _local_desde_us(ultima_s[i]) if ultima_s[i] >= 0 else None,
+            "abierta_desde": _local_desde_us(abierta_t[i]) if abierta_t[i] >= 0 else None,
+            "entradas_sin_salida": ent_sin[i], "salidas_sin_entrada": sal_sin[i],
+            "trabajado_min": trabajado[i],
+        }
+        _cerrar_dia(d, n_pares[i] > 0, jornada_minima)
+        if extra is not None:
+            d["extra_bruto_min"] = extra[i]
+        dias[(emp_g[i], _fecha_desde_dia(dia_g[i]))] = d
+    return dias
+
+
 def _resumen_vacio(emp_id, nombre, departamento):
     return {
         "empleado_id": emp_id, "nombre": nombre, "departamento": departamento,
@@ -543,86 +2342,544 @@ def _resumen_vacio(emp_id, nombre, departamento):
     }
 
 
-def db_resumen_periodo(desde, hasta, emp_id=None, departamento=None):
-    """Detalle diario (horas trabajadas y extras) y resumen por empleado
-    para el rango indicado. Una sola consulta a Supabase para todo."""
-    horario = db_get_horario_semanal()
-    reglas = db_get_reglas_extras()
-    dias = _jornadas_por_dia(db_registros_rango(desde, hasta, emp_id))
-    if departamento:
-        dias = {k: v for k, v in dias.items() if (v["departamento"] or SIN_AREA) == departamento}
-
-    detalle = []
-    for (eid, fecha), d in sorted(dias.items(), key=lambda kv: ((kv[1]["departamento"] or SIN_AREA), kv[1]["nombre"], kv[0][1])):
-        fecha_d = date.fromisoformat(fecha)
-        wd = fecha_d.weekday()
-        turno = horario[str(wd)]
-        salida_prog = None
-        if turno:
-            h, m = map(int, turno["salida"].split(":"))
-            salida_prog = datetime.combine(
-                fecha_d, datetime.min.time().replace(hour=h, minute=m), tzinfo=LOCAL_TZ
+# ------------------------------------------------------------
+# JORNADAS YA CALCULADAS (ROLLUPS=1)
+# Cada reporte volvia a emparejar todas las marcas del rango, aunque un dia ya
+# cerrado no cambia salvo que el admin lo corrija. Con ROLLUPS=1 (antes hay
+# que instalar sql/jornadas_dia.sql) cada dia pasado queda guardado en
+# jornadas_dia, una fila por empleado y fecha, y jornadas_cobertura anota que
+# fechas estan completas. Un reporte lee esas filas para las fechas cubiertas,
+# calcula y guarda de una vez las fechas pasadas que falten y solo empareja en
+# vivo lo de hoy: un mes cuesta empleados x dias filas, no todas las marcas.
+# Lo que depende de la configuracion no se guarda: las extras (horario) y la
+# jornada corta (jornada minima) salen de los pares al leer, asi que cambiar
+# el horario no deja filas viejas.
+#
+# Cada escritura de registros sobre un dia pasado (las correcciones del
+# admin) recalcula la fila de ese empleado y dia. Antes se quita la fecha de
+# jornadas_cobertura y se vuelve a poner al final: si algo falla a mitad, la
+# proxima lectura recalcula la fecha entera en vez de usar una fila vieja.
+#
+# Una correccion que cae mientras un reporte llena esa fecha no la encuentra
+# cubierta y no recalcula nada; si el llenado la marcara cubierta despues,
+# quedaria para siempre con las marcas de antes. Por eso cada escritura anota
+# su fecha (_rollup_escrito) antes de quitar la cobertura, y el llenado, como
+# _CacheReportes, solo deja cubiertas las fechas que nadie escribio desde que
+# empezo a leer: mira antes de marcar y otra vez despues, y si la escritura
+# llego en el medio quita la marca que acaba de poner. Esto vale dentro de la
+# instancia; una correccion hecha en otra instancia a mitad de un llenado
+# puede quedar sin ver hasta la siguiente escritura de ese dia.
+# ------------------------------------------------------------
+ROLLUPS = os.environ.get("ROLLUPS", "0") == "1"
+SELECT_JORNADAS = ("empleado_id,fecha,marcas,entradas_sin_salida,salidas_sin_entrada,trabajado_min,"
+                   "pares,primera_entrada,ultima_salida,abierta_desde,primera_marca,primera_marca_id,"
+                   "empleados(nombre,departamento)")
+ROLLUP_LOTE = 1000  # filas por POST al guardar una fecha
+
+_rollup_lock = threading.Lock()
+_rollup_version = 0  # sube con cada escritura
+_rollup_todo = 0     # version del ultimo vaciado
+_rollup_dias = {}    # fecha -> version de la ultima escritura de ese dia
+
+
+def _rollup_escrito(fechas=None):
+    """Anota una escritura sobre esas fechas (None: todas)."""
+    global _rollup_version, _rollup_todo
+    with _rollup_lock:
+        _rollup_version += 1
+        if fechas is None:
+            _rollup_todo = _rollup_version
+            _rollup_dias.clear()
+        else:
+            for f in fechas:
+                _rollup_dias[f] = _rollup_version
+        return _rollup_version
+
+
+def _rollup_sin_escribir(fechas, version):
+    """Las fechas que nadie escribio despues de version."""
+    with _rollup_lock:
+        if _rollup_todo > version:
+            return []
+        return [f for f in fechas if _rollup_dias.get(f, 0) <= version]
+
+
+def _hora_local(dt):
+    # Las horas se guardan como time local del dia: "07:02:11.204851".
+    return dt.time().isoformat() if dt is not None else None
+
+
+def _rollup_filas(marcas):
+    """Filas de jornadas_dia para marcas de dias completos."""
+    primeras = {}
+
+    def anotando():
+        for m in marcas:
+            primeras.setdefault((m.empleado_id, m.momento.date().isoformat()), m)
+            yield m
+
+    filas = []
+    for (eid, fecha), d in _jornadas_por_dia(anotando()).items():
+        primera = primeras[(eid, fecha)]
+        filas.append({
+            "empleado_id": eid, "fecha": fecha, "marcas": d["marcas"],
+            "entradas_sin_salida": d["entradas_sin_salida"],
+            "salidas_sin_entrada": d["salidas_sin_entrada"],
+            "trabajado_min": d["trabajado_min"],
+            "pares": [[_hora_local(i), _hora_local(f)] for i, f in d["pares"]],
+            "primera_entrada": _hora_local(d["primera_entrada"]),
+            "ultima_salida": _hora_local(d["ultima_salida"]),
+            "abierta_desde": _hora_local(d["abierta_desde"]),
+            # Hora e id de la primera marca: con ellos las jornadas leidas
+            # salen en el mismo orden que si se emparejaran en vivo.
+            "primera_marca": _hora_local(primera.momento), "primera_marca_id": primera.id,
+        })
+    return filas
+
+
+def _rollup_cubrir(desde, hasta):
+    """Calcula y guarda las fechas pasadas de [desde, hasta] que no esten en
+    jornadas_cobertura. Se hace por tramos de fechas seguidas."""
+    almacen = _almacen()
+    cubiertas = almacen.fechas_cubiertas(desde, hasta)
+    d, fin, tramos = date.fromisoformat(desde), date.fromisoformat(hasta), []
+    while d <= fin:
+        if d.isoformat() not in cubiertas:
+            if tramos and tramos[-1][1] == d - timedelta(days=1):
+                tramos[-1][1] = d
+            else:
+                tramos.append([d, d])
+        d += timedelta(days=1)
+    for ini, fin in tramos:
+        a, b = ini.isoformat(), fin.isoformat()
+        with _rollup_lock:
+            version = _rollup_version
+        filas = _rollup_filas(db_iter_registros_rango(a, b))
+        almacen.borrar_jornadas(a, b)
+        almacen.guardar_jornadas(filas)
+        fechas = [(ini + timedelta(days=k)).isoformat() for k in range((fin - ini).days + 1)]
+        limpias = _rollup_sin_escribir(fechas, version)
+        if not limpias:
+            continue
+        almacen.cubrir(limpias)
+        # Una escritura que llego entre mirar y marcar ya quito (o va a
+        # quitar) la cobertura sin recalcular: se deshace la marca.
+        sucias = sorted(set(limpias) - set(_rollup_sin_escribir(limpias, version)))
+        if sucias:
+            almacen.descubrir(sucias)
+
+
+def _dia_desde_rollup(f, horario, jornada_minima):
+    """Una fila de jornadas_dia con la forma de _jornadas(..., con_extras=True)."""
+    emp = f.get("empleados") or {}
+    fecha = f["fecha"]
+
+    def en_fecha(hora):
+        if not hora:
+            return None
+        return datetime.fromisoformat(f"{fecha}T{hora}").replace(tzinfo=LOCAL_TZ)
+
+    pares = [(en_fecha(i), en_fecha(fin)) for i, fin in f.get("pares") or []]
+    fecha_d = date.fromisoformat(fecha)
+    d = {
+        "nombre": emp.get("nombre", ""), "departamento": emp.get("departamento", ""),
+        "pares": pares, "marcas": f["marcas"],
+        "primera_entrada": en_fecha(f.get("primera_entrada")),
+        "ultima_salida": en_fecha(f.get("ultima_salida")),
+        "abierta_desde": en_fecha(f.get("abierta_desde")),
+        "entradas_sin_salida": f["entradas_sin_salida"],
+        "salidas_sin_entrada": f["salidas_sin_entrada"],
+        "trabajado_min": float(f["trabajado_min"]),
+    }
+    _cerrar_dia(d, bool(pares), jornada_minima)
+    d["extra_bruto_min"] = _minutos_extra(pares, _salida_programada(horario[str(fecha_d.weekday())], fecha_d))
+    return d
+
+
+def _jornadas_con_rollups(desde, hasta, emp_id=None):
+    """_jornadas(..., con_extras=True) del rango: lo pasado desde jornadas_dia
+    y lo de hoy (o posterior) emparejado en vivo."""
+    hoy = today_local()
+    ayer = (hoy - timedelta(days=1)).isoformat()
+    dias = {}
+    if desde <= min(hasta, ayer):
+        hasta_cerrado = min(hasta, ayer)
+        _rollup_cubrir(desde, hasta_cerrado)
+        filas = [f for pagina in _almacen().paginas_jornadas(desde, hasta_cerrado, emp_id) for f in pagina]
+        # "HH:MM:SS[.ffffff]" ordena bien como texto.
+        filas.sort(key=lambda f: (f["fecha"], f["primera_marca"], f["primera_marca_id"]))
+        horario, jornada_minima = db_get_horario_semanal(), db_get_jornada_minima()
+        for f in filas:
+            dias[(f["empleado_id"], f["fecha"])] = _dia_desde_rollup(f, horario, jornada_minima)
+    vivo_desde = max(desde, hoy.isoformat())
+    if vivo_desde <= hasta:
+        dias.update(_jornadas(db_iter_registros_rango(vivo_desde, hasta, emp_id), con_extras=True))
+    return dias
+
+
+def _rollup_tocar(filas):
+    """Recalcula jornadas_dia para los (empleado, dia pasado) de estas filas
+    de registros (fecha_hora tal como viene de Supabase)."""
+    if not ROLLUPS:
+        return
+    hoy = today_local()
+    tocados = {(f["empleado_id"], to_local(f["fecha_hora"]).date())
+               for f in filas if f and f.get("fecha_hora")}
+    _rollup_escrito({dia.isoformat() for _eid, dia in tocados if dia < hoy})
+    almacen = _almacen()
+    for eid, dia in sorted(tocados):
+        if dia >= hoy:
+            continue  # hoy siempre se empareja en vivo
+        fecha = dia.isoformat()
+        if not almacen.descubrir([fecha]):
+            continue  # se calcula entera la proxima vez que alguien la lea
+        nuevas = _rollup_filas(db_iter_registros_rango(fecha, fecha, eid))
+        if nuevas:
+            almacen.guardar_jornadas(nuevas)
+        else:
+            almacen.borrar_jornadas(fecha, fecha, eid)
+        almacen.cubrir([fecha])
+
+
+def _rollup_vaciar():
+    if ROLLUPS:
+        _rollup_escrito()
+        _almacen().vaciar_jornadas()
+
+
+# ------------------------------------------------------------
+# PERIODO EN UNA PASADA
+# db_resumen_periodo y db_retardos recorrian cada uno las mismas marcas con
+# su propia agrupacion por (empleado_id, fecha), y el Excel, que necesita las
+# dos y ademas los registros crudos, bajaba y recorria el rango tres veces. Un
+# _Periodo baja las marcas una sola vez (a la vez que la configuracion y los
+# empleados) y las agrupa con _jornadas; el detalle, el resumen, los retardos
+# y los dias por corregir salen de esas jornadas. La primera entrada de cada
+# jornada es la que buscaba db_retardos, porque las marcas llegan ordenadas
+# por fecha_hora.
+# ------------------------------------------------------------
+class _Periodo:
+    def __init__(self, desde, hasta, emp_id=None, con_empleados=True):
+        self.desde, self.hasta, self.emp_id = desde, hasta, emp_id
+
+        def jornadas():
+            if ROLLUPS:
+                return _jornadas_con_rollups(desde, hasta, emp_id)
+            return _jornadas(db_iter_registros_rango(desde, hasta, emp_id), con_extras=True)
+
+        tareas = [jornadas, db_ajustes] + ([db_listar_empleados] if con_empleados else [])
+        self.dias, self.ajustes, *resto = _en_paralelo(*tareas)
+        self.empleados = resto[0] if resto else []
+        self.horario = db_get_horario_semanal()
+        self.reglas = db_get_reglas_extras()
+
+    def resumen(self, emp_id=None, departamento=None):
+        """Detalle diario (horas trabajadas y extras) y resumen por empleado."""
+        dias = self.dias.items()
+        if emp_id:
+            dias = [kv for kv in dias if kv[0][0] == emp_id]
+        if departamento:
+            dias = [kv for kv in dias if (kv[1]["departamento"] or SIN_AREA) == departamento]
+
+        detalle = []
+        for (eid, fecha), d in sorted(dias, key=lambda kv: ((kv[1]["departamento"] or SIN_AREA), kv[1]["nombre"], kv[0][1])):
+            fecha_d = date.fromisoformat(fecha)
+            wd = fecha_d.weekday()
+            turno = self.horario[str(wd)]
+            trabajado = d["trabajado_min"] / 60
+            bruto = d["extra_bruto_min"]
+            extra = _aplicar_reglas_extras(bruto, self.reglas)
+            detalle.append({
+                "empleado_id": eid,
+                "nombre": d["nombre"],
+                "departamento": d["departamento"] or SIN_AREA,
+                "fecha": fecha,
+                "fecha_fmt": fecha_d.strftime("%d/%m/%Y"),
+                "dia": DIAS_SEMANA[wd],
+                "entrada": d["primera_entrada"].strftime("%H:%M") if d["primera_entrada"] else "",
+                "salida": d["ultima_salida"].strftime("%H:%M") if d["ultima_salida"] else "",
+                "entrada_programada": turno["entrada"] if turno else "",
+                "salida_programada": turno["salida"] if turno else "",
+                "horas_trabajadas": round(trabajado, 2),
+                "extra_bruto_min": int(round(bruto)),
+                "extra_min": extra,
+                "extra_horas": round(extra / 60, 2),
+                "no_laboral": turno is None,
+                "incompleto": d["incompleto"],
+                "revisar": d["revisar"],
+                "motivo": d["motivo"],
+                "marcas": d["marcas"],
+            })
+
+        resumen = {}
+        for e in self.empleados:
+            if emp_id and e["id"] != emp_id:
+                continue
+            area = e["departamento"] or SIN_AREA
+            if departamento and area != departamento:
+                continue
+            resumen[e["id"]] = _resumen_vacio(e["id"], e["nombre"], area)
+        for d in detalle:
+            # Un empleado desactivado despues de trabajar igual debe aparecer.
+            r = resumen.setdefault(
+                d["empleado_id"], _resumen_vacio(d["empleado_id"], d["nombre"], d["departamento"])
             )
+            r["horas"] += d["horas_trabajadas"]
+            r["extras_horas"] += d["extra_horas"]
+            if d["no_laboral"]:
+                r["extras_no_laboral_horas"] += d["extra_horas"]
+            else:
+                r["extras_habil_horas"] += d["extra_horas"]
+            if d["extra_min"] > 0:
+                r["dias_con_extra"] += 1
+            if d["incompleto"]:
+                r["dias_incompletos"] += 1
+
+        for r in resumen.values():
+            for k in ["horas", "extras_horas", "extras_habil_horas", "extras_no_laboral_horas"]:
+                r[k] = round(r[k], 2)
+
+        return {
+            "detalle": detalle,
+            "resumen": sorted(resumen.values(), key=lambda r: (r["departamento"], r["nombre"])),
+            "horario": self.horario,
+            "reglas": self.reglas,
+        }
+
+    def retardos(self, departamento=None):
+        """(retardos, sin_corregir), ver db_retardos."""
+        emp_map = {e["id"]: e for e in self.empleados}
+        tol = self.ajustes.tolerancia
+        corte = self.ajustes.hora_corte_entrada
+
+        retardos = []
+        sin_corregir = 0
+        for (emp_id, fecha), d in sorted(self.dias.items(), key=lambda kv: kv[0]):
+            if d["primera_entrada"] is None:
+                continue
+            emp = emp_map.get(emp_id)
+            if not emp:
+                continue
+            if departamento and emp["departamento"] != departamento:
+                continue
+            fecha_d = date.fromisoformat(fecha)
+            turno = self.horario[str(fecha_d.weekday())]
+            if not turno:
+                continue  # dia no laboral: trabajar ahi no es un retardo
+            hora_limite = turno["entrada"]
+            # Al minuto, como la hora programada.
+            hora_reg = d["primera_entrada"].strftime("%H:%M")
+            if hora_reg <= hora_limite:
+                continue
+            # Una "entrada" posterior a la hora de corte no es una llegada tarde
+            # de 10 horas: es la salida de quien olvido marcar en la manana,
+            # guardada como entrada por la alternancia vieja. Se usa la misma
+            # hora de corte con que el check-in decide el tipo de la primera
+            # marca, asi el reporte no contradice a la app. Esos dias no se
+            # pierden: salen en Admin -> Corregir Registros con su motivo, y
+            # aqui se cuentan aparte.
+            if hora_reg >= corte:
+                sin_corregir += 1
+                continue
+            h, m = map(int, hora_limite.split(":"))
+            lim = (
+                datetime.combine(fecha_d, datetime.min.time().replace(hour=h, minute=m))
+                + timedelta(minutes=tol)
+            ).strftime("%H:%M")
+            retardos.append({
+                "empleado_id": emp_id, "nombre": emp["nombre"],
+                "departamento": emp["departamento"] or "Sin area",
+                "fecha": fecha, "fecha_fmt": fecha_d.strftime("%d/%m/%Y"),
+                "dia": DIAS_SEMANA[fecha_d.weekday()],
+                "hora_programada": hora_limite, "hora_registro": hora_reg,
+                "minutos_tarde": _minutos_entre(hora_limite, hora_reg),
+                "con_tolerancia": hora_reg <= lim,
+            })
+        return retardos, sin_corregir
+
+    def por_corregir(self):
+        """Dias con marcas faltantes, listos para que el admin los arregle."""
+        pendientes = []
+        for (eid, fecha), d in self.dias.items():
+            if not d["revisar"]:
+                continue
+            fecha_d = date.fromisoformat(fecha)
+            pendientes.append({
+                "empleado_id": eid, "nombre": d["nombre"],
+                "departamento": d["departamento"] or SIN_AREA,
+                "fecha": fecha, "fecha_fmt": fecha_d.strftime("%d/%m/%Y"),
+                "dia": DIAS_SEMANA[fecha_d.weekday()],
+                "motivo": d["motivo"], "marcas": d["marcas"],
+                "primera_entrada": d["primera_entrada"].strftime("%H:%M") if d["primera_entrada"] else "",
+                "ultima_salida": d["ultima_salida"].strftime("%H:%M") if d["ultima_salida"] else "",
+            })
+        return sorted(pendientes, key=lambda p: (p["departamento"], p["nombre"], p["fecha"]))
 
-        trabajado = d["trabajado_min"] / 60
-        bruto = _minutos_extra(d["pares"], salida_prog)
-        extra = _aplicar_reglas_extras(bruto, reglas)
-        detalle.append({
-            "empleado_id": eid,
-            "nombre": d["nombre"],
-            "departamento": d["departamento"] or SIN_AREA,
-            "fecha": fecha,
-            "fecha_fmt": fecha_d.strftime("%d/%m/%Y"),
-            "dia": DIAS_SEMANA[wd],
-            "entrada": d["primera_entrada"].strftime("%H:%M") if d["primera_entrada"] else "",
-            "salida": d["ultima_salida"].strftime("%H:%M") if d["ultima_salida"] else "",
-            "entrada_programada": turno["entrada"] if turno else "",
-            "salida_programada": turno["salida"] if turno else "",
-            "horas_trabajadas": round(trabajado, 2),
-            "extra_bruto_min": int(round(bruto)),
-            "extra_min": extra,
-            "extra_horas": round(extra / 60, 2),
-            "no_laboral": turno is None,
-            "incompleto": d["incompleto"],
-            "revisar": d["revisar"],
-            "motivo": d["motivo"],
-            "marcas": d["marcas"],
-        })
 
-    resumen = {}
-    for e in db_listar_empleados():
-        if emp_id and e["id"] != emp_id:
-            continue
-        area = e["departamento"] or SIN_AREA
-        if departamento and area != departamento:
-            continue
-        resumen[e["id"]] = _resumen_vacio(e["id"], e["nombre"], area)
-    for d in detalle:
-        # Un empleado desactivado despues de trabajar igual debe aparecer.
-        r = resumen.setdefault(
-            d["empleado_id"], _resumen_vacio(d["empleado_id"], d["nombre"], d["departamento"])
-        )
-        r["horas"] += d["horas_trabajadas"]
-        r["extras_horas"] += d["extra_horas"]
-        if d["no_laboral"]:
-            r["extras_no_laboral_horas"] += d["extra_horas"]
+# ------------------------------------------------------------
+# RESULTADOS DE REPORTES EN CACHE
+# Cada cambio de filtro en Reportes recalculaba el rango desde cero, aunque
+# fuera un mes cerrado que ya no cambia. db_resumen_periodo y db_retardos
+# guardan su resultado por (rango, filtros, huella de la configuracion) con
+# la version de datos con que se calculo. Cada escritura sube la version
+# (_datos_cambiaron) y anota que dias toco: un check-in solo invalida los
+# resultados cuyo rango incluye hoy, una correccion los que incluyen ese dia,
+# y un cambio de empleados o una limpieza, todos. Las demas instancias de
+# Vercel no ven esas escrituras: las correcciones del admin dejan ademas
+# datos_version en configuracion, y cuando una instancia ve (al vencer
+# CONFIG_TTL) un valor que no publico ella, descarta todo. datos_version no
+# entra en la huella: si entrara, cada correccion dejaria huerfanas todas las
+# claves, incluso en la instancia que ya invalido solo ese dia. Lo que
+# incluye hoy vence a los REPORTES_CACHE_TTL_HOY segundos por los check-ins
+# de otras instancias. El tamano se mide en filas
+# (detalle + resumen + retardos) y se descarta lo menos usado.
+# REPORTES_CACHE=0 la apaga. Los resultados se comparten: no modificarlos.
+# ------------------------------------------------------------
+REPORTES_CACHE = os.environ.get("REPORTES_CACHE", "1") != "0"
+REPORTES_CACHE_FILAS = int(os.environ.get("REPORTES_CACHE_FILAS", "200000"))
+REPORTES_CACHE_TTL_HOY = int(os.environ.get("REPORTES_CACHE_TTL_HOY", "30"))  # segundos
+
+
+class _CacheReportes:
+    def __init__(self, max_filas):
+        self.max_filas = max_filas
+        self._lock = threading.Lock()
+        self._datos = OrderedDict()  # clave -> (version, creado, hoy, filas, valor)
+        self._filas = 0
+        self._version = 0            # sube con cada escritura
+        self._todo = 0               # version del ultimo cambio sin dias
+        self._dias = {}              # fecha -> version del ultimo cambio de ese dia
+        self._remota = None          # datos_version ya vista o publicada aqui
+        self._remota_vista = False
+
+    def cambio(self, fechas=None):
+        with self._lock:
+            self._anotar(fechas)
+
+    def _anotar(self, fechas):
+        self._version += 1
+        if fechas is None:
+            self._todo = self._version
+            self._dias.clear()
+            self._datos.clear()
+            self._filas = 0
         else:
-            r["extras_habil_horas"] += d["extra_horas"]
-        if d["extra_min"] > 0:
-            r["dias_con_extra"] += 1
-        if d["incompleto"]:
-            r["dias_incompletos"] += 1
+            for f in fechas:
+                self._dias[f] = self._version
+
+    def sincronizar(self, remota):
+        """remota: datos_version de configuracion. Un valor nuevo que no
+        publico esta instancia es una correccion de otra: se descarta todo."""
+        with self._lock:
+            if self._remota_vista and remota != self._remota:
+                self._anotar(None)
+            self._remota, self._remota_vista = remota, True
+
+    def publicada(self, previa, valor):
+        """Esta instancia cambio datos_version de previa a valor; sus dias ya
+        los invalido cambio()."""
+        self.sincronizar(previa)
+        with self._lock:
+            self._remota = valor
+
+    def _vigente(self, version, desde, hasta):
+        return version >= self._todo and all(
+            v <= version for f, v in self._dias.items() if desde <= f <= hasta
+        )
 
-    for r in resumen.values():
-        for k in ["horas", "extras_horas", "extras_habil_horas", "extras_no_laboral_horas"]:
-            r[k] = round(r[k], 2)
+    def obtener(self, clave, desde, hasta, calcular, contar_filas):
+        with self._lock:
+            e = self._datos.get(clave)
+            if e is not None:
+                version, creado, hoy, _n, valor = e
+                if self._vigente(version, desde, hasta) and (
+                    hasta < hoy or time.monotonic() - creado < REPORTES_CACHE_TTL_HOY
+                ):
+                    self._datos.move_to_end(clave)
+                    _metricas.contar("nevox_cache_total", cache="reportes", resultado="hit")
+                    return valor
+                self._quitar(clave)
+            version = self._version
+        _metricas.contar("nevox_cache_total", cache="reportes", resultado="miss")
+        valor = calcular()
+        n = contar_filas(valor)
+        with self._lock:
+            # Si algo del rango cambio mientras se calculaba, no se guarda.
+            if n <= self.max_filas and self._vigente(version, desde, hasta) and clave not in self._datos:
+                self._datos[clave] = (version, time.monotonic(), today_local().isoformat(), n, valor)
+                self._filas += n
+                while self._filas > self.max_filas:
+                    self._quitar(next(iter(self._datos)))
+        return valor
+
+    def _quitar(self, clave):
+        self._filas -= self._datos.pop(clave)[3]
+
+    def stats(self):
+        with self._lock:
+            return {"resultados": len(self._datos), "filas": self._filas, "version": self._version}
+
+
+_cache_reportes = _CacheReportes(REPORTES_CACHE_FILAS)
+_huella = (None, "")
+
+
+def _huella_config():
+    """Resumen de la tabla configuracion (horario, tolerancia, reglas...),
+    sin datos_version: si cambia algo, las claves viejas ya no se piden."""
+    global _huella
+    a = db_ajustes()
+    anterior, huella = _huella
+    if anterior is not a:
+        valores = sorted((k, v) for k, v in a.valores.items() if k != "datos_version")
+        huella = hashlib.sha1(json.dumps(valores).encode()).hexdigest()[:16]
+        _huella = (a, huella)
+    return huella
+
+
+def _en_cache(clave, desde, hasta, calcular, contar_filas):
+    if not REPORTES_CACHE:
+        return calcular()
+    _cache_reportes.sincronizar(db_ajustes().valores.get("datos_version"))
+    return _cache_reportes.obtener(clave + (_huella_config(),), desde, hasta, calcular, contar_filas)
+
+
+def _fechas_de(filas):
+    """Dias locales (YYYY-MM-DD) de filas de registros."""
+    return {to_local(f["fecha_hora"]).date().isoformat() for f in filas if f and f.get("fecha_hora")}
+
+
+def _datos_cambiaron(fechas=None, publicar=True):
+    """Aviso de escritura. fechas: los dias tocados, o None si puede cambiar
+    cualquiera (empleados, configuracion, limpiezas). publicar deja
+    datos_version en configuracion para las otras instancias; no hace falta
+    para los check-ins (solo tocan hoy) ni para la propia configuracion."""
+    _cache_reportes.cambio(fechas)
+    if publicar:
+        previa, valor = db_datos_version(), str(time.time_ns())
+        _almacen().guardar_config({"datos_version": valor})
+        _hoy.publicada(previa, valor)
+        _cache_reportes.publicada(previa, valor)
+        db_invalidar_ajustes()
+    # Los Excel ya armados solo se invalidan si cambio algo anterior a hoy:
+    # lo de hoy ya vence por EXPORTES_TTL_HOY.
+    if fechas is None or min(fechas, default="9") < today_local().isoformat():
+        try:
+            os.makedirs(EXPORTES_DIR, exist_ok=True)
+            with open(os.path.join(EXPORTES_DIR, _MARCA_DATOS), "w"):
+                pass
+        except OSError:
+            pass
 
-    return {
-        "detalle": detalle,
-        "resumen": sorted(resumen.values(), key=lambda r: (r["departamento"], r["nombre"])),
-        "horario": horario,
-        "reglas": reglas,
-    }
+
+def db_resumen_periodo(desde, hasta, emp_id=None, departamento=None):
+    """Detalle diario (horas trabajadas y extras) y resumen por empleado
+    para el rango indicado."""
+    return _en_cache(
+        ("resumen", desde, hasta, emp_id, departamento), desde, hasta,
+        lambda: _Periodo(desde, hasta, emp_id).resumen(emp_id, departamento),
+        lambda r: len(r["detalle"]) + len(r["resumen"]),
+    )
 
 
 def db_listar_areas():
@@ -640,65 +2897,13 @@ def db_retardos(desde, hasta, departamento=None):
 
     Devuelve (retardos, sin_corregir): el segundo es el numero de dias que se
     dejaron fuera por tener la marca mal tipada. Ver el filtro de la hora de
-    corte mas abajo.
+    corte en _Periodo.retardos.
     """
-    emp_map = {e["id"]: e for e in db_listar_empleados()}
-    horario = db_get_horario_semanal()
-    tol = int(db_get_config("tolerancia_minutos") or "15")
-    corte = db_get_hora_corte_entrada()
-
-    # Primera ENTRADA (hora local) por empleado y dia, calculada a partir de
-    # los registros ya convertidos a UTC-5. Asi la comparacion con la hora
-    # programada (que es local) es correcta.
-    primeras = {}  # (empleado_id, fecha_local) -> "HH:MM"
-    for r in db_registros_rango(desde, hasta):
-        if r["tipo"] != "entrada":
-            continue
-        loc = datetime.fromisoformat(r["fecha_hora"])  # ya en hora local
-        key = (r["empleado_id"], loc.strftime("%Y-%m-%d"))
-        hhmm = loc.strftime("%H:%M")
-        if key not in primeras or hhmm < primeras[key]:
-            primeras[key] = hhmm
-
-    retardos = []
-    sin_corregir = 0
-    for (emp_id, fecha), hora_reg in sorted(primeras.items()):
-        emp = emp_map.get(emp_id)
-        if not emp:
-            continue
-        if departamento and emp["departamento"] != departamento:
-            continue
-        fecha_d = date.fromisoformat(fecha)
-        turno = horario[str(fecha_d.weekday())]
-        if not turno:
-            continue  # dia no laboral: trabajar ahi no es un retardo
-        hora_limite = turno["entrada"]
-        if hora_reg <= hora_limite:
-            continue
-        # Una "entrada" posterior a la hora de corte no es una llegada tarde de
-        # 10 horas: es la salida de quien olvido marcar en la manana, guardada
-        # como entrada por la alternancia vieja. Se usa la misma hora de corte
-        # con que el check-in decide el tipo de la primera marca, asi el reporte
-        # no contradice a la app. Esos dias no se pierden: salen en Admin ->
-        # Corregir Registros con su motivo, y aqui se cuentan aparte.
-        if hora_reg >= corte:
-            sin_corregir += 1
-            continue
-        h, m = map(int, hora_limite.split(":"))
-        lim = (
-            datetime.combine(fecha_d, datetime.min.time().replace(hour=h, minute=m))
-            + timedelta(minutes=tol)
-        ).strftime("%H:%M")
-        retardos.append({
-            "empleado_id": emp_id, "nombre": emp["nombre"],
-            "departamento": emp["departamento"] or "Sin area",
-            "fecha": fecha, "fecha_fmt": fecha_d.strftime("%d/%m/%Y"),
-            "dia": DIAS_SEMANA[fecha_d.weekday()],
-            "hora_programada": hora_limite, "hora_registro": hora_reg,
-            "minutos_tarde": _minutos_entre(hora_limite, hora_reg),
-            "con_tolerancia": hora_reg <= lim,
-        })
-    return retardos, sin_corregir
+    return _en_cache(
+        ("retardos", desde, hasta, None, departamento), desde, hasta,
+        lambda: _Periodo(desde, hasta).retardos(departamento),
+        lambda r: len(r[0]),
+    )
 
 
 # ------------------------------------------------------------
@@ -716,12 +2921,15 @@ def _fecha_hora_utc(fecha, hora):
 
 
 def db_crear_registro(emp_id, fecha, hora, tipo):
-    filas = _sb_post("registros", {
+    fila = _almacen().insertar_registro({
         "empleado_id": emp_id, "tipo": tipo,
         "fecha_hora": _fecha_hora_utc(fecha, hora),
         "token_usado": "correccion-manual",
     })
-    return filas[0] if filas else None
+    _hoy.guardar([fila])
+    _rollup_tocar([fila])
+    _datos_cambiaron(_fechas_de([fila]))
+    return fila
 
 
 def db_actualizar_registro(reg_id, fecha=None, hora=None, tipo=None):
@@ -731,20 +2939,33 @@ def db_actualizar_registro(reg_id, fecha=None, hora=None, tipo=None):
     if fecha and hora:
         campos["fecha_hora"] = _fecha_hora_utc(fecha, hora)
     if campos:
-        _sb_patch("registros", campos, [("id", f"eq.{reg_id}")])
+        # Si cambia la fecha, el dia de antes tambien hay que recalcularlo.
+        antes = _almacen().registro(reg_id) if (ROLLUPS or REPORTES_CACHE) and "fecha_hora" in campos else None
+        filas = _almacen().actualizar_registro(reg_id, campos)
+        _hoy.guardar(filas)
+        _rollup_tocar([antes] + filas)
+        _datos_cambiaron(_fechas_de([antes] + filas))
 
 
 def db_eliminar_registro(reg_id):
-    _sb_delete("registros", [("id", f"eq.{reg_id}")])
+    borradas = _almacen().borrar_registro(reg_id, devolver=ROLLUPS or REPORTES_CACHE)
+    _hoy.quitar(reg_id)
+    _rollup_tocar(borradas or [])
+    _datos_cambiaron(_fechas_de(borradas) if borradas is not None else None)
 
 
 def db_mover_salida(reg_id, momento):
     """Reubica una salida duplicada a la hora real de salida. Queda marcada en
     token_usado para que se vea de donde salio."""
-    _sb_patch("registros", {
+    filas = _almacen().actualizar_registro(reg_id, {
         "fecha_hora": momento.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S+00:00"),
         "token_usado": "auto-correccion-duplicado",
-    }, [("id", f"eq.{reg_id}")])
+    })
+    _hoy.guardar(filas)
+    # La salida que se mueve es de hoy (sale de las marcas del dia), asi que
+    # basta con mirar donde quedo.
+    _rollup_tocar(filas)
+    _datos_cambiaron(_fechas_de(filas), publicar=False)
 
 
 def db_sin_cerrar(fecha=None):
@@ -757,8 +2978,12 @@ def db_sin_cerrar(fecha=None):
     ahora = now_local()
     vencido = bool(salida_prog and ahora.strftime("%H:%M") > salida_prog)
 
+    if fecha == today_local().isoformat():
+        regs = _marcas(_hoy.filas(HOY_TTL))
+    else:
+        regs = db_iter_registros_rango(fecha, fecha)
     pendientes = []
-    for (eid, _f), d in _jornadas_por_dia(db_registros_rango(fecha, fecha)).items():
+    for (eid, _f), d in _jornadas_por_dia(regs).items():
         if d["abierta_desde"] is None:
             continue
         pendientes.append({
@@ -780,31 +3005,22 @@ def db_sin_cerrar(fecha=None):
 
 def db_dias_por_corregir(desde, hasta, emp_id=None):
     """Dias con marcas faltantes, listos para que el admin los arregle."""
-    dias = _jornadas_por_dia(db_registros_rango(desde, hasta, emp_id))
-    pendientes = []
-    for (eid, fecha), d in dias.items():
-        if not d["revisar"]:
-            continue
-        fecha_d = date.fromisoformat(fecha)
-        pendientes.append({
-            "empleado_id": eid, "nombre": d["nombre"],
-            "departamento": d["departamento"] or SIN_AREA,
-            "fecha": fecha, "fecha_fmt": fecha_d.strftime("%d/%m/%Y"),
-            "dia": DIAS_SEMANA[fecha_d.weekday()],
-            "motivo": d["motivo"], "marcas": d["marcas"],
-            "primera_entrada": d["primera_entrada"].strftime("%H:%M") if d["primera_entrada"] else "",
-            "ultima_salida": d["ultima_salida"].strftime("%H:%M") if d["ultima_salida"] else "",
-        })
-    return sorted(pendientes, key=lambda p: (p["departamento"], p["nombre"], p["fecha"]))
+    return _Periodo(desde, hasta, emp_id, con_empleados=False).por_corregir()
 
 
 def db_limpiar_registros():
-    _sb_delete("registros", [("id", "neq.0")])
+    _almacen().borrar_registros()
+    _hoy.invalidar()
+    _rollup_vaciar()
+    _datos_cambiaron()
 
 
 def db_limpiar_todo():
-    _sb_delete("registros", [("id", "neq.0")])
-    _sb_delete("empleados", [("id", "neq.0")])
+    _almacen().borrar_registros()
+    _almacen().borrar_empleados()
+    _hoy.invalidar()
+    _rollup_vaciar()
+    _datos_cambiaron()
 
 
 # ============================================================
@@ -815,9 +3031,13 @@ def _secret():
     return db_get_config("secret_key")
 
 
-def qr_token():
+def qr_slot_actual():
+    return int(time.time()) // QR_ROTATION_INTERVAL
+
+
+def qr_token(slot=None):
     secret = _secret()
-    slot = int(time.time()) // QR_ROTATION_INTERVAL
+    slot = qr_slot_actual() if slot is None else slot
     firma = hmac.new(secret.encode(), f"qr:{slot}".encode(), hashlib.sha256).hexdigest()
     return f"{slot}:{firma}"
 
@@ -875,7 +3095,9 @@ def reg_validar(token):
     return int(emp_id) if hmac.compare_digest(firma, expected) else None
 
 
+@_fase("qr_png")
 def qr_base64(data, size=8):
+    _metricas.contar("nevox_qr_generados_total")
     qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=size, border=2)
     qr.add_data(data)
     qr.make(fit=True)
@@ -886,8 +3108,44 @@ def qr_base64(data, size=8):
     return base64.b64encode(buf.read()).decode("utf-8")
 
 
-def qr_checkin_url():
-    return f"{BASE_URL}/checkin?token={qr_token()}"
+def qr_checkin_url(slot=None):
+    return f"{BASE_URL}/checkin?token={qr_token(slot)}"
+
+
+# ------------------------------------------------------------
+# QR DEL DASHBOARD POR FRANJA
+# El dashboard pide /api/qr cada 5 s desde cada pantalla, pero el token solo
+# cambia cada QR_ROTATION_INTERVAL segundos. Antes cada consulta volvia a
+# firmar y a codificar el PNG; ahora la imagen de cada franja se genera una
+# vez por instancia y la de la franja siguiente se prepara por adelantado,
+# para que el primer pedido despues del cambio no pague el render.
+# ------------------------------------------------------------
+_qr_lock = threading.Lock()
+_qr_cache = {}  # slot -> (qr_base64, etag)
+
+
+def qr_checkin_imagen(slot):
+    """(qr_base64, etag) del QR de check-in de la franja indicada."""
+    hit = _qr_cache.get(slot)
+    if hit is not None:
+        _metricas.contar("nevox_cache_total", cache="qr", resultado="hit")
+        return hit
+    with _qr_lock:
+        hit = _qr_cache.get(slot)
+        _metricas.contar("nevox_cache_total", cache="qr", resultado="miss" if hit is None else "hit")
+        if hit is None:
+            url = qr_checkin_url(slot)
+            hit = (qr_base64(url), hashlib.sha256(url.encode()).hexdigest()[:20])
+            vigente = qr_slot_actual()
+            for viejo in [s for s in _qr_cache if s < vigente]:
+                del _qr_cache[viejo]
+            _qr_cache[slot] = hit
+        return hit
+
+
+def qr_preparar_siguiente(slot):
+    if slot + 1 not in _qr_cache:
+        _prefetch_pool.submit(qr_checkin_imagen, slot + 1)
 
 
 def qr_registro_url(emp_id):
@@ -904,6 +3162,102 @@ app = Flask(__name__, template_folder=TEMPLATE_DIR)
 app.secret_key = os.environ.get("SECRET_KEY", "dev-fallback-change-me")
 
 
+@app.before_request
+def _abrir_memo():
+    g.memo_token = _memo_peticion.set(_MemoConsultas())
+
+
+@app.teardown_request
+def _cerrar_memo(_exc):
+    token = g.pop("memo_token", None)
+    if token is not None:
+        _memo_peticion.reset(token)
+
+
+@app.before_request
+def _abrir_traza():
+    if TRAZA:
+        g.traza_token = _traza.set(_Traza())
+
+
+@app.after_request
+def _cerrar_traza(resp):
+    traza = _traza.get()
+    if traza is None:
+        return resp
+    total_ms = (time.perf_counter() - traza.inicio) * 1000
+    resp.headers["Server-Timing"] = traza.server_timing(total_ms)
+    if total_ms >= TRAZA_LOG_MS:
+        tablas = traza.por_tabla()
+        log_traza.info(json.dumps({
+            "evento": "peticion", "metodo": request.method, "ruta": request.path,
+            "endpoint": request.endpoint, "status": resp.status_code, "ms": round(total_ms, 1),
+            "sb": {
+                "llamadas": sum(t["llamadas"] for t in tablas.values()),
+                "ms": round(sum(t["ms"] for t in tablas.values()), 1),
+                "filas": sum(t["filas"] for t in tablas.values()),
+                "bytes": sum(t["bytes"] for t in tablas.values()),
+                "errores": sum(t["errores"] for t in tablas.values()),
+            },
+            "tablas": {k: {**t, "ms": round(t["ms"], 1)} for k, t in tablas.items()},
+            "fases": {k: {"veces": v, "ms": round(seg * 1000, 1)} for k, (v, seg) in traza.fases.items()},
+        }, separators=(",", ":")))
+    return resp
+
+
+@app.teardown_request
+def _soltar_traza(_exc):
+    token = g.pop("traza_token", None)
+    if token is not None:
+        _traza.reset(token)
+
+
+@app.before_request
+def _marcar_inicio():
+    g.inicio = time.perf_counter()
+
+
+@app.before_request
+def _abrir_perfil():
+    modo = request.args.get("perfil") or request.headers.get("X-Perfil")
+    if modo in PERFIL_MODOS and session.get("admin"):
+        perfil = _Perfil(modo, request.endpoint or "sin_ruta")
+        g.perfil_token = _perfil.set(perfil)
+        perfil.iniciar()
+
+
+@app.after_request
+def _guardar_perfil(resp):
+    perfil = _perfil.get()
+    if perfil is not None and g.get("perfil_token") is not None:
+        perfil.detener()
+        nombre = perfil.guardar()
+        resp.headers["X-Perfil"] = nombre
+        resp.headers["X-Perfil-Url"] = url_for("api_admin_perfil", nombre=nombre)
+        _perfil.reset(g.pop("perfil_token"))
+    return resp
+
+
+@app.teardown_request
+def _soltar_perfil(_exc):
+    token = g.pop("perfil_token", None)
+    if token is not None:
+        _perfil.get().detener()
+        _perfil.reset(token)
+
+
+@app.after_request
+def _medir_peticion(resp):
+    inicio = g.get("inicio")
+    if inicio is not None:
+        endpoint = request.endpoint or "sin_ruta"
+        _metricas.contar("nevox_http_peticiones_total", endpoint=endpoint,
+                         metodo=request.method, status=resp.status_code)
+        _metricas.observar("nevox_http_duracion_segundos", time.perf_counter() - inicio,
+                           endpoint=endpoint)
+    return resp
+
+
 @app.errorhandler(Exception)
 def handle_error(e):
     return jsonify({"error": str(e), "type": type(e).__name__, "trace": traceback.format_exc()}), 500
@@ -931,12 +3285,28 @@ def index():
     return render_template("dashboard.html")
 
 
+def _datos_qr(ahora):
+    slot = int(ahora) // QR_ROTATION_INTERVAL
+    b64, etag = qr_checkin_imagen(slot)
+    qr_preparar_siguiente(slot)
+    rem = QR_ROTATION_INTERVAL - (int(ahora) % QR_ROTATION_INTERVAL)
+    return {"qr_base64": b64, "remaining_seconds": rem, "slot": slot,
+            "timestamp": now_local().strftime("%H:%M:%S")}, etag
+
+
 @app.route("/api/qr")
 def api_qr():
-    url = qr_checkin_url()
-    b64 = qr_base64(url)
-    rem = QR_ROTATION_INTERVAL - (int(time.time()) % QR_ROTATION_INTERVAL)
-    return jsonify({"qr_base64": b64, "remaining_seconds": rem, "timestamp": now_local().strftime("%H:%M:%S")})
+    ahora = time.time()
+    datos, etag = _datos_qr(ahora)
+    fin = (datos["slot"] + 1) * QR_ROTATION_INTERVAL
+    resp = jsonify(datos)
+    # La respuesta vale hasta el cambio de franja y ni un segundo mas: max-age
+    # se redondea hacia abajo para que el navegador no muestre un QR vencido.
+    resp.set_etag(etag)
+    resp.cache_control.private = True
+    resp.cache_control.max_age = max(0, int(fin - ahora))
+    resp.expires = datetime.fromtimestamp(fin, timezone.utc)
+    return resp.make_conditional(request)
 
 
 @app.route("/api/pendientes-hoy")
@@ -944,12 +3314,138 @@ def api_pendientes_hoy():
     return jsonify(db_sin_cerrar())
 
 
+# ------------------------------------------------------------
+# REGISTROS DE HOY POR DIFERENCIA (?since=)
+# Despues de las 7:30 casi toda la lista del dia ya la tiene el dashboard. Con
+# el cursor de la respuesta anterior se devuelven solo las marcas nuevas (id
+# mayor al ultimo que vio) y los contadores. El cursor lleva tambien cuantas
+# filas habia y una firma de (id, fecha_hora, tipo): si alguna de esas filas
+# cambio (db_mover_salida, una edicion o un borrado del admin) o entro una
+# marca con hora anterior a las ya mostradas, la firma no coincide y se manda
+# la lista completa con delta=false.
+# ------------------------------------------------------------
+
+def _firma_registros(filas):
+    h = hashlib.blake2b(digest_size=8)
+    for f in sorted(filas, key=lambda f: f["id"]):
+        h.update(f"{f['id']}|{f['fecha_hora']}|{f['tipo']};".encode())
+    return h.hexdigest()
+
+
+def _cursor_registros(fecha, filas):
+    max_id = max((f["id"] for f in filas), default=0)
+    return f"{fecha}.{max_id}.{len(filas)}.{_firma_registros(filas)}"
+
+
+def _delta_desde(since, fecha, filas):
+    """Filas nuevas respecto del cursor, o None si hay que mandar todo."""
+    try:
+        c_fecha, c_id, c_total, c_firma = since.split(".")
+        c_id, c_total = int(c_id), int(c_total)
+    except (AttributeError, ValueError):
+        return None
+    if c_fecha != fecha:
+        return None
+    vistas = [f for f in filas if f["id"] <= c_id]
+    if len(vistas) != c_total or _firma_registros(vistas) != c_firma:
+        return None
+    nuevas = [f for f in filas if f["id"] > c_id]
+    if vistas and nuevas:
+        ultima_vista = max(datetime.fromisoformat(f["fecha_hora"]) for f in vistas)
+        if any(datetime.fromisoformat(f["fecha_hora"]) < ultima_vista for f in nuevas):
+            return None  # una correccion con hora pasada: la lista se reordena
+    return nuevas
+
+
+def _datos_registros_hoy(since=None):
+    fecha = today_local().isoformat()
+    crudas = _hoy.filas(HOY_TTL)  # orden ascendente
+    ent = sum(1 for r in crudas if r["tipo"] == "entrada")
+    sal = sum(1 for r in crudas if r["tipo"] == "salida")
+    nuevas = _delta_desde(since, fecha, crudas) if since else None
+    # El cursor va antes de _flatten_registros, que pasa fecha_hora a hora local.
+    cursor = _cursor_registros(fecha, crudas)
+    return {
+        "registros": _flatten_registros((crudas if nuevas is None else nuevas)[::-1]),
+        "delta": nuevas is not None,
+        "cursor": cursor,
+        "total": len(crudas), "entradas": ent, "salidas": sal,
+        "fecha": today_local().strftime("%d/%m/%Y"),
+    }
+
+
 @app.route("/api/registros-hoy")
 def api_registros_hoy():
-    regs = db_registros_dia()
-    ent = sum(1 for r in regs if r["tipo"] == "entrada")
-    sal = sum(1 for r in regs if r["tipo"] == "salida")
-    return jsonify({"registros": regs, "total": len(regs), "entradas": ent, "salidas": sal, "fecha": today_local().strftime("%d/%m/%Y")})
+    return jsonify(_datos_registros_hoy(request.args.get("since")))
+
+
+# ------------------------------------------------------------
+# DASHBOARD EN VIVO (SSE)
+# Cada pantalla consultaba /api/qr, /api/registros-hoy y /api/pendientes-hoy
+# por su cuenta, asi que la carga crecia con pantallas x tiempo aunque no
+# pasara nada. El stream manda un evento solo cuando algo cambia: el QR al
+# cambiar la franja, los registros cuando hay una marca nueva o una correccion
+# y los pendientes cuando cambia quien tiene la jornada abierta. Las marcas de
+# esta instancia despiertan al stream en el acto; las de otras se ven cuando
+# _RegistrosHoy concilia con Supabase, una vez por instancia y no por pantalla.
+# Vercel corta las funciones largas, asi que cada conexion dura SSE_DURACION
+# segundos y EventSource vuelve a conectarse solo.
+# ------------------------------------------------------------
+SSE_DURACION = int(os.environ.get("SSE_DURACION_SEGUNDOS", "55"))
+SSE_LATIDO = 15  # segundos sin eventos antes de mandar un comentario
+
+
+def _sse(evento, datos):
+    return f"event: {evento}\ndata: {json.dumps(datos, separators=(',', ':'))}\n\n"
+
+
+def _eventos_dashboard():
+    # Este stream vive casi un minuto: el memo de la peticion devolveria
+    # siempre la primera respuesta a las consultas de conciliacion, y la traza
+    # (que ya salio en las cabeceras) solo acumularia llamadas.
+    _memo_peticion.set(None)
+    _traza.set(None)
+    limite = time.monotonic() + SSE_DURACION
+    slot = cursor = pend_previos = None
+    ultimo_envio = time.monotonic()
+    version = _hoy.version
+    yield "retry: 3000\n\n"
+    while True:
+        ahora = time.time()
+        enviados = []
+        if int(ahora) // QR_ROTATION_INTERVAL != slot:
+            datos, _etag = _datos_qr(ahora)
+            slot = datos["slot"]
+            enviados.append(_sse("qr", datos))
+        regs = _datos_registros_hoy(cursor)
+        if regs["cursor"] != cursor:
+            cursor = regs["cursor"]
+            enviados.append(_sse("registros", regs))
+        pend = db_sin_cerrar()
+        if pend != pend_previos:
+            pend_previos = pend
+            enviados.append(_sse("pendientes", pend))
+        if enviados:
+            ultimo_envio = time.monotonic()
+            yield "".join(enviados)
+        elif time.monotonic() - ultimo_envio >= SSE_LATIDO:
+            ultimo_envio = time.monotonic()
+            yield ": latido\n\n"
+
+        resto = limite - time.monotonic()
+        if resto <= 0:
+            return
+        hasta_franja = (slot + 1) * QR_ROTATION_INTERVAL - time.time()
+        version = _hoy.esperar(version, max(0.05, min(resto, HOY_TTL, hasta_franja, SSE_LATIDO)))
+
+
+@app.route("/api/stream/dashboard")
+def api_stream_dashboard():
+    return Response(
+        stream_with_context(_eventos_dashboard()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # --- CHECK-IN ---
@@ -961,42 +3457,44 @@ def checkin():
     return render_template("checkin.html", token_qr=t)
 
 
-@app.route("/api/checkin", methods=["POST"])
-def api_checkin():
-    data = request.get_json()
-    if not data:
-        return jsonify({"ok": False, "mensaje": "Datos invalidos."}), 400
-    tqr = data.get("token_qr", "")
-    tdev = data.get("token_dispositivo", "")
-    if not qr_validar(tqr):
-        return jsonify({"ok": False, "mensaje": "QR expirado."}), 400
-    if not tdev:
-        return jsonify({"ok": False, "mensaje": "Dispositivo no registrado."}), 400
-    emp_id = device_validar(tdev)
-    if not emp_id:
-        return jsonify({"ok": False, "mensaje": "Token invalido."}), 400
-    emp = db_obtener_empleado(emp_id)
-    if not emp or not emp["activo"]:
-        return jsonify({"ok": False, "mensaje": "Empleado no encontrado o inactivo."}), 400
-    if emp["token_dispositivo"] != tdev:
-        return jsonify({"ok": False, "mensaje": "Dispositivo no vinculado."}), 400
+# ------------------------------------------------------------
+# DECISION DEL CHECK-IN
+# Toda la regla del escaneo (anti-rebote, jornada completa, margen de salida,
+# hora de corte y reubicacion de duplicados) vive en decidir_checkin, que no
+# toca la base: recibe las marcas de hoy y devuelve que hacer. El modo normal
+# la aplica y luego escribe; con CHECKIN_RPC=1 la misma regla corre dentro de
+# Postgres (sql/checkin_decidir.sql) en una sola llamada, con la fila del
+# empleado bloqueada, lo que cierra la ventana entre leer y escribir cuando
+# llegan dos escaneos a la vez. Los dos modos devuelven la misma decision y la
+# respuesta JSON se arma igual en ambos (_respuesta_checkin).
+#
+# Con ALMACEN=sqlite el check-in va siempre por el RPC: ahi el modo normal lee
+# y escribe en transacciones separadas y dos escaneos simultaneos crean dos
+# marcas, mientras que _AlmacenSqlite.checkin decide dentro de la
+# transaccion de escritura (BEGIN IMMEDIATE) sin costar nada extra.
+#
+# Decision: {"accion": ..., ...}
+#   rechazado         motivo: "empleado" | "dispositivo" (solo en modo RPC)
+#   duplicado         tipo, fecha_hora del registro previo
+#   jornada_completa  primera (entrada), ultima (salida)
+#   aviso             entrada, salida_programada, abre (minutos del dia)
+#   corregido         registro_id, previa, sin_entrada; fecha_hora al escribir
+#   creado            tipo, primera_del_dia, corte; fecha_hora al escribir
+# ------------------------------------------------------------
+CHECKIN_RPC = os.environ.get("CHECKIN_RPC", "0") == "1"
 
-    # Una sola consulta con las marcas de hoy: sirve para el anti-rebote, para
-    # saber si la jornada ya esta completa y para decidir el tipo.
-    regs_hoy = db_registros_hoy_empleado(emp_id)
 
+def decidir_checkin(regs_hoy, ahora, ajustes, duplicado_max=DUPLICADO_MAX_MINUTOS):
+    """Que hacer con un escaneo valido, dadas las marcas de hoy del empleado
+    (orden ascendente) y la hora local actual. No escribe nada. duplicado_max:
+    minutos entre entrada y salida por debajo de los cuales es doble escaneo."""
     # Recarga / doble escaneo: no se crea un registro nuevo, se repite el anterior.
-    ventana = db_get_antirrebote()
+    ventana = ajustes.antirrebote
     if regs_hoy and ventana > 0:
         previo = regs_hoy[-1]
-        seg = (now_local() - to_local(previo["fecha_hora"])).total_seconds()
+        seg = (ahora - to_local(previo["fecha_hora"])).total_seconds()
         if 0 <= seg < ventana:
-            hora = to_local(previo["fecha_hora"]).strftime("%H:%M:%S")
-            return jsonify({
-                "ok": True, "duplicado": True, "nombre": emp["nombre"],
-                "tipo": previo["tipo"], "hora": hora,
-                "mensaje": f"Ya habias registrado tu {previo['tipo']} a las {hora}.",
-            })
+            return {"accion": "duplicado", "tipo": previo["tipo"], "fecha_hora": previo["fecha_hora"]}
 
     # El almuerzo no se marca: dos marcas por dia y nada mas. Un tercer escaneo
     # antes creaba una entrada huerfana que dañaba el dia entero.
@@ -1006,27 +3504,14 @@ def api_checkin():
         primera = to_local(entradas[0]["fecha_hora"])
         ultima = to_local(salidas[-1]["fecha_hora"])
         duracion = (ultima - primera).total_seconds() / 60
-
-        if duracion >= DUPLICADO_MAX_MINUTOS:
-            return jsonify({
-                "ok": False, "jornada_completa": True, "nombre": emp["nombre"],
-                "mensaje": f"Tu jornada de hoy ya esta registrada: entrada {primera:%H:%M} y "
-                           f"salida {ultima:%H:%M}. El almuerzo no se marca. "
-                           f"Si algo esta mal, avisa a Recursos Humanos.",
-            }), 409
-
+        if duracion >= duplicado_max:
+            return {"accion": "jornada_completa",
+                    "primera": entradas[0]["fecha_hora"], "ultima": salidas[-1]["fecha_hora"]}
         # Entrada y salida a minutos de distancia: no es una jornada, es un
         # doble escaneo. Se reubica esa salida a la hora real en vez de dejar
         # a la persona bloqueada con un dia de cero horas.
-        ahora = now_local()
-        db_mover_salida(salidas[-1]["id"], ahora)
-        return jsonify({
-            "ok": True, "duplicado": False, "corregido": True,
-            "nombre": emp["nombre"], "tipo": "salida",
-            "hora": ahora.strftime("%H:%M:%S"),
-            "mensaje": "Salida registrada.",
-            "recordatorio": f"Se corrigio un registro duplicado de las {ultima:%H:%M}.",
-        })
+        return {"accion": "corregido", "registro_id": salidas[-1]["id"],
+                "previa": salidas[-1]["fecha_hora"], "sin_entrada": False}
 
     # Con la entrada ya marcada no se acepta otro escaneo hasta la hora de
     # salida programada. Un rescaneo a media manana creaba una salida a los
@@ -1035,19 +3520,12 @@ def api_checkin():
     # con Recursos Humanos. En dia no laboral no hay hora de salida programada,
     # asi que ahi no se bloquea nada.
     if entradas and not salidas:
-        ahora = now_local()
-        turno = db_get_horario_semanal()[str(ahora.date().weekday())]
+        turno = ajustes.horario[str(ahora.date().weekday())]
         if turno:
-            abre = max(0, _minutos_del_dia(turno["salida"]) - db_get_margen_salida())
+            abre = max(0, _minutos_del_dia(turno["salida"]) - ajustes.margen_salida)
             if _minutos_del_dia(ahora.strftime("%H:%M")) < abre:
-                hora_ent = to_local(entradas[0]["fecha_hora"])
-                return jsonify({
-                    "ok": False, "aviso": True, "nombre": emp["nombre"],
-                    "mensaje": f"Ya marcaste tu entrada a las {hora_ent:%H:%M}. Tu jornada "
-                               f"termina a las {turno['salida']} y la salida se puede marcar "
-                               f"desde las {abre // 60:02d}:{abre % 60:02d}. Si necesitas "
-                               f"salir antes, avisa a Recursos Humanos.",
-                }), 409
+                return {"accion": "aviso", "entrada": entradas[0]["fecha_hora"],
+                        "salida_programada": turno["salida"], "abre": abre}
 
     # Dia que empezo con una salida (nadie marco entrada antes de la hora de
     # corte): los escaneos siguientes NO crean una entrada de la tarde, que
@@ -1055,40 +3533,167 @@ def api_checkin():
     # queda sin entrada a proposito, para que Recursos Humanos ponga la que
     # falta.
     if salidas and not entradas:
-        ahora = now_local()
-        previa = to_local(salidas[-1]["fecha_hora"])
-        db_mover_salida(salidas[-1]["id"], ahora)
-        return jsonify({
+        return {"accion": "corregido", "registro_id": salidas[-1]["id"],
+                "previa": salidas[-1]["fecha_hora"], "sin_entrada": True}
+
+    corte = ajustes.hora_corte_entrada
+    if regs_hoy:
+        tipo = "entrada" if regs_hoy[-1]["tipo"] == "salida" else "salida"
+    else:
+        tipo = tipo_por_hora(ahora, corte)
+    return {"accion": "creado", "tipo": tipo, "primera_del_dia": not regs_hoy, "corte": corte}
+
+
+def _ejecutar_checkin(emp_id, token_qr, decision, ahora):
+    """Escribe lo que decidio decidir_checkin y completa fecha_hora."""
+    if decision["accion"] == "corregido":
+        db_mover_salida(decision["registro_id"], ahora)
+        decision["fecha_hora"] = ahora.isoformat()
+    elif decision["accion"] == "creado":
+        creado = db_registrar_asistencia(emp_id, decision["tipo"], token_qr)
+        decision["fecha_hora"] = creado.get("fecha_hora") if creado else None
+    return decision
+
+
+def db_checkin_rpc(emp_id, token_dispositivo, token_qr, ahora):
+    """Decision y escritura del check-in en una sola llamada a Postgres."""
+    ajustes = db_ajustes()
+    turno = ajustes.horario[str(ahora.date().weekday())]
+    ini, fin = local_day_bounds_utc(ahora.date().isoformat())
+    decision = _almacen().checkin(
+        empleado_id=emp_id, token_dispositivo=token_dispositivo, token_qr=token_qr,
+        desde=ini, hasta=fin,
+        antirrebote=ajustes.antirrebote,
+        salida_programada=turno["salida"] if turno else None,
+        margen_salida=ajustes.margen_salida,
+        hora_corte=ajustes.hora_corte_entrada,
+        duplicado_max=DUPLICADO_MAX_MINUTOS,
+        utc_offset_min=int(LOCAL_TZ.utcoffset(None).total_seconds() // 60),
+    )
+    if decision.get("registro"):
+        _hoy.guardar([decision.pop("registro")])
+    if decision.get("accion") in ("creado", "corregido"):
+        _datos_cambiaron({ahora.date().isoformat()}, publicar=False)
+    return decision
+
+
+def _respuesta_checkin(nombre, d):
+    """(cuerpo, status) del check-in para una decision ya aplicada."""
+    accion = d["accion"]
+    if accion == "rechazado":
+        if d.get("motivo") == "dispositivo":
+            return {"ok": False, "mensaje": "Dispositivo no vinculado."}, 400
+        return {"ok": False, "mensaje": "Empleado no encontrado o inactivo."}, 400
+
+    if accion == "duplicado":
+        hora = to_local(d["fecha_hora"]).strftime("%H:%M:%S")
+        return {
+            "ok": True, "duplicado": True, "nombre": nombre,
+            "tipo": d["tipo"], "hora": hora,
+            "mensaje": f"Ya habias registrado tu {d['tipo']} a las {hora}.",
+        }, 200
+
+    if accion == "jornada_completa":
+        primera, ultima = to_local(d["primera"]), to_local(d["ultima"])
+        return {
+            "ok": False, "jornada_completa": True, "nombre": nombre,
+            "mensaje": f"Tu jornada de hoy ya esta registrada: entrada {primera:%H:%M} y "
+                       f"salida {ultima:%H:%M}. El almuerzo no se marca. "
+                       f"Si algo esta mal, avisa a Recursos Humanos.",
+        }, 409
+
+    if accion == "aviso":
+        hora_ent, abre = to_local(d["entrada"]), d["abre"]
+        return {
+            "ok": False, "aviso": True, "nombre": nombre,
+            "mensaje": f"Ya marcaste tu entrada a las {hora_ent:%H:%M}. Tu jornada "
+                       f"termina a las {d['salida_programada']} y la salida se puede marcar "
+                       f"desde las {abre // 60:02d}:{abre % 60:02d}. Si necesitas "
+                       f"salir antes, avisa a Recursos Humanos.",
+        }, 409
+
+    if accion == "corregido":
+        ahora, previa = to_local(d["fecha_hora"]), to_local(d["previa"])
+        if d["sin_entrada"]:
+            recordatorio = (f"Hoy no marcaste entrada, asi que tu salida quedo a las "
+                            f"{ahora:%H:%M} (antes {previa:%H:%M}). "
+                            f"Avisa a Recursos Humanos para que registre tu entrada.")
+        else:
+            recordatorio = f"Se corrigio un registro duplicado de las {previa:%H:%M}."
+        return {
             "ok": True, "duplicado": False, "corregido": True,
-            "nombre": emp["nombre"], "tipo": "salida",
+            "nombre": nombre, "tipo": "salida",
             "hora": ahora.strftime("%H:%M:%S"),
             "mensaje": "Salida registrada.",
-            "recordatorio": f"Hoy no marcaste entrada, asi que tu salida quedo a las "
-                            f"{ahora:%H:%M} (antes {previa:%H:%M}). "
-                            f"Avisa a Recursos Humanos para que registre tu entrada.",
-        })
+            "recordatorio": recordatorio,
+        }, 200
 
-    corte = db_get_hora_corte_entrada()
-    tipo = ("entrada" if regs_hoy[-1]["tipo"] == "salida" else "salida") if regs_hoy else tipo_por_hora(now_local(), corte)
-    creado = db_registrar_asistencia(emp_id, tipo, tqr)
-    hora = to_local(creado["fecha_hora"]).strftime("%H:%M:%S") if creado and creado.get("fecha_hora") else now_local().strftime("%H:%M:%S")
+    tipo = d["tipo"]
+    hora = to_local(d["fecha_hora"]).strftime("%H:%M:%S") if d.get("fecha_hora") else now_local().strftime("%H:%M:%S")
     # El olvido de la salida es lo que mas ensucia los reportes: se avisa en el
     # momento, que es cuando la persona todavia puede hacer algo. Y si su
     # primera marca del dia quedo como salida, hay que decirle por que.
     if tipo == "entrada":
         recordatorio = "No olvides marcar tu SALIDA al terminar la jornada."
-    elif not regs_hoy:
-        recordatorio = (f"No marcaste entrada antes de las {corte}, asi que este registro "
+    elif d["primera_del_dia"]:
+        recordatorio = (f"No marcaste entrada antes de las {d['corte']}, asi que este registro "
                         f"quedo como SALIDA. Avisa a Recursos Humanos para que registre "
                         f"tu entrada de hoy.")
     else:
         recordatorio = ""
-    return jsonify({
-        "ok": True, "duplicado": False, "nombre": emp["nombre"],
+    return {
+        "ok": True, "duplicado": False, "nombre": nombre,
         "tipo": tipo, "hora": hora,
         "mensaje": f"{tipo.capitalize()} registrada.",
         "recordatorio": recordatorio,
-    })
+    }, 200
+
+
+def _checkin_rechazado(motivo, mensaje):
+    _metricas.contar("nevox_checkin_total", resultado="rechazado", motivo=motivo)
+    return jsonify({"ok": False, "mensaje": mensaje}), 400
+
+
+@app.route("/api/checkin", methods=["POST"])
+def api_checkin():
+    data = request.get_json()
+    if not data:
+        return _checkin_rechazado("datos", "Datos invalidos.")
+    tqr = data.get("token_qr", "")
+    tdev = data.get("token_dispositivo", "")
+    if not qr_validar(tqr):
+        return _checkin_rechazado("qr", "QR expirado.")
+    if not tdev:
+        return _checkin_rechazado("dispositivo", "Dispositivo no registrado.")
+    emp_id = device_validar(tdev)
+    if not emp_id:
+        return _checkin_rechazado("token", "Token invalido.")
+
+    if CHECKIN_RPC or ALMACEN == "sqlite":
+        decision = db_checkin_rpc(emp_id, tdev, tqr, now_local())
+        _metricas.contar("nevox_checkin_total", resultado=decision["accion"],
+                         motivo=decision.get("motivo", ""))
+        cuerpo, status = _respuesta_checkin(decision.get("nombre", ""), decision)
+        return jsonify(cuerpo), status
+
+    emp = db_obtener_empleado(emp_id)
+    if not emp or not emp["activo"]:
+        return _checkin_rechazado("empleado", "Empleado no encontrado o inactivo.")
+    if emp["token_dispositivo"] != tdev:
+        return _checkin_rechazado("dispositivo", "Dispositivo no vinculado.")
+
+    # Una sola lectura con las marcas de hoy: sirve para el anti-rebote, para
+    # saber si la jornada ya esta completa y para decidir el tipo.
+    # La hora se toma despues de leerlas: tomada antes, una marca que otro
+    # escaneo guardo en el medio quedaba "en el futuro" y se saltaba el
+    # anti-rebote.
+    regs_hoy = db_registros_hoy_empleado(emp_id)
+    ahora = now_local()
+    decision = _ejecutar_checkin(emp_id, tqr, decidir_checkin(regs_hoy, ahora, db_ajustes(), DUPLICADO_MAX_MINUTOS),
+                                 ahora)
+    _metricas.contar("nevox_checkin_total", resultado=decision["accion"], motivo="")
+    cuerpo, status = _respuesta_checkin(emp["nombre"], decision)
+    return jsonify(cuerpo), status
 
 
 # --- DEVICE REGISTRATION ---
@@ -1283,6 +3888,56 @@ def api_admin_save_config():
     return jsonify({"ok": True, "mensaje": "Configuracion guardada."})
 
 
+@app.route("/api/admin/conexiones")
+@admin_required
+def api_admin_conexiones():
+    return jsonify(sb_pool_stats())
+
+
+@app.route("/api/admin/perfiles")
+@admin_required
+def api_admin_perfiles():
+    return jsonify({"perfiles": _listar_perfiles(), "modos": list(PERFIL_MODOS)})
+
+
+@app.route("/api/admin/perfiles/<nombre>")
+@admin_required
+def api_admin_perfil(nombre):
+    """Baja un perfil. ?formato=texto muestra un .pstats ya ordenado por tiempo
+    acumulado, para mirarlo sin herramientas."""
+    ruta = os.path.join(PERFIL_DIR, os.path.basename(nombre))
+    if not _PERFIL_NOMBRE.match(nombre) or not os.path.isfile(ruta):
+        return jsonify({"ok": False, "mensaje": "Perfil no encontrado."}), 404
+    if request.args.get("formato") == "texto" and nombre.endswith(".pstats"):
+        buf = io.StringIO()
+        pstats.Stats(ruta, stream=buf).sort_stats("cumulative").print_stats(60)
+        return Response(buf.getvalue(), mimetype="text/plain; charset=utf-8")
+    return send_file(ruta, as_attachment=True, download_name=nombre, mimetype="application/octet-stream")
+
+
+@app.route("/api/metrics")
+def api_metrics():
+    """Metricas de esta instancia para Prometheus. Entra el admin con su
+    sesion o un scraper con Authorization: Bearer METRICS_TOKEN."""
+    auth = request.headers.get("Authorization", "")
+    por_token = bool(METRICS_TOKEN) and hmac.compare_digest(auth.encode(), f"Bearer {METRICS_TOKEN}".encode())
+    if not (session.get("admin") or por_token):
+        return jsonify({"ok": False, "mensaje": "No autorizado."}), 401
+    pool = sb_pool_stats()
+    reportes = _cache_reportes.stats()
+    extras = [
+        ("nevox_inicio_segundos", "gauge", "Arranque de la instancia (epoch)", f"{_metricas.inicio:.0f}"),
+        ("nevox_hoy_registros", "gauge", "Registros de hoy en memoria", len(_hoy._filas)),
+        ("nevox_qr_franjas_en_cache", "gauge", "Franjas de QR ya generadas", len(_qr_cache)),
+        ("nevox_reportes_cache_resultados", "gauge", "Resultados de reportes en cache", reportes["resultados"]),
+        ("nevox_reportes_cache_filas", "gauge", "Filas de reportes en cache", reportes["filas"]),
+    ]
+    if "conexiones_abiertas" in pool:
+        extras.append(("nevox_supabase_conexiones_abiertas", "gauge",
+                       "Conexiones abiertas a Supabase", pool["conexiones_abiertas"]))
+    return Response(_metricas.texto(extras), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+
 # --- CORRECCION DE REGISTROS ---
 TIPOS_VALIDOS = ("entrada", "salida")
 
@@ -1309,11 +3964,12 @@ def api_admin_registros():
     desde = request.args.get("desde") or today_local().isoformat()
     hasta = request.args.get("hasta") or desde
     eid = request.args.get("empleado_id")
-    regs = db_registros_rango(desde, hasta, int(eid) if eid else None)
-    for r in regs:
-        loc = datetime.fromisoformat(r["fecha_hora"])
-        r["fecha_dia"] = loc.strftime("%Y-%m-%d")
-        r["hora_corta"] = loc.strftime("%H:%M")
+    regs = []
+    for m in db_iter_registros_rango(desde, hasta, int(eid) if eid else None):
+        r = m.a_dict()
+        r["fecha_dia"] = m.momento.date().isoformat()
+        r["hora_corta"] = m.momento.strftime("%H:%M")
+        regs.append(r)
     return jsonify({"registros": regs, "desde": desde, "hasta": hasta})
 
 
@@ -1431,11 +4087,50 @@ def api_reportes_retardos():
     return jsonify({
         "datos": datos,
         "sin_corregir": sin_corregir,
-        "tolerancia": int(db_get_config("tolerancia_minutos") or "15"),
+        "tolerancia": db_ajustes().tolerancia,
         "desde": desde, "hasta": hasta,
     })
 
 
+# Estilos del Excel. Se registran una vez por libro como estilos con nombre y
+# cada celda solo apunta al suyo: antes cada celda recibia su propio Font,
+# PatternFill y Border, y el libro entero vivia en memoria hasta el save.
+# El color de alerta va en ARGB explicito: es la marca que pidio el cliente,
+# no depende del relleno de canal alfa que haga openpyxl.
+ESTILO_FILA = {"grupo": "nx_grupo", "subtotal": "nx_subtotal", "alerta": "nx_alerta"}
+
+
+def _estilos_excel(wb):
+    from openpyxl.styles import Alignment, Border, Font, NamedStyle, PatternFill, Side
+    from openpyxl.styles.fonts import DEFAULT_FONT
+
+    def relleno(color):
+        return PatternFill(start_color=color, end_color=color, fill_type="solid")
+
+    lado = Side(style="thin", color="e0e0e2")
+    borde = Border(left=lado, right=lado, top=lado, bottom=lado)
+    estilos = (
+        NamedStyle("nx_titulo", font=Font(bold=True, size=14, color="1d120e")),
+        NamedStyle("nx_cabecera", font=Font(bold=True, color="FFFFFF", size=11), fill=relleno("ea8511"),
+                   alignment=Alignment(horizontal="center", vertical="center"), border=borde),
+        NamedStyle("nx_dato", font=DEFAULT_FONT, border=borde),
+        NamedStyle("nx_dato_par", font=DEFAULT_FONT, fill=relleno("f7f7f8"), border=borde),
+        NamedStyle("nx_grupo", font=Font(bold=True, size=12, color="1d120e"), fill=relleno("fef7ed"), border=borde),
+        NamedStyle("nx_subtotal", font=Font(bold=True, color="1d120e"), fill=relleno("f0f0f2"), border=borde),
+        NamedStyle("nx_alerta", font=Font(bold=True, color="FFDC2626"), fill=relleno("FFFEF2F2"), border=borde),
+    )
+    for estilo in estilos:
+        wb.add_named_style(estilo)
+
+
+def _celda(ws, valor, estilo):
+    from openpyxl.cell import WriteOnlyCell
+
+    cell = WriteOnlyCell(ws, value=valor)
+    cell.style = estilo
+    return cell
+
+
 # Hojas del Excel, en el orden en que se arman. Cada pestana de Reportes pide
 # la suya con ?hojas=...; sin el parametro salen las cuatro, que es lo que hace
 # la pestana "Exportar a Excel".
@@ -1444,125 +4139,130 @@ NOMBRE_HOJA = {"registros": "Registros", "extras": "Horas Extras",
                "retardos": "Retardos", "resumen": "Resumen"}
 
 
+MIME_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
 @app.route("/api/reportes/exportar-excel")
 def api_exportar_excel():
-    from openpyxl import Workbook
-    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-
+    """Con ?segundo_plano=1 no arma el libro aqui: devuelve un trabajo que se
+    consulta en /api/reportes/jobs/<id> (ver TRABAJOS DE EXPORTACION)."""
+    pedido = _pedido_excel()
+    if request.args.get("segundo_plano") == "1":
+        return _encolar_exporte(pedido) if EXPORTES_SEGUNDO_PLANO else _exporte_directo()
+    # El libro se guarda en un temporal anonimo y send_file lo manda por
+    # partes; el archivo se borra solo cuando Flask cierra la respuesta.
+    salida = tempfile.TemporaryFile()
+    nombre = _armar_excel(pedido, salida)
+    salida.seek(0)
+    return send_file(salida, as_attachment=True, download_name=nombre, mimetype=MIME_XLSX)
+
+
+def _pedido_excel():
+    """Los parametros del Excel ya normalizados: dos pedidos equivalentes dan
+    el mismo dict, y con el la misma clave de trabajo."""
     desde, hasta = _rango_args()
     eid = request.args.get("empleado_id")
-    if eid:
-        eid = int(eid)
-    area_filtro = request.args.get("departamento") or None
     pedidas = {h.strip() for h in (request.args.get("hojas") or "").split(",") if h.strip()}
     hojas = [h for h in HOJAS_EXCEL if h in pedidas] or list(HOJAS_EXCEL)
+    return {
+        "desde": desde, "hasta": hasta,
+        "empleado_id": int(eid) if eid else None,
+        "departamento": request.args.get("departamento") or None,
+        "hojas": hojas,
+        # Solo cambia algo si va la hoja de extras.
+        "solo_extras": "extras" in hojas and request.args.get("solo_extras", "1") == "1",
+    }
 
-    # Solo se consulta lo que se va a escribir: bajar una hoja no debe costar
-    # las cuatro consultas a Supabase.
-    regs = []
-    if "registros" in hojas:
-        regs = db_registros_rango(desde, hasta, eid)
-        if area_filtro:
-            regs = [r for r in regs if (r["departamento"] or SIN_AREA) == area_filtro]
+
+def _armar_excel(pedido, salida, avance=None):
+    """Escribe el libro pedido en `salida` (ruta o archivo) y devuelve el
+    nombre de descarga. avance(fraccion, etapa), si se pasa, se llama al
+    terminar las consultas y antes de cada hoja."""
+    from openpyxl import Workbook
+    from openpyxl.utils import get_column_letter
+
+    desde, hasta, eid = pedido["desde"], pedido["hasta"], pedido["empleado_id"]
+    area_filtro, hojas = pedido["departamento"], pedido["hojas"]
+    avance = avance or (lambda fraccion, etapa: None)
+
+    # Solo se consulta lo que se va a escribir. Con la hoja de retardos se
+    # bajan las marcas de todos aunque se pida un empleado: sin_corregir
+    # cuenta a toda la planta, como cuando salia de db_retardos. Los registros
+    # crudos no se juntan aqui: la hoja los pide ya ordenados mientras escribe.
     periodo = {"detalle": [], "resumen": [], "reglas": db_get_reglas_extras()}
-    if "extras" in hojas or "resumen" in hojas:
-        periodo = db_resumen_periodo(desde, hasta, eid, area_filtro)
     retardos, ret_sin_corregir = [], 0
-    if "retardos" in hojas:
-        retardos, ret_sin_corregir = db_retardos(desde, hasta, area_filtro)
-        if eid:
-            retardos = [r for r in retardos if r["empleado_id"] == eid]
-
-    hf = Font(bold=True, color="FFFFFF", size=11)
-    hfill = PatternFill(start_color="ea8511", end_color="ea8511", fill_type="solid")
-    tf = Font(bold=True, size=14, color="1d120e")
-    c = Alignment(horizontal="center", vertical="center")
-    b = Border(
-        left=Side(style="thin", color="e0e0e2"),
-        right=Side(style="thin", color="e0e0e2"),
-        top=Side(style="thin", color="e0e0e2"),
-        bottom=Side(style="thin", color="e0e0e2"),
-    )
-    af = PatternFill(start_color="f7f7f8", end_color="f7f7f8", fill_type="solid")
-    # Estilos por tipo de fila: cabecera de area, subtotal y retardo en rojo.
-    grupo_font = Font(bold=True, size=12, color="1d120e")
-    grupo_fill = PatternFill(start_color="fef7ed", end_color="fef7ed", fill_type="solid")
-    sub_font = Font(bold=True, color="1d120e")
-    sub_fill = PatternFill(start_color="f0f0f2", end_color="f0f0f2", fill_type="solid")
-    # ARGB explicito: es la marca que pidio el cliente, no depende del relleno
-    # de canal alfa que haga openpyxl.
-    rojo_font = Font(bold=True, color="FFDC2626")
-    rojo_fill = PatternFill(start_color="FFFEF2F2", end_color="FFFEF2F2", fill_type="solid")
+    if set(hojas) - {"registros"}:
+        p = _Periodo(desde, hasta, None if "retardos" in hojas else eid)
+        if "extras" in hojas or "resumen" in hojas:
+            periodo = p.resumen(eid, area_filtro)
+        if "retardos" in hojas:
+            retardos, ret_sin_corregir = p.retardos(area_filtro)
+            if eid:
+                retardos = [r for r in retardos if r["empleado_id"] == eid]
+    t_excel = time.perf_counter()
+
+    wb = Workbook(write_only=True)
+    _estilos_excel(wb)
+    hechas = []
+
+    def nueva_hoja(hoja):
+        # Las consultas son la primera mitad del trabajo; las hojas, el resto.
+        avance(0.5 + 0.5 * len(hechas) / len(hojas), NOMBRE_HOJA[hoja])
+        hechas.append(hoja)
+        return wb.create_sheet(NOMBRE_HOJA[hoja])
 
     def armar_hoja(ws, titulo, cabeceras, filas, anchos):
-        """filas: lista de dicts {"tipo": grupo|dato|alerta|subtotal, "vals": [...]}"""
-        ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=len(cabeceras))
-        ws.cell(row=1, column=1, value=titulo).font = tf
-        for col, h in enumerate(cabeceras, 1):
-            cell = ws.cell(row=3, column=col, value=h)
-            cell.font = hf
-            cell.fill = hfill
-            cell.alignment = c
-            cell.border = b
+        """filas: iterable de dicts {"tipo": grupo|dato|alerta|subtotal, "vals": [...]}.
+        En modo solo escritura cada fila sale al disco al hacer append, asi
+        que anchos, congelado y fusiones se declaran antes o al paso."""
+        n = len(cabeceras)
+        ws.freeze_panes = "A4"
+        for col, ancho in enumerate(anchos, 1):
+            ws.column_dimensions[get_column_letter(col)].width = ancho
+        ultima = get_column_letter(n)
+        ws.merged_cells.add(f"A1:{ultima}1")
+        ws.append([_celda(ws, titulo, "nx_titulo")])
+        ws.append([])
+        ws.append([_celda(ws, h, "nx_cabecera") for h in cabeceras])
         for i, fila in enumerate(filas, 4):
             tipo = fila["tipo"]
-            for col in range(1, len(cabeceras) + 1):
-                val = fila["vals"][col - 1] if col <= len(fila["vals"]) else None
-                cell = ws.cell(row=i, column=col, value=val)
-                cell.border = b
-                if tipo == "grupo":
-                    cell.font = grupo_font
-                    cell.fill = grupo_fill
-                elif tipo == "subtotal":
-                    cell.font = sub_font
-                    cell.fill = sub_fill
-                elif tipo == "alerta":
-                    cell.font = rojo_font
-                    cell.fill = rojo_fill
-                elif i % 2 == 0:
-                    cell.fill = af
-            # El merge va despues de escribir: openpyxl deja de solo lectura
-            # las celdas fusionadas que no son la superior izquierda.
+            estilo = ESTILO_FILA.get(tipo) or ("nx_dato_par" if i % 2 == 0 else "nx_dato")
+            vals = fila["vals"]
+            ws.append([_celda(ws, vals[k] if k < len(vals) else None, estilo) for k in range(n)])
             if tipo == "grupo":
-                ws.merge_cells(start_row=i, start_column=1, end_row=i, end_column=len(cabeceras))
-        ws.freeze_panes = "A4"
-        for col, ancho in enumerate(anchos, 1):
-            ws.column_dimensions[ws.cell(row=3, column=col).column_letter].width = ancho
+                ws.merged_cells.add(f"A{i}:{ultima}{i}")
 
     def agrupar(items, vals_fn, subtotal_fn=None, alerta_fn=None):
         """Convierte items (ya ordenados por area) en filas con cabecera de
-        area y, opcionalmente, una fila de subtotal por area."""
-        filas, area_actual, grupo = [], None, []
+        area y, opcionalmente, una fila de subtotal por area. Es un generador:
+        cada fila se arma cuando la hoja la escribe."""
+        area_actual, grupo = None, []
         for it in items:
             area = it.get("departamento") or SIN_AREA
             if area != area_actual:
                 if grupo and subtotal_fn:
-                    filas.append({"tipo": "subtotal", "vals": subtotal_fn(area_actual, grupo)})
+                    yield {"tipo": "subtotal", "vals": subtotal_fn(area_actual, grupo)}
                 area_actual, grupo = area, []
-                filas.append({"tipo": "grupo", "vals": [f"AREA: {area}"]})
+                yield {"tipo": "grupo", "vals": [f"AREA: {area}"]}
             grupo.append(it)
-            filas.append({
+            yield {
                 "tipo": "alerta" if (alerta_fn and alerta_fn(it)) else "dato",
                 "vals": vals_fn(it),
-            })
+            }
         if grupo and subtotal_fn:
-            filas.append({"tipo": "subtotal", "vals": subtotal_fn(area_actual, grupo)})
-        return filas
+            yield {"tipo": "subtotal", "vals": subtotal_fn(area_actual, grupo)}
 
-    wb = Workbook()
-    wb.remove(wb.active)  # las hojas se crean abajo, solo las pedidas
 
     # --- Hoja 1: registros crudos, agrupados por area ---
     if "registros" in hojas:
-        regs_ord = sorted(regs, key=lambda r: ((r["departamento"] or SIN_AREA), r["nombre"], r["fecha_hora"]))
         armar_hoja(
-            wb.create_sheet(NOMBRE_HOJA["registros"]),
+            nueva_hoja("registros"),
             f"NEVOX FARMA - Registros {desde} al {hasta}",
             ["Fecha", "Hora", "Empleado", "Area", "Tipo"],
-            agrupar(regs_ord, lambda r: [
-                datetime.fromisoformat(r["fecha_hora"]).strftime("%Y-%m-%d"),
-                datetime.fromisoformat(r["fecha_hora"]).strftime("%H:%M:%S"),
-                r["nombre"], r["departamento"] or SIN_AREA, r["tipo"].upper(),
+            agrupar(db_iter_registros_por_area(desde, hasta, eid, area_filtro), lambda m: [
+                m.momento.date().isoformat(),
+                m.momento.strftime("%H:%M:%S"),
+                m.nombre, m.departamento or SIN_AREA, m.tipo.upper(),
             ]),
             [14, 12, 28, 22, 12],
         )
@@ -1580,10 +4280,10 @@ def api_exportar_excel():
         # Igual que la pestana: por defecto solo los dias con extra o por
         # revisar, pero si se destildo la casilla van todos los dias.
         detalle_ext = periodo["detalle"]
-        if request.args.get("solo_extras", "1") == "1":
+        if pedido["solo_extras"]:
             detalle_ext = [d for d in detalle_ext if d["extra_bruto_min"] > 0 or d["revisar"]]
         armar_hoja(
-            wb.create_sheet(NOMBRE_HOJA["extras"]),
+            nueva_hoja("extras"),
             f"NEVOX FARMA - Horas extras {desde} al {hasta} "
             f"(minimo {periodo['reglas']['minimo']} min, redondeo {periodo['reglas']['redondeo']} min)",
             ["Empleado", "Area", "Fecha", "Dia", "Entrada", "Salida",
@@ -1609,10 +4309,10 @@ def api_exportar_excel():
 
     # --- Hoja 3: retardos, con la fila en rojo cuando excede la tolerancia ---
     if "retardos" in hojas:
-        tol = int(db_get_config("tolerancia_minutos") or "15")
+        tol = db_ajustes().tolerancia
         retardos_ord = sorted(retardos, key=lambda r: (r["departamento"], r["nombre"], r["fecha"]))
         armar_hoja(
-            wb.create_sheet(NOMBRE_HOJA["retardos"]),
+            nueva_hoja("retardos"),
             f"NEVOX FARMA - Retardos {desde} al {hasta} (tolerancia {tol} min; "
             f"en rojo los que la exceden)"
             + (f" - {ret_sin_corregir} dia(s) excluidos por marcas sin corregir"
@@ -1639,7 +4339,7 @@ def api_exportar_excel():
     # --- Hoja 4: resumen por empleado ---
     if "resumen" in hojas:
         armar_hoja(
-            wb.create_sheet(NOMBRE_HOJA["resumen"]),
+            nueva_hoja("resumen"),
             f"NEVOX FARMA - Resumen {desde} al {hasta}",
             ["Empleado", "Area", "Horas trabajadas", "Horas extras",
              "Extras dias habiles", "Extras fin de semana", "Dias con extra",
@@ -1664,12 +4364,288 @@ def api_exportar_excel():
             [26, 20, 18, 14, 18, 20, 16, 16],
         )
 
-    buf = BytesIO()
-    wb.save(buf)
-    buf.seek(0)
+    wb.save(salida)
+    _sumar_fase("excel", time.perf_counter() - t_excel)
     nombre = hojas[0] if len(hojas) == 1 else "registros"
-    return send_file(
-        buf, as_attachment=True,
-        download_name=f"{nombre}_{desde}_{hasta}.xlsx",
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    return f"{nombre}_{desde}_{hasta}.xlsx"
+
+
+# ------------------------------------------------------------
+# TRABAJOS DE EXPORTACION
+# Un Excel de muchos meses puede pasarse del limite de tiempo de la funcion,
+# y el usuario reintenta, con lo que la carga se duplica. Con ?segundo_plano=1
+# el pedido responde al momento con un id: un hilo de _exportes_pool arma el
+# libro y /api/reportes/jobs/<id> dice en que va y, al terminar, sirve el
+# archivo. El id sale de los parametros normalizados, asi que repetir el
+# pedido engancha al trabajo en curso o reusa el archivo ya armado mientras
+# siga vigente. Deja de estarlo si los datos cambiaron despues de empezar
+# (marcas corregidas, empleados o configuracion: _datos_cambiaron), si el
+# rango llegaba a hoy y pasaron EXPORTES_TTL_HOY segundos (siguen entrando
+# marcas), o pasado EXPORTES_VIDA, cuando ademas se borra. Estado y archivos
+# van en disco local, en EXPORTES_DIR, asi que cada proceso tiene los suyos
+# y si el sondeo cae en otro recibe 404 y el cliente vuelve a pedir.
+#
+# El modo en segundo plano necesita un proceso que siga vivo despues de
+# responder: on-prem (ALMACEN=sqlite en la oficina, o un servidor propio
+# contra Supabase). En Vercel la funcion se congela al mandar la respuesta y
+# el hilo que arma el libro no avanza, asi que ahi (variable VERCEL, que pone
+# la plataforma) EXPORTES_SEGUNDO_PLANO queda apagado: ?segundo_plano=1
+# contesta "listo" con la URL del Excel sin ese parametro, y el libro se arma
+# dentro de la descarga como antes.
+# ------------------------------------------------------------
+EXPORTES_SEGUNDO_PLANO = os.environ.get(
+    "EXPORTES_SEGUNDO_PLANO", "0" if os.environ.get("VERCEL") else "1") == "1"
+EXPORTES_DIR = os.environ.get("EXPORTES_DIR", "/tmp/nevox-exportes")
+EXPORTES_HILOS = int(os.environ.get("EXPORTES_HILOS", "2"))
+EXPORTES_TTL_HOY = int(os.environ.get("EXPORTES_TTL_HOY", "120"))  # segundos
+EXPORTES_VIDA = int(os.environ.get("EXPORTES_VIDA", "3600"))       # segundos
+_TRABAJO_ID = re.compile(r"^[0-9a-f]{20}$")
+_MARCA_DATOS = "datos-cambiaron"  # su mtime es el ultimo cambio de datos
+
+_exportes_lock = threading.Lock()
+_exportes_activos = set()  # ids que esta armando este proceso
+_exportes_pool = ThreadPoolExecutor(max_workers=EXPORTES_HILOS, thread_name_prefix="exporte")
+log_exportes = logging.getLogger("nevox.exportes")
+
+
+def _ruta_exporte(tid, ext):
+    return os.path.join(EXPORTES_DIR, f"{tid}.{ext}")
+
+
+def _leer_trabajo(tid):
+    try:
+        with open(_ruta_exporte(tid, "json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _guardar_trabajo(t):
+    # Se escribe aparte y se renombra: quien consulta nunca lee un json a medias.
+    ruta = _ruta_exporte(t["id"], "json")
+    tmp = f"{ruta}.{threading.get_ident()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(t, f)
+    os.replace(tmp, ruta)
+
+
+def _trabajo_vigente(t):
+    if t is None or t["estado"] == "error":
+        return False
+    if t["estado"] != "listo":
+        # Si no lo arma este proceso, quedo huerfano (la instancia se
+        # reinicio a mitad) y no va a terminar nunca.
+        return t["id"] in _exportes_activos
+    try:
+        cambio = os.path.getmtime(os.path.join(EXPORTES_DIR, _MARCA_DATOS))
+    except OSError:
+        cambio = 0
+    edad = time.time() - t["iniciado"]
+    if t["iniciado"] <= cambio or edad > EXPORTES_VIDA:
+        return False
+    if t["pedido"]["hasta"] >= t["hoy"] and edad > EXPORTES_TTL_HOY:
+        return False
+    return os.path.isfile(_ruta_exporte(t["id"], "xlsx"))
+
+
+def _podar_exportes():
+    limite = time.time() - EXPORTES_VIDA
+    for nombre in os.listdir(EXPORTES_DIR):
+        ruta = os.path.join(EXPORTES_DIR, nombre)
+        if nombre == _MARCA_DATOS or nombre.split(".")[0] in _exportes_activos:
+            continue
+        try:
+            if os.path.getmtime(ruta) < limite:
+                os.remove(ruta)
+        except OSError:
+            pass
+
+
+def _vista_trabajo(t):
+    v = {k: t[k] for k in ("id", "estado", "progreso", "etapa", "mensaje")}
+    v["ok"] = t["estado"] != "error"
+    v["url"] = f"/api/reportes/jobs/{t['id']}"
+    if t["estado"] == "listo":
+        v["archivo"] = f"{v['url']}/archivo"
+    return v
+
+
+def _exporte_directo():
+    """Respuesta de trabajo para cuando no hay segundo plano: ya "listo", y el
+    archivo es el mismo pedido armado en la descarga."""
+    args = {k: v for k, v in request.args.items() if k != "segundo_plano"}
+    return jsonify({
+        "id": None, "estado": "listo", "progreso": 1.0, "etapa": "", "mensaje": "", "ok": True,
+        "url": None, "archivo": url_for("api_exportar_excel", **args),
+    })
+
+
+def _encolar_exporte(pedido):
+    tid = hashlib.sha256(json.dumps(pedido, sort_keys=True).encode()).hexdigest()[:20]
+    with _exportes_lock:
+        t = _leer_trabajo(tid)
+        if not _trabajo_vigente(t):
+            os.makedirs(EXPORTES_DIR, exist_ok=True)
+            _podar_exportes()
+            t = {
+                "id": tid, "estado": "en_cola", "progreso": 0.0, "etapa": "", "mensaje": "",
+                "pedido": pedido, "hoy": today_local().isoformat(), "iniciado": time.time(),
+                "archivo": None,
+            }
+            _guardar_trabajo(t)
+            _exportes_activos.add(tid)
+            _exportes_pool.submit(_correr_exporte, t)
+    return jsonify(_vista_trabajo(t)), 200 if t["estado"] == "listo" else 202
+
+
+def _correr_exporte(t):
+    def avance(fraccion, etapa):
+        t.update(estado="armando", progreso=round(fraccion, 2), etapa=etapa)
+        _guardar_trabajo(t)
+
+    ruta = _ruta_exporte(t["id"], "xlsx")
+    parcial = f"{ruta}.parcial"
+    try:
+        avance(0.0, "consultas")
+        with open(parcial, "wb") as salida:
+            t["archivo"] = _armar_excel(t["pedido"], salida, avance)
+        os.replace(parcial, ruta)
+        t.update(estado="listo", progreso=1.0, etapa="")
+    except Exception as e:
+        # Al log va la traza completa; en el trabajo, que lo lee el navegador,
+        # solo el mensaje corto.
+        log_exportes.exception("exporte %s fallo", t["id"])
+        t.update(estado="error", mensaje=f"{type(e).__name__}: {e}")
+    finally:
+        _guardar_trabajo(t)
+        with _exportes_lock:
+            _exportes_activos.discard(t["id"])
+
+
+@app.route("/api/reportes/jobs/<tid>")
+def api_trabajo_exporte(tid):
+    t = _leer_trabajo(tid) if _TRABAJO_ID.match(tid) else None
+    if t is None:
+        return jsonify({"ok": False, "mensaje": "Trabajo no encontrado."}), 404
+    return jsonify(_vista_trabajo(t))
+
+
+@app.route("/api/reportes/jobs/<tid>/archivo")
+def api_trabajo_archivo(tid):
+    t = _leer_trabajo(tid) if _TRABAJO_ID.match(tid) else None
+    if t is None or t["estado"] != "listo" or not os.path.isfile(_ruta_exporte(tid, "xlsx")):
+        return jsonify({"ok": False, "mensaje": "Archivo no disponible."}), 404
+    return send_file(_ruta_exporte(tid, "xlsx"), as_attachment=True,
+                     download_name=t["archivo"], mimetype=MIME_XLSX)
+
+
+# ------------------------------------------------------------
+# EXPORTACION PLANA (CSV / NDJSON)
+# Las planillas solo necesitan los datos, sin areas ni subtotales, y openpyxl
+# es lo mas lento del Excel. /api/reportes/exportar da las mismas hojas que
+# HOJAS_EXCEL, una por pedido, y las manda fila por fila: la descarga empieza
+# con la cabecera y los registros crudos salen pagina por pagina, sin juntar
+# el rango entero. Por eso los registros van en orden de hora y no por area
+# como en el Excel. Las demas hojas salen de un _Periodo, que igual calcula
+# todo el rango antes de la primera fila.
+# ------------------------------------------------------------
+FORMATOS_EXPORTAR = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+COLUMNAS_EXPORTAR = {
+    "registros": ("id", "empleado_id", "nombre", "departamento", "fecha", "hora", "tipo"),
+    "extras": ("empleado_id", "nombre", "departamento", "fecha", "dia", "entrada", "salida",
+               "entrada_programada", "salida_programada", "horas_trabajadas", "extra_bruto_min",
+               "extra_min", "extra_horas", "no_laboral", "incompleto", "revisar", "motivo"),
+    "retardos": ("empleado_id", "nombre", "departamento", "fecha", "dia", "hora_programada",
+                 "hora_registro", "minutos_tarde", "con_tolerancia"),
+    "resumen": ("empleado_id", "nombre", "departamento", "horas", "extras_horas",
+                "extras_habil_horas", "extras_no_laboral_horas", "dias_con_extra", "dias_incompletos"),
+}
+EXPORTAR_LOTE = 500  # filas por trozo de la respuesta
+
+
+def _filas_exportar(hoja, desde, hasta, eid, area, solo_extras):
+    """Filas (dicts) de una hoja, con los mismos filtros que el Excel."""
+    if hoja == "registros":
+        for m in db_iter_registros_rango(desde, hasta, eid):
+            dep = m.departamento or SIN_AREA
+            if area and dep != area:
+                continue
+            yield {
+                "id": m.id, "empleado_id": m.empleado_id, "nombre": m.nombre,
+                "departamento": dep, "fecha": m.momento.date().isoformat(),
+                "hora": m.momento.strftime("%H:%M:%S"), "tipo": m.tipo,
+            }
+        return
+    if hoja == "retardos":
+        # Con todos los empleados, como en el Excel: sin_corregir y el mapa
+        # de activos no dependen del empleado pedido.
+        retardos, _ = _Periodo(desde, hasta).retardos(area)
+        yield from sorted(
+            (r for r in retardos if not eid or r["empleado_id"] == eid),
+            key=lambda r: (r["departamento"], r["nombre"], r["fecha"]),
+        )
+        return
+    periodo = _Periodo(desde, hasta, eid).resumen(eid, area)
+    if hoja == "resumen":
+        yield from periodo["resumen"]
+    elif solo_extras:
+        yield from (d for d in periodo["detalle"] if d["extra_bruto_min"] > 0 or d["revisar"])
+    else:
+        yield from periodo["detalle"]
+
+
+def _exportar_csv(columnas, filas):
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(columnas)
+    yield _vaciar(buf)
+    n = 0
+    for f in filas:
+        w.writerow([f[c] for c in columnas])
+        n += 1
+        if n % EXPORTAR_LOTE == 0:
+            yield _vaciar(buf)
+    yield _vaciar(buf)
+
+
+def _exportar_ndjson(columnas, filas):
+    lote = []
+    for f in filas:
+        lote.append(json.dumps({c: f[c] for c in columnas}, ensure_ascii=False))
+        if len(lote) == EXPORTAR_LOTE:
+            yield "\n".join(lote) + "\n"
+            lote = []
+    if lote:
+        yield "\n".join(lote) + "\n"
+
+
+def _vaciar(buf):
+    texto = buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    return texto
+
+
+@app.route("/api/reportes/exportar")
+def api_exportar():
+    formato = request.args.get("formato", "csv")
+    hoja = request.args.get("hoja", "registros")
+    if formato not in FORMATOS_EXPORTAR or hoja not in HOJAS_EXCEL:
+        return jsonify({
+            "ok": False,
+            "mensaje": f"formato: {', '.join(FORMATOS_EXPORTAR)}; hoja: {', '.join(HOJAS_EXCEL)}.",
+        }), 400
+    desde, hasta = _rango_args()
+    eid = request.args.get("empleado_id")
+    eid = int(eid) if eid else None
+    area = request.args.get("departamento") or None
+    filas = _filas_exportar(hoja, desde, hasta, eid, area, request.args.get("solo_extras", "1") == "1")
+    escribir = _exportar_csv if formato == "csv" else _exportar_ndjson
+    return Response(
+        stream_with_context(escribir(COLUMNAS_EXPORTAR[hoja], filas)),
+        mimetype=FORMATOS_EXPORTAR[formato],
+        headers={
+            "Content-Disposition": f'attachment; filename="{hoja}_{desde}_{hasta}.{formato}"',
+            "X-Accel-Buffering": "no",
+        },
     )
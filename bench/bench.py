@@ -0,0 +1,330 @@
+"""
+NEVOX FARMA - Benchmark de los endpoints contra el Supabase falso.
+
+Maneja la app con app.test_client() sobre fake_supabase, con una empresa
+sembrada de N empleados y D dias de marcas hacia atras desde hoy, y mide por
+endpoint: latencia (primera llamada en frio, p50 y p99 del resto), llamadas a
+Supabase por peticion, bytes en cada sentido y pico de memoria de Python.
+
+    python bench/bench.py
+    python bench/bench.py --empleados 500 --dias 1,30 --latencia 0.03
+    python bench/bench.py --solo checkin,reportes-horas --comparar bench/resultados/antes.json
+
+Cada corrida se guarda en bench/resultados/AAAAMMDD-HHMMSS.json; con
+--comparar se muestra la diferencia contra otra corrida para los mismos
+(escenario, empleados, dias). Con --latencia 0 se mide solo el CPU de la app;
+con la latencia real de Vercel a Supabase (30-60 ms) pesa sobre todo el
+numero de llamadas. Con --rollups los reportes leen jornadas_dia (ROLLUPS=1):
+la primera llamada llena las fechas pasadas y el resto las lee ya calculadas.
+La cache de resultados de reportes (REPORTES_CACHE) va apagada para medir el
+calculo; con --cache-reportes se prende y las llamadas en caliente son hits.
+Con --almacen sqlite la app corre sobre su base SQLite local (ALMACEN=sqlite)
+en vez del Supabase falso; ahi "sb" cuenta las consultas a SQLite y no hay
+bytes de red.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+AQUI = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(AQUI, "..", "api"), AQUI]
+
+import index  # noqa: E402
+from fake_supabase import FakeSupabase  # noqa: E402
+from sqlite_local import SqliteLocal  # noqa: E402
+
+DEPARTAMENTOS = ["Ventas", "Almacen", "Farmacia", "Administracion", "Reparto", ""]
+RESULTADOS = os.path.join(AQUI, "resultados")
+
+
+# ------------------------------------------------------------
+# DATOS DE PRUEBA
+# Dias laborales segun el horario por defecto: llegada alrededor de las 7:00,
+# salida unos minutos despues de la programada, algun ausente, algun olvido de
+# la salida y uno que otro que trabaja el fin de semana. Hoy solo tiene las
+# marcas que ya habrian ocurrido a esta hora.
+# ------------------------------------------------------------
+
+def preparar(latencia=0.0, jitter=0.0, max_rows=1000, reloj=None, semilla=1, almacen="supabase"):
+    """(fake, cliente con sesion de admin) con la app apuntando al fake, o a
+    una base SQLite nueva con almacen="sqlite"."""
+    # La traza sigue activa (su costo entra en la medicion) pero sin log.
+    index.log_traza.setLevel(logging.WARNING)
+    if almacen == "sqlite":
+        fake = SqliteLocal(latencia=latencia, jitter=jitter, reloj=reloj, semilla=semilla).instalar(index)
+    else:
+        fake = FakeSupabase(latencia=latencia, jitter=jitter, max_rows=max_rows,
+                            reloj=reloj, semilla=semilla).instalar(index)
+    cliente = index.app.test_client()
+    with cliente.session_transaction() as s:
+        s["admin"] = True
+    return fake, cliente
+
+
+def _utc(dia, minutos):
+    local = datetime(dia.year, dia.month, dia.day, tzinfo=index.LOCAL_TZ) + timedelta(minutes=minutos)
+    return local.astimezone(timezone.utc).isoformat()
+
+
+def sembrar_empresa(fake, empleados, dias, ahora=None, semilla=1):
+    """Siembra empleados con dispositivo vinculado y sus marcas. Devuelve la
+    lista de empleados (con token_dispositivo)."""
+    azar = random.Random(semilla)
+    ahora = ahora or index.now_local()
+    emps = fake.sembrar("empleados", [
+        {"nombre": f"EMPLEADO {i:05d}", "departamento": DEPARTAMENTOS[i % len(DEPARTAMENTOS)]}
+        for i in range(1, empleados + 1)
+    ])
+    for e in emps:
+        e["token_dispositivo"] = index.device_token(e["id"])
+    # De nuevo con el token: en la base SQLite sembrar devuelve copias.
+    fake.sembrar("empleados", emps)
+
+    horario = index.normalizar_horario(index.HORARIO_SEMANAL_DEFAULT)
+    minuto_actual = ahora.hour * 60 + ahora.minute
+    filas = []
+    for atras in range(dias - 1, -1, -1):
+        dia = ahora.date() - timedelta(days=atras)
+        turno = horario[str(dia.weekday())]
+        del_dia = []
+        for e in emps:
+            if turno is None and azar.random() > 0.03:
+                continue
+            if turno is not None and azar.random() < 0.05:
+                continue
+            base_ent = index._minutos_del_dia(turno["entrada"]) if turno else 8 * 60
+            base_sal = index._minutos_del_dia(turno["salida"]) if turno else 13 * 60
+            ent = int(azar.gauss(base_ent - 2, 8))
+            sal = int(azar.gauss(base_sal + 20, 25))
+            marcas = [(ent, "entrada")]
+            if azar.random() > 0.04:
+                marcas.append((sal, "salida"))
+            for minuto, tipo in marcas:
+                if atras == 0 and minuto > minuto_actual:
+                    continue
+                del_dia.append((minuto, azar.random(), e["id"], tipo))
+        del_dia.sort()
+        filas.extend({
+            "empleado_id": eid, "tipo": tipo, "fecha_hora": _utc(dia, minuto + seg),
+            "token_usado": "bench",
+        } for minuto, seg, eid, tipo in del_dia)
+    fake.sembrar("registros", filas)
+    return emps
+
+
+# ------------------------------------------------------------
+# ESCENARIOS
+# Cada uno arma la peticion i-esima: (metodo, url, json).
+# ------------------------------------------------------------
+
+def _escenarios(emps, dias):
+    hoy = index.today_local()
+    rango = f"desde={(hoy - timedelta(days=dias - 1)).isoformat()}&hasta={hoy.isoformat()}"
+    estado = {"cursor": None}
+
+    def checkin(i):
+        e = emps[i % len(emps)]
+        return "POST", "/api/checkin", {"token_qr": index.qr_token(),
+                                        "token_dispositivo": e["token_dispositivo"]}
+
+    def delta(i):
+        if estado["cursor"] is None:
+            estado["cursor"] = index._datos_registros_hoy()["cursor"]
+        return "GET", f"/api/registros-hoy?since={estado['cursor']}", None
+
+    return {
+        "checkin": checkin,
+        "registros-hoy": lambda i: ("GET", "/api/registros-hoy", None),
+        "registros-hoy-delta": delta,
+        "pendientes-hoy": lambda i: ("GET", "/api/pendientes-hoy", None),
+        "reportes-areas": lambda i: ("GET", "/api/reportes/areas", None),
+        "reportes-horas": lambda i: ("GET", f"/api/reportes/horas?{rango}", None),
+        "reportes-horas-extras": lambda i: ("GET", f"/api/reportes/horas-extras?{rango}", None),
+        "reportes-retardos": lambda i: ("GET", f"/api/reportes/retardos?{rango}", None),
+        "exportar-excel": lambda i: ("GET", f"/api/reportes/exportar-excel?{rango}", None),
+        "exportar-csv": lambda i: ("GET", f"/api/reportes/exportar?{rango}&hoja=registros&formato=csv", None),
+        "exportar-ndjson": lambda i: ("GET", f"/api/reportes/exportar?{rango}&hoja=extras&formato=ndjson", None),
+    }
+
+
+def _limpiar_caches():
+    index.db_invalidar_ajustes()
+    index._hoy.invalidar()
+    index._qr_cache.clear()
+    index._cache_reportes.cambio()
+
+
+def _llamar(cliente, peticion):
+    metodo, url, cuerpo = peticion
+    # El cuerpo se lee entero: en las respuestas en streaming el tiempo medido
+    # incluye generarlo, y el generador se cierra dentro de su peticion.
+    r = cliente.open(url, method=metodo, json=cuerpo)
+    r.get_data()
+    r.close()
+    return r
+
+
+def _percentil(valores, p):
+    orden = sorted(valores)
+    return orden[min(len(orden) - 1, int(round(p / 100 * (len(orden) - 1))))]
+
+
+def medir(fake, cliente, nombre, armar, repeticiones, segundos):
+    """Primera llamada con los caches vacios, luego hasta `repeticiones` (o
+    `segundos`) llamadas en caliente y una ultima bajo tracemalloc."""
+    _limpiar_caches()
+    tiempos, llamadas, recibidos, enviados, status = [], [], [], [], Counter()
+    limite = time.perf_counter() + segundos
+    for i in range(repeticiones + 1):
+        peticion = armar(i)
+        antes = fake.stats()
+        t0 = time.perf_counter()
+        r = _llamar(cliente, peticion)
+        tiempos.append((time.perf_counter() - t0) * 1000)
+        despues = fake.stats()
+        status[r.status_code] += 1
+        llamadas.append(despues["llamadas"] - antes["llamadas"])
+        recibidos.append(despues["bytes_recibidos"] - antes["bytes_recibidos"])
+        enviados.append(despues["bytes_enviados"] - antes["bytes_enviados"])
+        if i >= 3 and time.perf_counter() > limite:
+            break
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    _llamar(cliente, armar(len(tiempos)))
+    pico = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    calientes = tiempos[1:] or tiempos
+    return {
+        "escenario": nombre,
+        "n": len(calientes),
+        "primera_ms": round(tiempos[0], 2),
+        "p50_ms": round(_percentil(calientes, 50), 2),
+        "p99_ms": round(_percentil(calientes, 99), 2),
+        "sb_llamadas": round(sum(llamadas[1:] or llamadas) / len(calientes), 2),
+        "sb_llamadas_primera": llamadas[0],
+        "bytes_recibidos": round(sum(recibidos) / len(recibidos)),
+        "bytes_enviados": round(sum(enviados) / len(enviados)),
+        "pico_kb": round(pico / 1024),
+        "status": {str(k): v for k, v in sorted(status.items())},
+    }
+
+
+def _clave(r):
+    return (r["escenario"], r["empleados"], r["dias"])
+
+
+def _encabezado():
+    print(f"{'escenario':24} {'emp':>5} {'dias':>4} {'1a ms':>9} {'p50 ms':>9} {'p99 ms':>9} "
+          f"{'sb':>6} {'rx KB':>8} {'pico KB':>8}  status")
+
+
+def _imprimir(resultados, previos=None):
+    previos = {_clave(r): r for r in (previos or [])}
+    for r in resultados:
+        linea = (f"{r['escenario']:24} {r['empleados']:>5} {r['dias']:>4} {r['primera_ms']:>9.1f} "
+                 f"{r['p50_ms']:>9.1f} {r['p99_ms']:>9.1f} {r['sb_llamadas']:>6} "
+                 f"{r['bytes_recibidos'] / 1024:>8.1f} {r['pico_kb']:>8}  {r['status']}")
+        previo = previos.get(_clave(r))
+        if previo:
+            linea += (f"  | p50 x{r['p50_ms'] / max(previo['p50_ms'], 0.01):.2f}"
+                      f" sb {previo['sb_llamadas']}->{r['sb_llamadas']}")
+        print(linea)
+    if any(r.get("truncadas") for r in resultados):
+        print("\nOjo: hubo lecturas cortadas por max_rows (columna 'truncadas' en el JSON).")
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=AQUI,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def _lista(texto, tipo=str):
+    return [tipo(x) for x in texto.split(",") if x.strip()]
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--empleados", default="50,500,5000", help="lista, p. ej. 50,500")
+    ap.add_argument("--dias", default="1,30,365", help="lista, p. ej. 1,7,30")
+    ap.add_argument("--solo", default="", help="escenarios a correr, separados por coma")
+    ap.add_argument("--repeticiones", type=int, default=20)
+    ap.add_argument("--segundos", type=float, default=20, help="tope de tiempo por escenario")
+    ap.add_argument("--latencia", type=float, default=0.0, help="segundos por llamada a Supabase")
+    ap.add_argument("--jitter", type=float, default=0.0, help="segundos extra aleatorios por llamada")
+    ap.add_argument("--max-rows", type=int, default=1000, help="tope de filas por lectura (max-rows de PostgREST)")
+    ap.add_argument("--max-filas", type=int, default=600_000,
+                    help="omite combinaciones que sembrarian mas registros que esto")
+    ap.add_argument("--salida", default="", help="archivo JSON de resultados")
+    ap.add_argument("--comparar", default="", help="JSON de una corrida anterior")
+    ap.add_argument("--rollups", action="store_true", help="reportes sobre jornadas_dia (ROLLUPS=1)")
+    ap.add_argument("--cache-reportes", action="store_true", help="con la cache de resultados de reportes")
+    ap.add_argument("--almacen", choices=("supabase", "sqlite"), default="supabase",
+                    help="Supabase falso o la base SQLite local de la app")
+    args = ap.parse_args(argv)
+    index.ROLLUPS = args.rollups
+    index.REPORTES_CACHE = args.cache_reportes
+
+    solo = set(_lista(args.solo))
+    resultados = []
+    for n_emp in _lista(args.empleados, int):
+        for n_dias in _lista(args.dias, int):
+            # ~0.95 marcas por empleado y dia laboral, dos por jornada.
+            estimadas = int(n_emp * n_dias * 5 / 7 * 2 * 0.95)
+            if estimadas > args.max_filas:
+                print(f"-- omitido {n_emp} empleados x {n_dias} dias (~{estimadas} registros > --max-filas)")
+                continue
+            fake, cliente = preparar(args.latencia, args.jitter, args.max_rows, almacen=args.almacen)
+            t0 = time.perf_counter()
+            emps = sembrar_empresa(fake, n_emp, n_dias)
+            print(f"-- {n_emp} empleados x {n_dias} dias: "
+                  f"{fake.contar('registros')} registros sembrados en {time.perf_counter() - t0:.1f}s")
+            _encabezado()
+            for nombre, armar in _escenarios(emps, n_dias).items():
+                if solo and nombre not in solo:
+                    continue
+                truncadas = fake.stats()["truncadas"]
+                r = medir(fake, cliente, nombre, armar, args.repeticiones, args.segundos)
+                r.update(empleados=n_emp, dias=n_dias, truncadas=fake.stats()["truncadas"] - truncadas)
+                resultados.append(r)
+                _imprimir([r])
+
+    previos = None
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            previos = json.load(f)["resultados"]
+        print("\nComparado con", args.comparar)
+        _encabezado()
+        _imprimir(resultados, previos)
+
+    salida = args.salida or os.path.join(RESULTADOS, datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(salida)), exist_ok=True)
+    with open(salida, "w", encoding="utf-8") as f:
+        json.dump({
+            "meta": {
+                "fecha": datetime.now().isoformat(timespec="seconds"), "commit": _commit(),
+                "python": sys.version.split()[0], "latencia": args.latencia, "jitter": args.jitter,
+                "max_rows": args.max_rows, "repeticiones": args.repeticiones,
+                "rollups": args.rollups, "cache_reportes": args.cache_reportes,
+                "almacen": args.almacen,
+            },
+            "resultados": resultados,
+        }, f, indent=1, ensure_ascii=False)
+    print("\nResultados en", salida)
+
+
+if __name__ == "__main__":
+    main()
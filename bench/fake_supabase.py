@@ -0,0 +1,594 @@
+"""
+NEVOX FARMA - Supabase/PostgREST falso, en memoria.
+
+Con ALMACEN=supabase todo lo que api/index.py guarda pasa por _sb_get/_sb_post/
+_sb_upsert/_sb_patch/_sb_delete/_sb_rpc contra SUPABASE_URL, asi que sin el
+servicio real no se podia medir nada. Este modulo implementa el pedazo de PostgREST que usa
+la app y se monta como adaptador de requests en el cliente compartido
+(_sb_client), de modo que las peticiones recorren el mismo camino que en
+produccion: armado de la URL, filtros, cabeceras Prefer y JSON.
+
+Soporta:
+  - filtros eq, neq, gt, gte, lt, lte, is, in y or=(...)/and(...) anidados
+  - select con columnas y joins embebidos, p. ej. *,empleados(nombre,departamento)
+  - order (varias columnas, asc/desc), limit, offset y el tope max-rows
+  - Prefer: return=representation|minimal, resolution=merge-duplicates y
+    on_conflict para el upsert
+  - rpc/checkin_decidir, resuelto con la misma decidir_checkin de la app (no
+    corre sql/checkin_decidir.sql; esa funcion se prueba con
+    sql/checkin_decidir_pruebas.sql contra un Postgres)
+  - latencia inyectada por llamada (fija + aleatoria) y conteo de llamadas y
+    bytes por tabla y verbo
+
+Uso:
+    import index
+    from fake_supabase import FakeSupabase
+    fake = FakeSupabase(latencia=0.02)
+    fake.instalar(index)
+    fake.sembrar("empleados", [{"nombre": "ANA", "departamento": "Ventas"}])
+"""
+
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+
+URL_FAKE = "http://supabase.fake"
+
+# Lo que hace Postgres por su cuenta al insertar en cada tabla.
+TABLAS = {
+    "empleados": {"pk": ("id",), "defaults": {
+        "departamento": "", "hora_entrada": "09:00", "hora_salida": "18:00",
+        "token_dispositivo": None, "activo": True,
+    }},
+    "registros": {"pk": ("id",), "defaults": {"token_usado": None}, "ahora": ("fecha_hora",)},
+    "configuracion": {"pk": ("clave",), "defaults": {}},
+    # sql/jornadas_dia.sql (ROLLUPS=1)
+    "jornadas_dia": {"pk": ("empleado_id", "fecha"), "defaults": {}, "indice": "fecha"},
+    "jornadas_cobertura": {"pk": ("fecha",), "defaults": {}},
+}
+
+CONFIG_INICIAL = {
+    "admin_password": hashlib.sha256(b"admin123").hexdigest(),
+    "secret_key": "clave-secreta-de-pruebas",
+    "tolerancia_minutos": "15",
+    "nombre_empresa": "NEVOX FARMA",
+}
+
+_ISO = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}")
+
+
+class ErrorPostgrest(Exception):
+    def __init__(self, status, code, message):
+        super().__init__(message)
+        self.status, self.code, self.message = status, code, message
+
+
+# ------------------------------------------------------------
+# Comparacion de valores: PostgREST recibe todo como texto y Postgres lo
+# convierte al tipo de la columna. Aqui se convierte segun el valor guardado.
+# ------------------------------------------------------------
+
+@lru_cache(maxsize=1 << 20)
+def _como_fecha(v):
+    dt = datetime.fromisoformat(v)
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def _convertir(guardado, texto):
+    if isinstance(guardado, bool):
+        return texto == "true"
+    if isinstance(guardado, int):
+        return int(texto)
+    if isinstance(guardado, float):
+        return float(texto)
+    if isinstance(guardado, str) and _ISO.match(guardado) and _ISO.match(texto):
+        return _como_fecha(texto)
+    return texto
+
+
+def _normal(v):
+    if isinstance(v, str) and _ISO.match(v):
+        return _como_fecha(v)
+    return v
+
+
+def _cumple(fila, columna, op, texto):
+    v = fila.get(columna)
+    if op == "is":
+        return {"null": v is None, "true": v is True, "false": v is False}[texto]
+    if v is None:
+        return False  # NULL no compara con nada, igual que en SQL
+    if op == "in":
+        return any(_normal(v) == _convertir(v, t) for t in _partir(texto.strip("()")))
+    x, y = _normal(v), _convertir(v, texto)
+    return {
+        "eq": x == y, "neq": x != y, "gt": x > y,
+        "gte": x >= y, "lt": x < y, "lte": x <= y,
+    }[op]
+
+
+def _partir(texto):
+    """Separa por comas de primer nivel, respetando parentesis y comillas
+    (dentro de comillas, \\ escapa el caracter siguiente)."""
+    partes, nivel, comillas, escape, actual = [], 0, False, False, []
+    for ch in texto:
+        if escape:
+            escape = False
+        elif comillas and ch == "\\":
+            escape = True
+        elif ch == '"':
+            comillas = not comillas
+        elif not comillas and ch == "(":
+            nivel += 1
+        elif not comillas and ch == ")":
+            nivel -= 1
+        if ch == "," and nivel == 0 and not comillas:
+            partes.append("".join(actual))
+            actual = []
+        else:
+            actual.append(ch)
+    if actual:
+        partes.append("".join(actual))
+    return [p.strip() for p in partes if p.strip()]
+
+
+def _sin_comillas(v):
+    if len(v) >= 2 and v[0] == v[-1] == '"':
+        return re.sub(r"\\(.)", r"\1", v[1:-1])
+    return v
+
+
+class _Condicion:
+    """Filtro ya interpretado. Ademas de evaluar una fila sabe decir entre que
+    valores de una columna puede caer, que es lo que usa el indice por fecha."""
+
+    def __init__(self, texto):
+        self.logico = None
+        for logico in ("and", "or"):
+            if texto.startswith(logico + "("):
+                self.logico = logico
+                self.hijos = [_Condicion(p) for p in _partir(texto[len(logico) + 1:-1])]
+                return
+        self.columna, op, valor = texto.split(".", 2)
+        self.negado = op == "not"
+        if self.negado:
+            op, valor = valor.split(".", 1)
+        self.op, self.valor = op, _sin_comillas(valor)
+
+    def __call__(self, fila):
+        if self.logico == "and":
+            return all(h(fila) for h in self.hijos)
+        if self.logico == "or":
+            return any(h(fila) for h in self.hijos)
+        return _cumple(fila, self.columna, self.op, self.valor) != self.negado
+
+    def cotas(self, columna):
+        """(minimo, maximo) posibles de la columna; None si no acota."""
+        if self.logico:
+            cotas = [h.cotas(columna) for h in self.hijos]
+            if self.logico == "and":
+                los = [lo for lo, _ in cotas if lo is not None]
+                his = [hi for _, hi in cotas if hi is not None]
+                return (max(los) if los else None, min(his) if his else None)
+            los, his = [lo for lo, _ in cotas], [hi for _, hi in cotas]
+            return (None if None in los else min(los), None if None in his else max(his))
+        if self.columna != columna or self.negado or self.op not in ("gt", "gte", "lt", "lte", "eq"):
+            return None, None
+        v = _clave_indice(self.valor)
+        return (v if self.op in ("gt", "gte", "eq") else None,
+                v if self.op in ("lt", "lte", "eq") else None)
+
+
+def _clave_indice(v):
+    return _como_fecha(v) if _ISO.match(v) else v
+
+
+def _filtro(columna, valor):
+    if columna in ("or", "and"):
+        return _Condicion(f"{columna}{valor}")
+    return _Condicion(f"{columna}.{valor}")
+
+
+def _primero(entrada):
+    return entrada[0]
+
+
+def _clave_orden(v):
+    # None al final en asc (como Postgres) y tipos mezclados sin romper sort().
+    v = _normal(v)
+    return (v is None, v if v is not None else 0)
+
+
+class FakeSupabase:
+    """Base PostgREST en memoria. Todas las operaciones se serializan con un
+    lock, que hace las veces de las transacciones de Postgres."""
+
+    def __init__(self, latencia=0.0, jitter=0.0, max_rows=1000, reloj=None, semilla=None):
+        self.latencia = latencia
+        self.jitter = jitter
+        self.max_rows = max_rows
+        self.reloj = reloj or (lambda: datetime.now(timezone.utc))
+        self._azar = random.Random(semilla)
+        self._lock = threading.RLock()
+        self.tablas = {}
+        self.rpcs = {"checkin_decidir": self._rpc_checkin_decidir}
+        self._decidir = None
+        for nombre, definicion in TABLAS.items():
+            self.definir_tabla(nombre, **definicion)
+        self.reiniciar_stats()
+
+    # --- datos ---
+
+    def definir_tabla(self, nombre, pk=("id",), defaults=None, ahora=(), indice=None):
+        with self._lock:
+            # Las tablas con columna de fecha (la primera de "ahora", o la que
+            # se indique) llevan un indice ordenado (fecha, pk), como el de
+            # registros en la base real: sin el, cada pagina de un reporte de
+            # un ano recorria todo.
+            if indice is None and ahora and tuple(pk) == ("id",):
+                indice = ahora[0]
+            self.tablas[nombre] = {
+                "pk": tuple(pk), "defaults": dict(defaults or {}), "ahora": tuple(ahora),
+                "filas": {}, "seq": 0, "col_indice": indice,
+                "indice": [] if indice else None,
+            }
+
+    def sembrar(self, tabla, filas):
+        """Inserta sin pasar por HTTP ni contar en las estadisticas."""
+        with self._lock:
+            return [self._insertar(tabla, f, upsert=True) for f in filas]
+
+    def sembrar_config(self, **valores):
+        self.sembrar("configuracion", [
+            {"clave": k, "valor": v} for k, v in {**CONFIG_INICIAL, **valores}.items()
+        ])
+
+    def filas(self, tabla):
+        with self._lock:
+            return [dict(f) for f in self.tablas[tabla]["filas"].values()]
+
+    def contar(self, tabla):
+        with self._lock:
+            return len(self.tablas[tabla]["filas"])
+
+    def vaciar(self, tabla=None):
+        with self._lock:
+            for nombre, t in self.tablas.items():
+                if tabla in (None, nombre):
+                    t["filas"].clear()
+                    if t["indice"] is not None:
+                        t["indice"].clear()
+
+    # --- estadisticas ---
+
+    def reiniciar_stats(self):
+        with self._lock:
+            self.llamadas = Counter()   # (verbo, tabla) -> n
+            self.bytes_enviados = 0     # de la app hacia "Supabase"
+            self.bytes_recibidos = 0    # de "Supabase" hacia la app
+            self.filas_devueltas = 0
+            self.truncadas = 0          # lecturas cortadas por max_rows
+
+    def stats(self):
+        with self._lock:
+            return {
+                "llamadas": sum(self.llamadas.values()),
+                "por_tabla": {f"{v} {t}": n for (v, t), n in sorted(self.llamadas.items())},
+                "bytes_enviados": self.bytes_enviados,
+                "bytes_recibidos": self.bytes_recibidos,
+                "filas_devueltas": self.filas_devueltas,
+                "truncadas": self.truncadas,
+            }
+
+    # --- conexion con la app ---
+
+    def adaptador(self):
+        return _AdaptadorFake(self)
+
+    def instalar(self, index, url=URL_FAKE):
+        """Apunta la app a esta base: monta el adaptador en el cliente
+        compartido y descarta los caches que pudieran traer datos de antes."""
+        index.SUPABASE_URL = url
+        sesion = requests.Session()
+        sesion.mount(url, self.adaptador())
+        with index._sb_lock:
+            index._sb_cliente = sesion
+            index._sb_usa_httpx = False
+            index.ALMACEN = "supabase"
+            index._almacen_actual = None
+        self._decidir = index.decidir_checkin
+        index.db_invalidar_ajustes()
+        index._hoy.invalidar()
+        index._qr_cache.clear()
+        if not self.tablas["configuracion"]["filas"]:
+            self.sembrar_config()
+        return self
+
+    # --- PostgREST ---
+
+    def atender(self, metodo, url, cuerpo, cabeceras):
+        """(status, cuerpo_json_o_None, cabeceras) para una peticion HTTP."""
+        espera = self.latencia + (self._azar.uniform(0, self.jitter) if self.jitter else 0)
+        if espera > 0:
+            time.sleep(espera)
+        partes = urlsplit(url)
+        ruta = partes.path.split("/rest/v1/", 1)[-1]
+        params = parse_qsl(partes.query, keep_blank_values=True)
+        prefer = {p.strip() for p in cabeceras.get("Prefer", "").split(",") if p.strip()}
+        datos = json.loads(cuerpo) if cuerpo else None
+        verbo = "RPC" if ruta.startswith("rpc/") else metodo
+        try:
+            with self._lock:
+                if ruta.startswith("rpc/"):
+                    fn = self.rpcs.get(ruta[4:])
+                    if fn is None:
+                        raise ErrorPostgrest(404, "PGRST202", f"funcion {ruta[4:]} no existe")
+                    status, resultado = 200, fn(datos or {})
+                else:
+                    status, resultado = self._tabla(metodo, ruta, params, datos, prefer)
+        except ErrorPostgrest as e:
+            status, resultado = e.status, {"code": e.code, "message": e.message}
+        salida = b"" if resultado is None else json.dumps(resultado, default=str).encode()
+        with self._lock:
+            self.llamadas[(verbo, ruta[4:] if verbo == "RPC" else ruta)] += 1
+            self.bytes_enviados += len(cuerpo or b"") + len(url)
+            self.bytes_recibidos += len(salida)
+            if isinstance(resultado, list) and status < 400:
+                self.filas_devueltas += len(resultado)
+        return status, salida, {"Content-Type": "application/json"}
+
+    def _tabla(self, metodo, nombre, params, datos, prefer):
+        t = self.tablas.get(nombre)
+        if t is None:
+            raise ErrorPostgrest(404, "42P01", f'relation "public.{nombre}" does not exist')
+        especiales = {"select", "order", "limit", "offset", "on_conflict", "columns"}
+        opciones = {k: v for k, v in params if k in especiales}
+        condiciones = [_filtro(k, v) for k, v in params if k not in especiales]
+        select = opciones.get("select", "*")
+        representacion = "return=representation" in prefer
+
+        if metodo == "GET":
+            offset = int(opciones.get("offset", 0))
+            limite = int(opciones["limit"]) if "limit" in opciones else None
+            tope = limite
+            if self.max_rows:
+                tope = min(limite, self.max_rows) if limite is not None else self.max_rows
+            candidatas, ordenadas = self._candidatas(t, condiciones, opciones.get("order"))
+            filas = []
+            for f in candidatas:
+                if all(c(f) for c in condiciones):
+                    filas.append(f)
+                    # En orden de indice se corta apenas se llena la pagina.
+                    if ordenadas and tope is not None and len(filas) > offset + tope:
+                        break
+            if not ordenadas:
+                filas = self._ordenar(filas, opciones.get("order"))
+            if tope is not None and len(filas) > offset + tope and (limite is None or limite > tope):
+                self.truncadas += 1
+            filas = filas[offset:offset + tope if tope is not None else None]
+            return 200, [self._proyectar(nombre, f, select) for f in filas]
+
+        if metodo == "POST":
+            lote = datos if isinstance(datos, list) else [datos]
+            upsert = "resolution=merge-duplicates" in prefer
+            conflicto = tuple(c.strip() for c in opciones["on_conflict"].split(",")) if "on_conflict" in opciones else None
+            nuevas = [self._insertar(nombre, f, upsert=upsert, conflicto=conflicto) for f in lote]
+            if not representacion:
+                return 201, None
+            return 201, [self._proyectar(nombre, f, select) for f in nuevas]
+
+        if metodo == "PATCH":
+            cambios = self._normalizar(datos)
+            cambiadas = [f for f in self._candidatas(t, condiciones)[0] if all(c(f) for c in condiciones)]
+            for f in cambiadas:
+                self._actualizar(t, f, cambios)
+            if not representacion:
+                return 204, None
+            return 200, [self._proyectar(nombre, f, select) for f in cambiadas]
+
+        if metodo == "DELETE":
+            borradas = [f for f in self._candidatas(t, condiciones)[0] if all(c(f) for c in condiciones)]
+            for f in borradas:
+                self._desindexar(t, f)
+                del t["filas"][tuple(f.get(c) for c in t["pk"])]
+            if not representacion:
+                return 204, None
+            return 200, [self._proyectar(nombre, f, select) for f in borradas]
+
+        raise ErrorPostgrest(405, "PGRST105", f"metodo {metodo} no soportado")
+
+    def _candidatas(self, t, condiciones, orden=None):
+        """(filas a revisar, si ya vienen en el orden pedido). Usa la pk para
+        id=eq.N y el indice por fecha para rangos; si no, toda la tabla."""
+        if t["pk"] == ("id",):
+            for c in condiciones:
+                if not c.logico and c.columna == "id" and c.op == "eq" and not c.negado:
+                    f = t["filas"].get((int(c.valor),))
+                    return ([f] if f is not None else []), True
+        indice = t["indice"]
+        if indice is None:
+            return list(t["filas"].values()), False
+        col = t["col_indice"]
+        los, his = [], []
+        for c in condiciones:
+            lo, hi = c.cotas(col)
+            if lo is not None:
+                los.append(lo)
+            if hi is not None:
+                his.append(hi)
+        i = bisect_left(indice, max(los), key=_primero) if los else 0
+        j = bisect_right(indice, min(his), key=_primero) if his else len(indice)
+        tramo = indice[i:j]
+        columnas = [p.partition(".") for p in orden.split(",")] if orden else []
+        nombres = [c for c, _, _ in columnas]
+        sentidos = {s.startswith("desc") for _, _, s in columnas}
+        ordenadas = nombres in ([col], [col, t["pk"][0]]) and len(sentidos) == 1
+        if ordenadas and True in sentidos:
+            tramo.reverse()
+        filas = t["filas"]
+        return [filas[pk] for _v, pk in tramo], ordenadas
+
+    def _indexar(self, t, fila):
+        if t["indice"] is not None and fila.get(t["col_indice"]):
+            insort(t["indice"], self._entrada_indice(t, fila))
+
+    @staticmethod
+    def _entrada_indice(t, fila):
+        return (_clave_indice(fila[t["col_indice"]]), tuple(fila.get(c) for c in t["pk"]))
+
+    def _desindexar(self, t, fila):
+        if t["indice"] is not None and fila.get(t["col_indice"]):
+            clave = self._entrada_indice(t, fila)
+            i = bisect_left(t["indice"], clave)
+            if i < len(t["indice"]) and t["indice"][i] == clave:
+                del t["indice"][i]
+
+    def _actualizar(self, t, fila, cambios):
+        self._desindexar(t, fila)
+        fila.update(cambios)
+        self._indexar(t, fila)
+
+    def _normalizar(self, fila):
+        # Postgres devuelve los timestamptz en UTC; se guardan igual.
+        return {
+            k: (_como_fecha(v).astimezone(timezone.utc).isoformat()
+                if isinstance(v, str) and _ISO.match(v) and k.startswith("fecha_hora") else v)
+            for k, v in fila.items()
+        }
+
+    def _insertar(self, nombre, fila, upsert=False, conflicto=None):
+        t = self.tablas[nombre]
+        nueva = {**t["defaults"], **self._normalizar(fila)}
+        for col in t["ahora"]:
+            if nueva.get(col) is None:
+                nueva[col] = self.reloj().astimezone(timezone.utc).isoformat()
+        if t["pk"] == ("id",) and nueva.get("id") is None:
+            t["seq"] += 1
+            nueva["id"] = t["seq"]
+        elif t["pk"] == ("id",):
+            t["seq"] = max(t["seq"], nueva["id"])
+        clave_pk = tuple(nueva.get(c) for c in t["pk"])
+        conflicto = conflicto or t["pk"]
+        existente = None
+        if conflicto == t["pk"]:
+            existente = t["filas"].get(clave_pk)
+        else:
+            for f in t["filas"].values():
+                if all(f.get(c) == nueva.get(c) for c in conflicto):
+                    existente = f
+                    break
+        if existente is not None:
+            if not upsert:
+                raise ErrorPostgrest(409, "23505", "duplicate key value violates unique constraint")
+            # merge-duplicates: solo se pisan las columnas enviadas.
+            self._actualizar(t, existente, {k: v for k, v in nueva.items() if k in fila or k in conflicto})
+            return existente
+        t["filas"][clave_pk] = nueva
+        self._indexar(t, nueva)
+        return nueva
+
+    def _ordenar(self, filas, orden):
+        if not orden:
+            return filas
+        for parte in reversed(orden.split(",")):
+            columna, _, sentido = parte.partition(".")
+            desc = sentido.startswith("desc")
+            filas = sorted(filas, key=lambda f: _clave_orden(f.get(columna)), reverse=desc)
+        return filas
+
+    def _proyectar(self, nombre, fila, select):
+        salida = {}
+        for item in _partir(select):
+            if item == "*":
+                salida.update(fila)
+            elif "(" in item:
+                rel, cols = item[:-1].split("(", 1)
+                salida[rel] = self._embebido(fila, rel, cols)
+            else:
+                salida[item] = fila.get(item)
+        return salida
+
+    def _embebido(self, fila, rel, cols):
+        # Relacion por convencion: registros.empleado_id -> empleados.id.
+        fk = fila.get(f"{rel[:-1]}_id")
+        destino = self.tablas[rel]["filas"].get((fk,))
+        if destino is None:
+            return None
+        return self._proyectar(rel, destino, cols)
+
+    # --- rpc ---
+
+    def _rpc_checkin_decidir(self, p):
+        """Equivalente de sql/checkin_decidir.sql: el lock de la base hace de
+        FOR UPDATE y la regla es la misma decidir_checkin de la app. Lo que se
+        mide aqui es la app, no el plpgsql."""
+        emp = self.tablas["empleados"]["filas"].get((p["p_empleado_id"],))
+        if emp is None or not emp.get("activo"):
+            return {"accion": "rechazado", "motivo": "empleado"}
+        if emp.get("token_dispositivo") != p["p_token_dispositivo"]:
+            return {"accion": "rechazado", "motivo": "dispositivo", "nombre": emp["nombre"]}
+        condiciones = [_filtro("empleado_id", f"eq.{emp['id']}"),
+                       _filtro("fecha_hora", f"gte.{p['p_desde']}"),
+                       _filtro("fecha_hora", f"lte.{p['p_hasta']}")]
+        candidatas, _ = self._candidatas(self.tablas["registros"], condiciones, "fecha_hora.asc,id.asc")
+        regs = [dict(f) for f in candidatas if all(c(f) for c in condiciones)]
+        tz = timezone(timedelta(minutes=p["p_utc_offset_min"]))
+        ahora = self.reloj().astimezone(tz)
+        salida = p["p_salida_programada"]
+        ajustes = SimpleNamespace(
+            antirrebote=p["p_antirrebote"], margen_salida=p["p_margen_salida"],
+            hora_corte_entrada=p["p_hora_corte"],
+            horario={str(ahora.weekday()): {"salida": salida} if salida else None},
+        )
+        d = self._decidir(regs, ahora, ajustes, p["p_duplicado_max"])
+        d["nombre"] = emp["nombre"]
+        registro = None
+        if d["accion"] == "corregido":
+            registros = self.tablas["registros"]
+            registro = registros["filas"][(d["registro_id"],)]
+            self._actualizar(registros, registro, {
+                "fecha_hora": ahora.astimezone(timezone.utc).isoformat(),
+                "token_usado": "auto-correccion-duplicado",
+            })
+        elif d["accion"] == "creado":
+            registro = self._insertar("registros", {
+                "empleado_id": emp["id"], "tipo": d["tipo"], "token_usado": p["p_token_qr"],
+            })
+        if registro is not None:
+            d["fecha_hora"] = registro["fecha_hora"]
+            d["registro"] = self._proyectar("registros", registro, "*,empleados(nombre,departamento)")
+        return d
+
+
+class _AdaptadorFake(BaseAdapter):
+    def __init__(self, fake):
+        super().__init__()
+        self.fake = fake
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        cuerpo = request.body.encode() if isinstance(request.body, str) else request.body
+        status, salida, cabeceras = self.fake.atender(request.method, request.url, cuerpo, request.headers)
+        r = requests.Response()
+        r.status_code = status
+        r._content = salida
+        r.headers.update(cabeceras)
+        r.encoding = "utf-8"
+        r.url = request.url
+        r.request = request
+        r.reason = "OK" if status < 400 else "Error"
+        return r
+
+    def close(self):
+        pass
@@ -0,0 +1,212 @@
+"""
+NEVOX FARMA - Simulador de la rafaga de entrada.
+
+El pico real es toda la planta escaneando en los ~90 segundos antes de las
+7:00. Este modo siembra N empleados con dispositivo vinculado en el Supabase
+falso, fija el reloj de la app y del fake en --hora y dispara un escaneo por
+empleado con una curva de llegada que se carga hacia el final de la ventana,
+mas algunos dobles escaneos (a los pocos segundos y en simultaneo) para
+probar el anti-rebote y la carrera entre leer y escribir del check-in.
+
+    python bench/rafaga.py --empleados 500
+    python bench/rafaga.py --empleados 2000 --escala 10 --hilos 64 --modo ambos
+
+Al final revisa en la base falsa que no haya filas duplicadas, que ningun
+doble escaneo haya creado una marca y que el tipo de cada marca sea el que da
+tipo_por_hora; sale con codigo 1 si algo falla. Con --almacen sqlite corre
+sobre la base SQLite local de la app en vez del Supabase falso; ahi la app
+siempre decide dentro de la transaccion (CHECKIN_RPC), asi que solo hay modo
+rpc.
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+AQUI = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(AQUI, "..", "api"), AQUI]
+
+import index  # noqa: E402
+from bench import _percentil, preparar, sembrar_empresa  # noqa: E402
+
+
+class Reloj:
+    """Hora local simulada: parte de `inicio` y avanza `escala` veces mas
+    rapido que el reloj real."""
+
+    def __init__(self, inicio, escala=1.0):
+        self.inicio, self.escala = inicio, escala
+        self.t0 = time.perf_counter()
+
+    def local(self):
+        return self.inicio + timedelta(seconds=(time.perf_counter() - self.t0) * self.escala)
+
+    def utc(self):
+        return self.local().astimezone(timezone.utc)
+
+
+def _llegadas(emps, ventana, rebote, simultaneo, azar):
+    """[(segundo_simulado, empleado, es_repeticion)] en orden de llegada."""
+    eventos = []
+    for e in emps:
+        t = azar.betavariate(4, 2) * ventana
+        eventos.append((t, e, False))
+        if azar.random() < simultaneo:
+            eventos.append((t, e, True))
+        elif azar.random() < rebote:
+            eventos.append((t + azar.uniform(0.5, 5), e, True))
+    eventos.sort(key=lambda ev: ev[0])
+    return eventos
+
+
+def correr(modo, args):
+    index.CHECKIN_RPC = modo == "rpc"
+    hoy = datetime.now(index.LOCAL_TZ).date()
+    hh, mm, *ss = (int(x) for x in args.hora.split(":"))
+    inicio = datetime(hoy.year, hoy.month, hoy.day, hh, mm, ss[0] if ss else 0, tzinfo=index.LOCAL_TZ)
+    reloj = Reloj(inicio, args.escala)
+
+    original = index.now_local
+    index.now_local = reloj.local
+    try:
+        fake, _ = preparar(args.latencia, args.jitter, reloj=reloj.utc, semilla=args.semilla,
+                           almacen=args.almacen)
+        emps = sembrar_empresa(fake, args.empleados, 0, ahora=inicio, semilla=args.semilla)
+        eventos = _llegadas(emps, args.ventana, args.rebote, args.simultaneo, random.Random(args.semilla))
+        resultados = []
+        lock = threading.Lock()
+        tokens = {}
+        hilo = threading.local()
+
+        def escanear(programado, emp, repeticion):
+            cliente = getattr(hilo, "cliente", None)
+            if cliente is None:
+                cliente = hilo.cliente = index.app.test_client()
+            slot = index.qr_slot_actual()
+            token = tokens.get(slot) or tokens.setdefault(slot, index.qr_token(slot))
+            momento = reloj.local()
+            t0 = time.perf_counter()
+            r = cliente.post("/api/checkin", json={
+                "token_qr": token, "token_dispositivo": emp["token_dispositivo"],
+            })
+            fin = time.perf_counter()
+            with lock:
+                resultados.append({
+                    "emp": emp["id"], "repeticion": repeticion, "status": r.status_code,
+                    "cuerpo": r.get_json() or {}, "servicio_ms": (fin - t0) * 1000,
+                    "espera_ms": (fin - programado) * 1000, "momento": momento,
+                })
+
+        # Un poco de calor antes de abrir la puerta: config y _hoy cargados.
+        index.db_ajustes()
+        fake.reiniciar_stats()
+        t_inicio = time.perf_counter()
+        reloj.t0 = t_inicio
+        with ThreadPoolExecutor(max_workers=args.hilos) as pool:
+            for t_sim, emp, repeticion in eventos:
+                programado = t_inicio + t_sim / args.escala
+                pausa = programado - time.perf_counter()
+                if pausa > 0:
+                    time.sleep(pausa)
+                pool.submit(escanear, programado, emp, repeticion)
+        duracion = time.perf_counter() - t_inicio
+        return _informe(modo, fake, emps, resultados, duracion)
+    finally:
+        index.now_local = original
+
+
+def _informe(modo, fake, emps, resultados, duracion):
+    ajustes = index.db_ajustes()
+    corte = ajustes.hora_corte_entrada
+    por_emp = defaultdict(list)
+    for f in fake.filas("registros"):
+        por_emp[f["empleado_id"]].append(f)
+
+    duplicadas = {eid: len(fs) for eid, fs in por_emp.items() if len(fs) > 1}
+    sin_marca = [e["id"] for e in emps if e["id"] not in por_emp]
+    tipo_mal = [
+        (f["empleado_id"], f["tipo"], index.tipo_por_hora(index.to_local(f["fecha_hora"]), corte))
+        for fs in por_emp.values() for f in fs
+        if f["tipo"] != index.tipo_por_hora(index.to_local(f["fecha_hora"]), corte)
+    ]
+    # Quien escaneo dos veces (a los segundos o a la vez) debe tener una sola
+    # respuesta que escribio y el resto "duplicado": en un par simultaneo
+    # cualquiera de los dos puede ser el que llega primero.
+    respuestas = defaultdict(Counter)
+    for r in resultados:
+        respuestas[r["emp"]][_clase(r)] += 1
+    repetidos = {r["emp"] for r in resultados if r["repeticion"]}
+    rebote_mal = {
+        eid: dict(respuestas[eid]) for eid in sorted(repetidos)
+        if respuestas[eid]["creado"] != 1 or set(respuestas[eid]) != {"creado", "duplicado"}
+    }
+    errores = [r for r in resultados if r["status"] >= 500]
+
+    espera = [r["espera_ms"] for r in resultados]
+    servicio = [r["servicio_ms"] for r in resultados]
+    stats = fake.stats()
+    resultado = Counter(_clase(r) for r in resultados)
+    print(f"\n== modo {modo}: {len(resultados)} escaneos de {len(emps)} empleados en {duracion:.1f}s "
+          f"({len(resultados) / duracion:.1f}/s)")
+    print(f"   servicio ms  p50 {_percentil(servicio, 50):.1f}  p95 {_percentil(servicio, 95):.1f}  "
+          f"p99 {_percentil(servicio, 99):.1f}  max {max(servicio):.1f}")
+    print(f"   llegada->respuesta ms  p50 {_percentil(espera, 50):.1f}  p99 {_percentil(espera, 99):.1f}")
+    print(f"   Supabase: {stats['llamadas']} llamadas ({stats['llamadas'] / len(resultados):.2f} por escaneo) "
+          f"{stats['por_tabla']}")
+    print(f"   respuestas: {dict(resultado)}")
+    fallas = {
+        "filas duplicadas": duplicadas, "empleados sin marca": sin_marca,
+        "tipo distinto a tipo_por_hora": tipo_mal, "doble escaneo no detectado": rebote_mal,
+        "errores 5xx": errores,
+    }
+    ok = True
+    for nombre, casos in fallas.items():
+        if casos:
+            ok = False
+            muestra = list(casos.items())[:5] if isinstance(casos, dict) else casos[:5]
+            print(f"   FALLA {nombre}: {len(casos)}  p. ej. {muestra}")
+    if ok:
+        print("   OK: sin duplicados, anti-rebote respetado y tipos correctos")
+    return ok
+
+
+def _clase(r):
+    c = r["cuerpo"]
+    for clave in ("duplicado", "corregido", "aviso", "jornada_completa"):
+        if c.get(clave):
+            return clave
+    return "creado" if c.get("ok") else f"error {r['status']}"
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--empleados", type=int, default=500)
+    ap.add_argument("--ventana", type=float, default=90, help="segundos simulados de la rafaga")
+    ap.add_argument("--escala", type=float, default=1, help="cuantas veces mas rapido que el reloj real")
+    ap.add_argument("--hora", default="06:58:30", help="hora local simulada al abrir la ventana")
+    ap.add_argument("--hilos", type=int, default=32, help="escaneos atendidos a la vez")
+    ap.add_argument("--rebote", type=float, default=0.10, help="fraccion que vuelve a escanear a los segundos")
+    ap.add_argument("--simultaneo", type=float, default=0.02, help="fraccion que escanea dos veces a la vez")
+    ap.add_argument("--latencia", type=float, default=0.03, help="segundos por llamada a Supabase")
+    ap.add_argument("--jitter", type=float, default=0.02)
+    ap.add_argument("--modo", choices=("normal", "rpc", "ambos"), default="normal")
+    ap.add_argument("--almacen", choices=("supabase", "sqlite"), default="supabase")
+    ap.add_argument("--semilla", type=int, default=1)
+    args = ap.parse_args(argv)
+
+    modos = ("normal", "rpc") if args.modo == "ambos" else (args.modo,)
+    if args.almacen == "sqlite" and modos != ("rpc",):
+        print("con --almacen sqlite el check-in siempre va por el RPC: se corre solo --modo rpc")
+        modos = ("rpc",)
+    ok = all([correr(m, args) for m in modos])
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
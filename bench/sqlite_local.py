@@ -0,0 +1,116 @@
+"""
+NEVOX FARMA - La app sobre su almacen SQLite local (ALMACEN=sqlite).
+
+Misma cara que FakeSupabase (sembrar, filas, contar, stats, instalar) para que
+bench.py y rafaga.py corran sus escenarios sobre _AlmacenSqlite igual que
+sobre el PostgREST falso. Cada sentencia cuenta como una llamada, con el verbo
+de PostgREST que le corresponde (GET, POST, PATCH, DELETE), y la latencia
+inyectada se suma a cada una que corra fuera de una transaccion: dormir con
+el lock de escritura tomado no imita nada que pase de verdad. Cada instancia usa un archivo nuevo en un
+directorio temporal que se borra al salir.
+
+Uso:
+    import index
+    from sqlite_local import SqliteLocal
+    base = SqliteLocal().instalar(index)
+    base.sembrar("empleados", [{"nombre": "ANA", "departamento": "Ventas"}])
+"""
+
+import atexit
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from fake_supabase import CONFIG_INICIAL
+
+
+class SqliteLocal:
+    def __init__(self, latencia=0.0, jitter=0.0, reloj=None, semilla=None, ruta=None):
+        if ruta is None:
+            carpeta = tempfile.mkdtemp(prefix="nevox-sqlite-")
+            atexit.register(shutil.rmtree, carpeta, ignore_errors=True)
+            ruta = os.path.join(carpeta, "nevox_farma.db")
+        self.ruta = ruta
+        self.latencia = latencia
+        self.jitter = jitter
+        self.reloj = reloj
+        self._azar = random.Random(semilla)
+        self._lock = threading.Lock()
+        self._hilo = threading.local()
+        self.almacen = None
+        self.reiniciar_stats()
+
+    # --- datos ---
+
+    def sembrar(self, tabla, filas):
+        """Inserta (upsert por la clave primaria) sin contar en las
+        estadisticas; devuelve las filas como quedaron."""
+        a = self.almacen
+        self._hilo.sembrando = True
+        try:
+            return a._guardar(tabla, filas, a._pk[tabla])
+        finally:
+            self._hilo.sembrando = False
+
+    def sembrar_config(self, **valores):
+        self.sembrar("configuracion", [
+            {"clave": k, "valor": v} for k, v in {**CONFIG_INICIAL, **valores}.items()
+        ])
+
+    def filas(self, tabla):
+        a = self.almacen
+        return [a._desde_sqlite(tabla, f) for f in a._conexion().execute(f'select * from "{tabla}" order by rowid')]
+
+    def contar(self, tabla):
+        return self.almacen._conexion().execute(f'select count(*) from "{tabla}"').fetchone()[0]
+
+    # --- estadisticas ---
+
+    def reiniciar_stats(self):
+        with self._lock:
+            self.llamadas = Counter()  # (verbo, tabla) -> n
+            self.filas_devueltas = 0
+
+    def stats(self):
+        # Sin red de por medio no hay bytes que contar ni max-rows que trunque.
+        with self._lock:
+            return {
+                "llamadas": sum(self.llamadas.values()),
+                "por_tabla": {f"{v} {t}": n for (v, t), n in sorted(self.llamadas.items())},
+                "bytes_enviados": 0,
+                "bytes_recibidos": 0,
+                "filas_devueltas": self.filas_devueltas,
+                "truncadas": 0,
+            }
+
+    # --- conexion con la app ---
+
+    def instalar(self, index):
+        """Apunta la app a esta base y descarta los caches de antes."""
+        self.almacen = index._AlmacenSqlite(self.ruta, reloj=self.reloj)
+        anotar = self.almacen._anotar
+
+        def contando(verbo, tabla, status, dur, filas):
+            if getattr(self._hilo, "sembrando", False):
+                return
+            espera = self.latencia + (self._azar.uniform(0, self.jitter) if self.jitter else 0)
+            if espera > 0 and not self.almacen._conexion().in_transaction:
+                time.sleep(espera)
+            with self._lock:
+                self.llamadas[(verbo, tabla)] += 1
+                self.filas_devueltas += filas
+            anotar(verbo, tabla, status, dur, filas)
+
+        self.almacen._anotar = contando
+        with index._sb_lock:
+            index.ALMACEN = "sqlite"
+            index._almacen_actual = self.almacen
+        index.db_invalidar_ajustes()
+        index._hoy.invalidar()
+        index._qr_cache.clear()
+        self.sembrar_config()
+        return self
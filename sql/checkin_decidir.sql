@@ -0,0 +1,149 @@
+-- NEVOX FARMA - check-in en una sola llamada (CHECKIN_RPC=1).
+--
+-- Misma regla que decidir_checkin en api/index.py, aplicada dentro de una
+-- transaccion: la fila del empleado se bloquea (FOR UPDATE) mientras se leen
+-- las marcas de hoy y se escribe, asi dos escaneos simultaneos del mismo
+-- empleado no pueden crear dos registros. La configuracion la manda la app
+-- (sale de su cache de configuracion); aqui no se lee la tabla configuracion.
+--
+-- Devuelve la decision ya aplicada, con el formato que espera
+-- _respuesta_checkin, mas "nombre" y, si se escribio, "registro" (la fila con
+-- el join de empleados, para el cache de registros de hoy).
+--
+-- Instalar desde el SQL Editor de Supabase. Despues de cambiar la firma:
+--   notify pgrst, 'reload schema';
+--
+-- Cualquier cambio aqui se prueba con tests/test_checkin_decidir.py (la misma
+-- tabla de casos contra esta funcion y contra decidir_checkin; la mitad SQL
+-- pide PRUEBAS_DATABASE_URL) y con sql/checkin_decidir_pruebas.sql (psql, en
+-- una transaccion que se deshace). El fake de bench/ y ALMACEN=sqlite no
+-- corren este SQL: deciden con decidir_checkin de la app.
+
+create or replace function checkin_decidir(
+    p_empleado_id       bigint,
+    p_token_dispositivo text,
+    p_token_qr          text,
+    p_desde             timestamptz,  -- inicio del dia local, en UTC
+    p_hasta             timestamptz,  -- fin del dia local, en UTC
+    p_antirrebote       integer,      -- segundos
+    p_salida_programada text,         -- 'HH:MM' de hoy, null si no es laboral
+    p_margen_salida     integer,      -- minutos
+    p_hora_corte        text,         -- 'HH:MM'
+    p_duplicado_max     integer,      -- minutos
+    p_utc_offset_min    integer       -- -300 para UTC-5
+) returns jsonb
+language plpgsql
+as $$
+declare
+    v_emp      empleados%rowtype;
+    v_ahora    timestamptz := now();
+    v_local    timestamp   := (now() at time zone 'UTC') + make_interval(mins => p_utc_offset_min);
+    v_n        integer;
+    v_n_ent    integer;
+    v_n_sal    integer;
+    v_ultimo   registros%rowtype;
+    v_primera  registros%rowtype;   -- primera entrada del dia
+    v_sal      registros%rowtype;   -- ultima salida del dia
+    v_reg      registros%rowtype;
+    v_seg      double precision;
+    v_abre     integer;
+    v_tipo     text;
+    v_join     jsonb;
+begin
+    select * into v_emp from empleados where id = p_empleado_id for update;
+    if not found or not coalesce(v_emp.activo, false) then
+        return jsonb_build_object('accion', 'rechazado', 'motivo', 'empleado');
+    end if;
+    if v_emp.token_dispositivo is distinct from p_token_dispositivo then
+        return jsonb_build_object('accion', 'rechazado', 'motivo', 'dispositivo', 'nombre', v_emp.nombre);
+    end if;
+    v_join := jsonb_build_object('empleados', jsonb_build_object(
+        'nombre', v_emp.nombre, 'departamento', v_emp.departamento));
+
+    select count(*),
+           count(*) filter (where tipo = 'entrada'),
+           count(*) filter (where tipo = 'salida')
+      into v_n, v_n_ent, v_n_sal
+      from registros
+     where empleado_id = p_empleado_id and fecha_hora between p_desde and p_hasta;
+
+    if v_n > 0 then
+        select * into v_ultimo from registros
+         where empleado_id = p_empleado_id and fecha_hora between p_desde and p_hasta
+         order by fecha_hora desc, id desc limit 1;
+
+        -- Anti-rebote: se repite el registro anterior.
+        if p_antirrebote > 0 then
+            v_seg := extract(epoch from (v_ahora - v_ultimo.fecha_hora));
+            if v_seg >= 0 and v_seg < p_antirrebote then
+                return jsonb_build_object('accion', 'duplicado', 'nombre', v_emp.nombre,
+                    'tipo', v_ultimo.tipo, 'fecha_hora', v_ultimo.fecha_hora);
+            end if;
+        end if;
+    end if;
+
+    if v_n_ent > 0 then
+        select * into v_primera from registros
+         where empleado_id = p_empleado_id and tipo = 'entrada'
+           and fecha_hora between p_desde and p_hasta
+         order by fecha_hora asc, id asc limit 1;
+    end if;
+    if v_n_sal > 0 then
+        select * into v_sal from registros
+         where empleado_id = p_empleado_id and tipo = 'salida'
+           and fecha_hora between p_desde and p_hasta
+         order by fecha_hora desc, id desc limit 1;
+    end if;
+
+    -- Entrada y salida: jornada completa, salvo que sea un doble escaneo.
+    if v_n_ent > 0 and v_n_sal > 0 then
+        if extract(epoch from (v_sal.fecha_hora - v_primera.fecha_hora)) / 60 >= p_duplicado_max then
+            return jsonb_build_object('accion', 'jornada_completa', 'nombre', v_emp.nombre,
+                'primera', v_primera.fecha_hora, 'ultima', v_sal.fecha_hora);
+        end if;
+        update registros
+           set fecha_hora = v_ahora, token_usado = 'auto-correccion-duplicado'
+         where id = v_sal.id returning * into v_reg;
+        return jsonb_build_object('accion', 'corregido', 'nombre', v_emp.nombre,
+            'registro_id', v_reg.id, 'previa', v_sal.fecha_hora, 'sin_entrada', false,
+            'fecha_hora', v_reg.fecha_hora, 'registro', to_jsonb(v_reg) || v_join);
+    end if;
+
+    -- Solo entrada: la salida se acepta desde salida programada - margen.
+    if v_n_ent > 0 and p_salida_programada is not null then
+        v_abre := greatest(0, split_part(p_salida_programada, ':', 1)::integer * 60
+                              + split_part(p_salida_programada, ':', 2)::integer
+                              - p_margen_salida);
+        if extract(hour from v_local)::integer * 60 + extract(minute from v_local)::integer < v_abre then
+            return jsonb_build_object('accion', 'aviso', 'nombre', v_emp.nombre,
+                'entrada', v_primera.fecha_hora,
+                'salida_programada', p_salida_programada, 'abre', v_abre);
+        end if;
+    end if;
+
+    -- Solo salida: se reubica a la hora real, el dia queda sin entrada.
+    if v_n_sal > 0 and v_n_ent = 0 then
+        update registros
+           set fecha_hora = v_ahora, token_usado = 'auto-correccion-duplicado'
+         where id = v_sal.id returning * into v_reg;
+        return jsonb_build_object('accion', 'corregido', 'nombre', v_emp.nombre,
+            'registro_id', v_reg.id, 'previa', v_sal.fecha_hora, 'sin_entrada', true,
+            'fecha_hora', v_reg.fecha_hora, 'registro', to_jsonb(v_reg) || v_join);
+    end if;
+
+    if v_n > 0 then
+        v_tipo := case when v_ultimo.tipo = 'salida' then 'entrada' else 'salida' end;
+    elsif to_char(v_local, 'HH24:MI') < p_hora_corte then
+        v_tipo := 'entrada';
+    else
+        v_tipo := 'salida';
+    end if;
+
+    insert into registros (empleado_id, tipo, token_usado)
+    values (p_empleado_id, v_tipo, p_token_qr)
+    returning * into v_reg;
+    return jsonb_build_object('accion', 'creado', 'nombre', v_emp.nombre,
+        'tipo', v_tipo, 'primera_del_dia', v_n = 0, 'corte', p_hora_corte,
+        'fecha_hora', v_reg.fecha_hora, 'registro', to_jsonb(v_reg) || v_join);
+end;
+$$;
@@ -0,0 +1,153 @@
+-- NEVOX FARMA - pruebas de checkin_decidir (sql/checkin_decidir.sql).
+--
+-- El fake de bench/ y el backend SQLite resuelven rpc/checkin_decidir con la
+-- decidir_checkin de la app, asi que la funcion SQL no corre en ninguna
+-- medicion. La paridad con decidir_checkin la cubre tests/test_checkin_decidir.py
+-- (con PRUEBAS_DATABASE_URL); aqui quedan ademas los rechazos y lo que se
+-- escribe. Correr contra una base con el esquema y la funcion ya instalados
+-- (una copia, o la de desarrollo):
+--
+--   psql "$DATABASE_URL" -v ON_ERROR_STOP=1 -f sql/checkin_decidir_pruebas.sql
+--
+-- Todo va en una transaccion que termina en rollback: los empleados y
+-- registros de prueba no quedan. Dentro de la transaccion now() no cambia,
+-- asi que las marcas previas se siembran con fecha_hora = now() - intervalo.
+-- Cada caso imprime "NOTICE:  ok: <caso>"; si una decision no es la esperada
+-- el ASSERT corta con el caso y el jsonb devuelto. Salida esperada: 15
+-- lineas "ok" y ROLLBACK.
+--
+-- Parametros comunes: dia = now() +/- 12 h, anti-rebote 60 s, margen de
+-- salida 0, duplicado 30 min, UTC (offset 0). La hora de corte y la salida
+-- programada se eligen para que no dependan de la hora a la que se corre:
+-- corte '24:00' siempre da entrada, '00:00' siempre salida; salida
+-- programada '24:00' nunca abre, '00:00' ya abrio.
+
+begin;
+
+create function pg_temp.emp(p_activo boolean default true) returns bigint
+language sql as $$
+    insert into empleados (nombre, departamento, hora_entrada, hora_salida, token_dispositivo, activo)
+    values ('PRUEBA CHECKIN', 'Pruebas', '09:00', '18:00', 'disp-prueba', p_activo)
+    returning id;
+$$;
+
+create function pg_temp.marca(p_emp bigint, p_tipo text, p_hace interval) returns bigint
+language sql as $$
+    insert into registros (empleado_id, tipo, fecha_hora, token_usado)
+    values (p_emp, p_tipo, now() - p_hace, 'qr-previo')
+    returning id;
+$$;
+
+create function pg_temp.decidir(p_emp bigint, p_corte text default '24:00',
+                                p_salida text default null, p_antirrebote integer default 60,
+                                p_token text default 'disp-prueba') returns jsonb
+language sql as $$
+    select checkin_decidir(p_emp, p_token, 'qr-prueba',
+                           now() - interval '12 hours', now() + interval '12 hours',
+                           p_antirrebote, p_salida, 0, p_corte, 30, 0);
+$$;
+
+create function pg_temp.esperar(p_caso text, p_r jsonb, p_esperado jsonb) returns void
+language plpgsql as $$
+begin
+    assert p_r @> p_esperado, format('%s: se esperaba %s, vino %s', p_caso, p_esperado, p_r);
+    raise notice 'ok: %', p_caso;
+end;
+$$;
+
+do $$
+declare
+    e  bigint;
+    r  jsonb;
+    v_id bigint;
+    n  integer;
+begin
+    -- Rechazos.
+    perform pg_temp.esperar('empleado inexistente',
+        pg_temp.decidir(-1), '{"accion": "rechazado", "motivo": "empleado"}');
+    perform pg_temp.esperar('empleado inactivo',
+        pg_temp.decidir(pg_temp.emp(false)), '{"accion": "rechazado", "motivo": "empleado"}');
+    perform pg_temp.esperar('otro dispositivo',
+        pg_temp.decidir(pg_temp.emp(), p_token => 'disp-ajeno'),
+        '{"accion": "rechazado", "motivo": "dispositivo", "nombre": "PRUEBA CHECKIN"}');
+
+    -- Primera marca: el tipo sale de la hora de corte.
+    e := pg_temp.emp();
+    r := pg_temp.decidir(e, '24:00');
+    perform pg_temp.esperar('primera marca antes del corte', r,
+        '{"accion": "creado", "tipo": "entrada", "primera_del_dia": true, "corte": "24:00"}');
+    assert r->'registro'->'empleados' = '{"nombre": "PRUEBA CHECKIN", "departamento": "Pruebas"}',
+        format('registro con join: %s', r);
+    assert (r->'registro'->>'token_usado') = 'qr-prueba', format('token del qr: %s', r);
+
+    -- Mismo instante (now() no cambia en la transaccion): anti-rebote.
+    perform pg_temp.esperar('segundo escaneo dentro del anti-rebote',
+        pg_temp.decidir(e), '{"accion": "duplicado", "tipo": "entrada"}');
+    select count(*) into n from registros where empleado_id = e;
+    assert n = 1, format('el duplicado no escribe: %s marcas', n);
+
+    perform pg_temp.esperar('primera marca despues del corte',
+        pg_temp.decidir(pg_temp.emp(), '00:00'), '{"accion": "creado", "tipo": "salida"}');
+
+    -- Anti-rebote 0 lo apaga; una marca "en el futuro" (seg < 0) no es rebote.
+    e := pg_temp.emp();
+    perform pg_temp.marca(e, 'entrada', interval '5 seconds');
+    perform pg_temp.esperar('anti-rebote apagado',
+        pg_temp.decidir(e, p_antirrebote => 0), '{"accion": "creado", "tipo": "salida"}');
+    e := pg_temp.emp();
+    perform pg_temp.marca(e, 'entrada', interval '-10 seconds');
+    perform pg_temp.esperar('marca posterior a ahora',
+        pg_temp.decidir(e), '{"accion": "creado", "tipo": "salida", "primera_del_dia": false}');
+
+    -- Solo entrada: aviso hasta la salida programada - margen.
+    e := pg_temp.emp();
+    perform pg_temp.marca(e, 'entrada', interval '4 hours');
+    perform pg_temp.esperar('salida antes de hora',
+        pg_temp.decidir(e, p_salida => '24:00'),
+        '{"accion": "aviso", "salida_programada": "24:00", "abre": 1440}');
+    perform pg_temp.esperar('salida en hora',
+        pg_temp.decidir(e, p_salida => '00:00'),
+        '{"accion": "creado", "tipo": "salida", "primera_del_dia": false}');
+    e := pg_temp.emp();
+    perform pg_temp.marca(e, 'entrada', interval '4 hours');
+    perform pg_temp.esperar('dia no laboral: sin aviso',
+        pg_temp.decidir(e), '{"accion": "creado", "tipo": "salida"}');
+
+    -- Entrada y salida separadas por mas de duplicado_max: jornada completa.
+    e := pg_temp.emp();
+    perform pg_temp.marca(e, 'entrada', interval '9 hours');
+    perform pg_temp.marca(e, 'salida', interval '1 hour');
+    perform pg_temp.esperar('jornada completa',
+        pg_temp.decidir(e), '{"accion": "jornada_completa"}');
+
+    -- Salida a los 5 minutos de la entrada: doble escaneo, la salida se mueve.
+    e := pg_temp.emp();
+    perform pg_temp.marca(e, 'entrada', interval '2 hours');
+    v_id := pg_temp.marca(e, 'salida', interval '115 minutes');
+    r := pg_temp.decidir(e);
+    perform pg_temp.esperar('salida duplicada', r,
+        jsonb_build_object('accion', 'corregido', 'registro_id', v_id, 'sin_entrada', false));
+    assert (r->>'fecha_hora')::timestamptz = now(), format('salida movida a ahora: %s', r);
+    select count(*) into n from registros
+     where registros.id = v_id and fecha_hora = now() and token_usado = 'auto-correccion-duplicado';
+    assert n = 1, format('salida %s no quedo movida', v_id);
+    select count(*) into n from registros where empleado_id = e;
+    assert n = 2, format('corregir no agrega marcas: %s', n);
+
+    -- Solo salida: se reubica a ahora y el dia queda sin entrada.
+    e := pg_temp.emp();
+    v_id := pg_temp.marca(e, 'salida', interval '3 hours');
+    perform pg_temp.esperar('solo salida', pg_temp.decidir(e),
+        jsonb_build_object('accion', 'corregido', 'registro_id', v_id, 'sin_entrada', true));
+
+    -- Salida anterior a la entrada: duracion negativa, cuenta como doble
+    -- escaneo (igual que en decidir_checkin).
+    e := pg_temp.emp();
+    v_id := pg_temp.marca(e, 'salida', interval '2 hours');
+    perform pg_temp.marca(e, 'entrada', interval '1 hour');
+    perform pg_temp.esperar('salida anterior a la entrada', pg_temp.decidir(e),
+        jsonb_build_object('accion', 'corregido', 'registro_id', v_id, 'sin_entrada', false));
+end;
+$$;
+
+rollback;
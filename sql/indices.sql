@@ -0,0 +1,12 @@
+-- NEVOX FARMA - indices de las consultas calientes.
+--
+-- Los mismos que crea la app en su base SQLite local (SQLITE_ESQUEMA en
+-- api/index.py). El check-in busca al empleado por token_dispositivo y lee
+-- sus marcas de hoy por (empleado_id, fecha_hora); los reportes paginan
+-- registros por (fecha_hora, id).
+--
+-- Instalar desde el SQL Editor de Supabase.
+
+create index if not exists empleados_token_idx on empleados (token_dispositivo);
+create index if not exists registros_empleado_fecha_idx on registros (empleado_id, fecha_hora);
+create index if not exists registros_fecha_idx on registros (fecha_hora, id);
@@ -0,0 +1,41 @@
+-- NEVOX FARMA - jornadas por dia ya calculadas (ROLLUPS=1).
+--
+-- Una fila por empleado y fecha local con lo que sale de emparejar sus marcas
+-- (ver _jornadas_por_dia en api/index.py). La app llena una fecha entera la
+-- primera vez que un reporte la pide y la anota en jornadas_cobertura; despues
+-- cada correccion de un dia pasado recalcula solo la fila de ese empleado. El
+-- dia de hoy nunca se guarda: se empareja en vivo.
+--
+-- No se guarda nada que dependa de la configuracion: las extras salen de
+-- "pares" y del horario al leer, y la jornada corta de trabajado_min y la
+-- jornada minima. Las horas son hora local (UTC-5) del dia "fecha", como
+-- time o como texto "HH:MM:SS.ffffff" dentro de pares.
+--
+-- Instalar desde el SQL Editor de Supabase y luego:
+--   notify pgrst, 'reload schema';
+-- Para reconstruir todo basta con vaciar jornadas_cobertura.
+
+create table if not exists jornadas_dia (
+    empleado_id         bigint      not null references empleados(id) on delete cascade,
+    fecha               date        not null,
+    marcas              integer     not null,
+    entradas_sin_salida integer     not null default 0,
+    salidas_sin_entrada integer     not null default 0,
+    trabajado_min       double precision not null default 0,
+    pares               jsonb       not null default '[]',  -- [["07:01:12.5", "16:02:40"], ...]
+    primera_entrada     time,
+    ultima_salida       time,
+    abierta_desde       time,         -- entrada que quedo sin salida
+    primera_marca       time        not null,
+    primera_marca_id    bigint      not null,
+    actualizado         timestamptz not null default now(),
+    primary key (empleado_id, fecha)
+);
+
+-- Los reportes leen por rango de fechas, paginando por (fecha, empleado_id).
+create index if not exists jornadas_dia_fecha_idx on jornadas_dia (fecha, empleado_id);
+
+create table if not exists jornadas_cobertura (
+    fecha       date        primary key,
+    calculado   timestamptz not null default now()
+);
@@ -0,0 +1,424 @@
+"""
+NEVOX FARMA - La app contra sus dos almacenes.
+
+Cada prueba corre dos veces: con ALMACEN=supabase (el PostgREST falso de
+bench/fake_supabase.py, que recorre el mismo camino HTTP que produccion) y con
+ALMACEN=sqlite (_AlmacenSqlite sobre un archivo nuevo). Cubre lo que la app le
+pide al almacen: el check-in, el CRUD del admin, la paginacion por cursor
+(fecha_hora, id), el join embebido de empleados, el upsert con
+merge-duplicates y los reportes.
+
+Lo que NO cubre: el check-in por RPC tal como corre en Supabase. Con
+CHECKIN_RPC=1 (y siempre con SQLite) la decision la toma la decidir_checkin de
+la app, dentro del fake o de _AlmacenSqlite.checkin; la funcion plpgsql de
+sql/checkin_decidir.sql no se ejecuta en ninguna de estas pruebas, asi que que
+el RPC pase aqui solo dice que la regla de Python coincide consigo misma. La
+paridad con el SQL esta en test_checkin_decidir.py (pide PRUEBAS_DATABASE_URL).
+
+    python -m pytest -q tests
+"""
+
+import os
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [os.path.join(RAIZ, "api"), os.path.join(RAIZ, "bench")]
+
+import bench  # noqa: E402
+import index  # noqa: E402
+
+ALMACENES = ("supabase", "sqlite")
+
+
+class Entorno:
+    """La app apuntando a un almacen, con el reloj fijo en t."""
+
+    def __init__(self, almacen, t):
+        self.almacen = almacen
+        self.t = t
+        self.base, self.cliente = bench.preparar(0, reloj=lambda: self.t.astimezone(timezone.utc),
+                                                 almacen=almacen)
+
+    @property
+    def hoy(self):
+        return self.t.date()
+
+    def utc(self, dia, hhmm):
+        local = datetime.fromisoformat(f"{dia.isoformat()}T{hhmm}").replace(tzinfo=index.LOCAL_TZ)
+        return local.astimezone(timezone.utc).isoformat()
+
+    def empleados(self, *nombres, departamento="Ventas"):
+        emps = self.base.sembrar("empleados", [{"nombre": n, "departamento": departamento} for n in nombres])
+        for e in emps:
+            e["token_dispositivo"] = index.device_token(e["id"])
+        return self.base.sembrar("empleados", emps)
+
+    def marcas(self, emp, dia, *marcas):
+        return self.base.sembrar("registros", [
+            {"empleado_id": emp["id"], "tipo": tipo, "fecha_hora": self.utc(dia, hhmm), "token_usado": "prueba"}
+            for hhmm, tipo in marcas
+        ])
+
+    def escanear(self, emp, cliente=None):
+        r = (cliente or self.cliente).post("/api/checkin", json={
+            "token_qr": index.qr_token(index.qr_slot_actual()),
+            "token_dispositivo": emp["token_dispositivo"],
+        })
+        return r.status_code, r.get_json()
+
+    def registros_de(self, emp):
+        return [f for f in self.base.filas("registros") if f["empleado_id"] == emp["id"]]
+
+
+@pytest.fixture(params=ALMACENES)
+def app(request, monkeypatch):
+    hoy = datetime.now(index.LOCAL_TZ).date()
+    e = Entorno.__new__(Entorno)
+    e.t = datetime(hoy.year, hoy.month, hoy.day, 6, 55, tzinfo=index.LOCAL_TZ)
+    monkeypatch.setattr(index, "now_local", lambda: e.t)
+    # Estado de la instancia que no debe pasar de una prueba a otra.
+    monkeypatch.setattr(index, "CHECKIN_RPC", False)
+    monkeypatch.setattr(index, "ROLLUPS", False)
+    monkeypatch.setattr(index, "REPORTES_CACHE", True)
+    monkeypatch.setattr(index, "_cache_reportes", index._CacheReportes(index.REPORTES_CACHE_FILAS))
+    monkeypatch.setattr(index, "_hoy", index._RegistrosHoy())
+    monkeypatch.setattr(index, "SB_PAGINA", index.SB_PAGINA)
+    Entorno.__init__(e, request.param, e.t)
+    yield e
+    with index._sb_lock:
+        index._almacen_actual = None
+
+
+def _dia_laboral_pasado(hoy, horario):
+    d = hoy - timedelta(days=1)
+    while horario[str(d.weekday())] is None:
+        d -= timedelta(days=1)
+    return d
+
+
+# ------------------------------------------------------------
+# CHECK-IN
+# ------------------------------------------------------------
+
+def test_checkin_primera_marca_y_duplicado(app):
+    ana, = app.empleados("ANA")
+    status, r = app.escanear(ana)
+    assert status == 200 and r["ok"] and r["tipo"] == "entrada" and not r["duplicado"]
+
+    # Dentro de la ventana anti-rebote se repite la marca anterior.
+    app.t += timedelta(seconds=20)
+    status, r = app.escanear(ana)
+    assert status == 200 and r["duplicado"] and r["tipo"] == "entrada"
+    assert r["hora"] == "06:55:00"
+    assert len(app.registros_de(ana)) == 1
+
+
+def test_checkin_antirrebote_vence(app):
+    ana, = app.empleados("ANA")
+    app.t = app.t.replace(hour=12, minute=0)  # despues del corte: la primera marca es salida
+    app.marcas(ana, app.hoy, ("11:59:30", "entrada"))
+    status, r = app.escanear(ana)
+    assert r.get("duplicado"), r
+
+    # Pasada la ventana ya no es rebote: con la entrada marcada y sin horario
+    # que la frene (margen de salida amplio) se registra la salida.
+    index.db_set_config("margen_salida_minutos", str(24 * 60))
+    app.t += timedelta(seconds=index.db_get_antirrebote())
+    status, r = app.escanear(ana)
+    assert status == 200 and not r["duplicado"] and r["tipo"] == "salida", r
+    assert sorted(f["tipo"] for f in app.registros_de(ana)) == ["entrada", "salida"]
+
+
+def test_checkin_marca_posterior_a_ahora_no_es_rebote(app):
+    # Una marca que otro escaneo guardo despues de que este leyo la hora
+    # queda "en el futuro": no cuenta como rebote (igual que en el SQL).
+    ana, = app.empleados("ANA")
+    app.marcas(ana, app.hoy, ("06:55:10", "entrada"))
+    index.db_set_config("margen_salida_minutos", str(24 * 60))
+    status, r = app.escanear(ana)
+    assert not r.get("duplicado"), r
+
+
+def test_checkin_jornada_completa(app):
+    ana, = app.empleados("ANA")
+    app.t = app.t.replace(hour=17)
+    app.marcas(ana, app.hoy, ("07:00:00", "entrada"), ("16:00:00", "salida"))
+    status, r = app.escanear(ana)
+    assert status == 409 and r["jornada_completa"]
+    assert "07:00" in r["mensaje"] and "16:00" in r["mensaje"]
+    assert len(app.registros_de(ana)) == 2
+
+
+def test_checkin_salida_duplicada_se_reubica(app):
+    ana, = app.empleados("ANA")
+    app.t = app.t.replace(hour=7, minute=10)
+    app.marcas(ana, app.hoy, ("07:00:00", "entrada"), ("07:02:00", "salida"))
+    status, r = app.escanear(ana)
+    assert status == 200 and r["corregido"] and r["hora"] == "07:10:00"
+    salida = [f for f in app.registros_de(ana) if f["tipo"] == "salida"]
+    assert len(salida) == 1 and salida[0]["token_usado"] == "auto-correccion-duplicado"
+    assert index.to_local(salida[0]["fecha_hora"]).strftime("%H:%M") == "07:10"
+
+
+def test_checkin_rpc_respeta_duplicado_max(app):
+    # El limite entre doble escaneo y jornada que manda la app llega hasta
+    # donde se decide (el fake, o la transaccion de SQLite).
+    ana, = app.empleados("ANA")
+    app.t = app.t.replace(hour=7, minute=10)
+    app.marcas(ana, app.hoy, ("07:00:00", "entrada"), ("07:02:00", "salida"))
+    ini, fin = index.local_day_bounds_utc(app.hoy.isoformat())
+    p = dict(empleado_id=ana["id"], token_dispositivo=ana["token_dispositivo"], token_qr="qr",
+             desde=ini, hasta=fin, antirrebote=90, salida_programada=None, margen_salida=0,
+             hora_corte="10:00", utc_offset_min=-300)
+    assert index._almacen().checkin(**p, duplicado_max=1)["accion"] == "jornada_completa"
+    assert index._almacen().checkin(**p, duplicado_max=5)["accion"] == "corregido"
+
+
+def test_checkin_rechazos(app):
+    ana, = app.empleados("ANA")
+    index.db_actualizar_empleado(ana["id"], activo=0)
+    status, r = app.escanear(ana)
+    assert status == 400 and not r["ok"]
+    status, r = app.escanear({"token_dispositivo": "no-es-un-token"})
+    assert status == 400 and not r["ok"]
+    assert app.registros_de(ana) == []
+
+
+def test_checkin_simultaneo_crea_una_marca(app, monkeypatch):
+    # Dos escaneos a la vez del mismo empleado: con la decision dentro de la
+    # transaccion (RPC; con SQLite siempre) solo uno escribe.
+    monkeypatch.setattr(index, "CHECKIN_RPC", True)
+    emps = app.empleados(*[f"EMP {i}" for i in range(8)])
+    barrera = threading.Barrier(len(emps) * 2)
+    errores = []
+
+    def escanear(emp):
+        cliente = index.app.test_client()
+        barrera.wait()
+        status, _r = app.escanear(emp, cliente)
+        if status != 200:
+            errores.append(status)
+
+    hilos = [threading.Thread(target=escanear, args=(e,)) for e in emps for _ in range(2)]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    assert errores == []
+    for e in emps:
+        assert len(app.registros_de(e)) == 1
+
+
+# ------------------------------------------------------------
+# ADMIN
+# ------------------------------------------------------------
+
+def test_admin_empleados_crud(app):
+    c = app.cliente
+    r = c.post("/api/admin/empleados", json={"nombre": "NUEVA", "departamento": "Farmacia"})
+    assert r.status_code == 200
+    eid = r.get_json()["id"]
+    emps = {e["id"]: e for e in c.get("/api/admin/empleados").get_json()["empleados"]}
+    assert emps[eid]["nombre"] == "NUEVA" and emps[eid]["activo"]
+    assert emps[eid]["hora_entrada"] == "09:00"
+
+    assert c.put(f"/api/admin/empleados/{eid}", json={"nombre": "NUEVA 2", "hora_salida": "17:00"}).status_code == 200
+    r = c.post(f"/api/admin/empleados/{eid}/toggle")
+    assert r.get_json()["activo"] == 0
+    emp = {e["id"]: e for e in c.get("/api/admin/empleados").get_json()["empleados"]}[eid]
+    assert (emp["nombre"], emp["departamento"], emp["hora_salida"], emp["activo"]) == \
+        ("NUEVA 2", "Farmacia", "17:00", False)
+    assert eid not in {e["id"] for e in index.db_listar_empleados()}
+    assert c.post("/api/admin/empleados/999999/toggle").status_code == 404
+
+
+def test_admin_registros_crud(app):
+    c = app.cliente
+    ana, = app.empleados("ANA")
+    ayer = (app.hoy - timedelta(days=1)).isoformat()
+    r = c.post("/api/admin/registros", json={"empleado_id": ana["id"], "fecha": ayer, "hora": "07:05", "tipo": "entrada"})
+    assert r.status_code == 200
+    c.post("/api/admin/registros", json={"empleado_id": ana["id"], "fecha": ayer, "hora": "16:10", "tipo": "salida"})
+
+    regs = c.get(f"/api/admin/registros?desde={ayer}&empleado_id={ana['id']}").get_json()["registros"]
+    assert [(x["hora_corta"], x["tipo"], x["nombre"]) for x in regs] == \
+        [("07:05", "entrada", "ANA"), ("16:10", "salida", "ANA")]
+    assert all(x["token_usado"] == "correccion-manual" for x in regs)
+
+    assert c.put(f"/api/admin/registros/{regs[0]['id']}",
+                 json={"fecha": ayer, "hora": "06:50", "tipo": "entrada"}).status_code == 200
+    assert c.delete(f"/api/admin/registros/{regs[1]['id']}").status_code == 200
+    regs = c.get(f"/api/admin/registros?desde={ayer}&empleado_id={ana['id']}").get_json()["registros"]
+    assert [(x["hora_corta"], x["tipo"]) for x in regs] == [("06:50", "entrada")]
+
+    r = c.post("/api/admin/registros", json={"empleado_id": 999999, "fecha": ayer, "hora": "07:00", "tipo": "entrada"})
+    assert r.status_code == 404
+
+
+# ------------------------------------------------------------
+# ALMACEN: cursor, join embebido, upsert
+# ------------------------------------------------------------
+
+def test_paginacion_por_cursor(app, monkeypatch):
+    monkeypatch.setattr(index, "SB_PAGINA", 4)
+    ana, beto = app.empleados("ANA", "BETO")
+    ayer = app.hoy - timedelta(days=1)
+    # Empates de fecha_hora que cruzan el borde de pagina: desempata el id.
+    for _ in range(3):
+        app.marcas(ana, ayer, ("07:00:00", "entrada"), ("07:00:00", "entrada"))
+        app.marcas(beto, ayer, ("07:00:00", "entrada"), ("12:00:00", "salida"))
+    esperado = sorted(((datetime.fromisoformat(f["fecha_hora"]), f["id"]) for f in app.base.filas("registros")))
+
+    marcas = index.db_registros_rango(ayer.isoformat(), ayer.isoformat())
+    assert [m.id for m in marcas] == [i for _t, i in esperado]
+
+    # Descendente, y sobre otra columna de orden (nombre) con valores que
+    # llevan comas, parentesis, comillas y barras.
+    paginas = list(index._almacen().paginas_registros(desc=True))
+    assert [f["id"] for p in paginas for f in p] == [i for _t, i in reversed(esperado)]
+    assert max(len(p) for p in paginas) == 4
+    raros = ['O"NEIL, ANA', "BARRA \\ INVERTIDA", "PAREN (X)", "COMA, Y"]
+    app.empleados(*raros, *raros)
+    nombres = [e["nombre"] for e in index.db_listar_empleados()]
+    assert sorted(nombres) == sorted(["ANA", "BETO", *raros, *raros])
+    assert nombres == sorted(nombres)
+
+
+def test_join_embebido_de_empleados(app):
+    ana, = app.empleados("ANA", departamento="Almacen")
+    app.marcas(ana, app.hoy, ("06:50:00", "entrada"))
+    filas = [f for p in index._almacen().paginas_registros() for f in p]
+    assert [f["empleados"] for f in filas] == [{"nombre": "ANA", "departamento": "Almacen"}]
+    ini, fin = index.local_day_bounds_utc(app.hoy.isoformat())
+    assert "empleados" not in index._almacen().marcas_empleado(ana["id"], ini, fin)[0]
+
+    r = app.cliente.get("/api/registros-hoy").get_json()
+    assert [(x["nombre"], x["departamento"], x["hora"]) for x in r["registros"]] == [("ANA", "Almacen", "06:50:00")]
+    # Cambiar el empleado cambia lo que trae el join.
+    app.cliente.put(f"/api/admin/empleados/{ana['id']}", json={"nombre": "ANA MARIA"})
+    r = app.cliente.get("/api/registros-hoy").get_json()
+    assert r["registros"][0]["nombre"] == "ANA MARIA"
+
+
+def test_upsert_merge_duplicates(app):
+    almacen = index._almacen()
+    antes = app.base.contar("configuracion")
+    almacen.guardar_config({"x": "1", "y": "2"})
+    almacen.guardar_config({"x": "3"})
+    assert (almacen.config_valor("x"), almacen.config_valor("y")) == ("3", "2")
+    assert app.base.contar("configuracion") == antes + 2
+
+    # jornadas_dia: la clave es (empleado_id, fecha) y se pisan solo las
+    # columnas enviadas.
+    ana, = app.empleados("ANA")
+    fila = {"empleado_id": ana["id"], "fecha": "2024-05-02", "marcas": 1, "primera_marca": "07:00:00",
+            "primera_marca_id": 1, "pares": []}
+    almacen.guardar_jornadas([fila])
+    almacen.guardar_jornadas([{**fila, "marcas": 2, "pares": [["07:00:00", "16:00:00"]]}])
+    filas = [f for p in almacen.paginas_jornadas("2024-05-01", "2024-05-03") for f in p]
+    assert [(f["marcas"], f["pares"], f["empleados"]["nombre"]) for f in filas] == \
+        [(2, [["07:00:00", "16:00:00"]], "ANA")]
+
+    # Por la app: guardar dos veces la misma clave deja una fila.
+    app.cliente.post("/api/admin/config", json={"tolerancia_minutos": 20})
+    app.cliente.post("/api/admin/config", json={"tolerancia_minutos": 25})
+    assert [f["valor"] for f in app.base.filas("configuracion") if f["clave"] == "tolerancia_minutos"] == ["25"]
+    assert app.cliente.get("/api/admin/config").get_json()["tolerancia_minutos"] == "25"
+
+
+# ------------------------------------------------------------
+# REPORTES
+# ------------------------------------------------------------
+
+def test_reportes(app):
+    horario = index.normalizar_horario(index.HORARIO_SEMANAL_DEFAULT)
+    dia = _dia_laboral_pasado(app.hoy, horario)
+    turno = horario[str(dia.weekday())]
+    ent = datetime.strptime(turno["entrada"], "%H:%M")
+    sal = datetime.strptime(turno["salida"], "%H:%M")
+    ana, beto, caro = app.empleados("ANA", "BETO", "CARO")
+    # ANA: a tiempo y una hora extra. BETO: 20 min tarde (tolerancia 15).
+    # CARO: sin salida.
+    app.marcas(ana, dia, (f"{ent:%H:%M}:00", "entrada"), (f"{sal + timedelta(hours=1):%H:%M}:00", "salida"))
+    app.marcas(beto, dia, (f"{ent + timedelta(minutes=20):%H:%M}:00", "entrada"), (f"{sal:%H:%M}:00", "salida"))
+    app.marcas(caro, dia, (f"{ent:%H:%M}:00", "entrada"))
+    rango = f"desde={dia.isoformat()}&hasta={dia.isoformat()}"
+    trabajado = (sal - ent).total_seconds() / 3600
+
+    horas = {r["nombre"]: r for r in app.cliente.get(f"/api/reportes/horas?{rango}").get_json()["datos"]}
+    assert horas["ANA"]["horas"] == pytest.approx(trabajado + 1)
+    assert horas["ANA"]["extras_horas"] == pytest.approx(1)
+    assert horas["BETO"]["horas"] == pytest.approx(trabajado - 20 / 60, abs=0.01)
+    assert horas["CARO"]["dias_incompletos"] == 1
+
+    extras = app.cliente.get(f"/api/reportes/horas-extras?{rango}").get_json()["detalle"]
+    assert {d["nombre"] for d in extras} == {"ANA", "CARO"}  # extra, o a revisar
+
+    retardos = app.cliente.get(f"/api/reportes/retardos?{rango}").get_json()["datos"]
+    assert [r["nombre"] for r in retardos] == ["BETO"]
+
+    # Una correccion del dia cambia el reporte (la cache de resultados se
+    # invalida por dia).
+    app.cliente.post("/api/admin/registros", json={
+        "empleado_id": caro["id"], "fecha": dia.isoformat(), "hora": turno["salida"], "tipo": "salida"})
+    horas = {r["nombre"]: r for r in app.cliente.get(f"/api/reportes/horas?{rango}").get_json()["datos"]}
+    assert horas["CARO"]["dias_incompletos"] == 0
+    assert horas["CARO"]["horas"] == pytest.approx(trabajado)
+
+    csv = app.cliente.get(f"/api/reportes/exportar?{rango}&hoja=registros&formato=csv").get_data(as_text=True)
+    assert csv.count("\n") == 1 + 6
+
+
+@pytest.mark.parametrize("ruta", ["exportar?hoja=registros&formato=csv", "exportar?hoja=registros&formato=ndjson",
+                                  "exportar?hoja=resumen&formato=csv", "horas"])
+def test_paginas_fuera_del_memo(app, monkeypatch, ruta):
+    """Un rango de varias paginas no deja ninguna pagina en el memo de la
+    peticion: se consumen sobre la marcha y el memo no las soltaria hasta
+    el final de la respuesta. Las exportaciones planas salen por un
+    generador que el servidor recorre despues de la vista, fuera del
+    contexto donde se abrio el memo; "horas" pagina dentro de la vista."""
+    monkeypatch.setattr(index, "SB_PAGINA", 4)
+    claves = []
+
+    class Memo(index._MemoConsultas):
+        def obtener(self, clave, cargar):
+            claves.append(clave)
+            return super().obtener(clave, cargar)
+
+    monkeypatch.setattr(index, "_MemoConsultas", Memo)
+    ana, beto = app.empleados("ANA", "BETO")
+    ayer = app.hoy - timedelta(days=1)
+    for emp in (ana, beto):
+        app.marcas(emp, ayer, *[(f"{h:02d}:00:00", "entrada" if h % 2 else "salida") for h in range(7, 12)])
+    sep = "&" if "?" in ruta else "?"
+    r = app.cliente.get(f"/api/reportes/{ruta}{sep}desde={ayer.isoformat()}&hasta={ayer.isoformat()}")
+    assert r.status_code == 200 and r.get_data()
+    assert [c for c in claves if c[0] == "registros"] == []
+
+
+def test_reportes_iguales_en_los_dos_almacenes(monkeypatch):
+    """Mismo escenario sembrado en los dos: respuestas identicas."""
+    hoy = datetime.now(index.LOCAL_TZ).date()
+    respuestas = []
+    for almacen in ALMACENES:
+        t = datetime(hoy.year, hoy.month, hoy.day, 10, 0, tzinfo=index.LOCAL_TZ)
+        monkeypatch.setattr(index, "now_local", lambda: t)
+        monkeypatch.setattr(index, "REPORTES_CACHE", False)
+        monkeypatch.setattr(index, "_hoy", index._RegistrosHoy())
+        base, cliente = bench.preparar(0, reloj=lambda: t.astimezone(timezone.utc), almacen=almacen)
+        bench.sembrar_empresa(base, 12, 10, ahora=t, semilla=5)
+        rango = f"desde={(hoy - timedelta(days=9)).isoformat()}&hasta={hoy.isoformat()}"
+        respuestas.append([
+            cliente.get(u).get_json() for u in (
+                f"/api/reportes/horas?{rango}", f"/api/reportes/horas-extras?{rango}&solo_extras=0",
+                f"/api/reportes/retardos?{rango}", f"/api/admin/dias-por-corregir?{rango}",
+                "/api/pendientes-hoy",
+            )
+        ])
+    with index._sb_lock:
+        index._almacen_actual = None
+    assert respuestas[0] == respuestas[1]
@@ -0,0 +1,129 @@
+"""
+NEVOX FARMA - Paridad de la regla del check-in.
+
+La misma tabla de casos corre contra decidir_checkin (api/index.py), que es la
+que usan el fake de bench/ y ALMACEN=sqlite, y contra la funcion plpgsql de
+sql/checkin_decidir.sql, que es la que corre en Supabase con CHECKIN_RPC=1.
+Si una de las dos cambia y la otra no, falla el caso.
+
+La mitad de Postgres necesita psycopg y una base con las tablas empleados y
+registros (una copia, o la de desarrollo); sin PRUEBAS_DATABASE_URL se salta.
+Instala la funcion del archivo dentro de una transaccion que termina en
+rollback, asi que prueba el SQL del repo y no deja nada en la base:
+
+    PRUEBAS_DATABASE_URL=postgresql://... python -m pytest -q tests
+
+Los rechazos (empleado inactivo, otro dispositivo) no estan aqui: no son de
+decidir_checkin sino de quien la llama; siguen en
+sql/checkin_decidir_pruebas.sql.
+"""
+
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [os.path.join(RAIZ, "api")]
+
+import index  # noqa: E402
+
+# (caso, marcas previas [(tipo, hace cuantos segundos)], parametros, esperado).
+# Corte '24:00' siempre da entrada y '00:00' siempre salida; salida
+# programada '24:00' nunca abre y '00:00' ya abrio: ningun caso depende de la
+# hora a la que se corre. "movida" es el indice de la marca previa que se
+# reubica en un "corregido".
+CASOS = [
+    ("primera marca antes del corte", [], {"corte": "24:00"},
+     {"accion": "creado", "tipo": "entrada", "primera_del_dia": True, "corte": "24:00"}),
+    ("primera marca despues del corte", [], {"corte": "00:00"},
+     {"accion": "creado", "tipo": "salida", "primera_del_dia": True}),
+    ("segundo escaneo dentro del anti-rebote", [("entrada", 0)], {},
+     {"accion": "duplicado", "tipo": "entrada"}),
+    ("anti-rebote apagado", [("entrada", 5)], {"antirrebote": 0},
+     {"accion": "creado", "tipo": "salida"}),
+    ("marca posterior a ahora", [("entrada", -10)], {},
+     {"accion": "creado", "tipo": "salida", "primera_del_dia": False}),
+    ("salida antes de hora", [("entrada", 4 * 3600)], {"salida": "24:00"},
+     {"accion": "aviso", "salida_programada": "24:00", "abre": 1440}),
+    ("salida en hora", [("entrada", 4 * 3600)], {"salida": "00:00"},
+     {"accion": "creado", "tipo": "salida", "primera_del_dia": False}),
+    ("dia no laboral: sin aviso", [("entrada", 4 * 3600)], {},
+     {"accion": "creado", "tipo": "salida"}),
+    ("jornada completa", [("entrada", 9 * 3600), ("salida", 3600)], {},
+     {"accion": "jornada_completa"}),
+    ("salida duplicada", [("entrada", 2 * 3600), ("salida", 115 * 60)], {},
+     {"accion": "corregido", "movida": 1, "sin_entrada": False}),
+    ("salida corta con duplicado_max menor", [("entrada", 2 * 3600), ("salida", 115 * 60)],
+     {"duplicado_max": 5}, {"accion": "jornada_completa"}),
+    ("solo salida", [("salida", 3 * 3600)], {},
+     {"accion": "corregido", "movida": 0, "sin_entrada": True}),
+    ("salida anterior a la entrada", [("salida", 2 * 3600), ("entrada", 3600)], {},
+     {"accion": "corregido", "movida": 0, "sin_entrada": False}),
+]
+
+PARAMETROS = {"corte": "24:00", "salida": None, "antirrebote": 60, "duplicado_max": 30}
+
+
+def _ids(casos):
+    return [c[0] for c in casos]
+
+
+def _comparar(decision, esperado, ids):
+    """Los campos de esperado, con "movida" traducido al id de la marca."""
+    esperado = dict(esperado)
+    if "movida" in esperado:
+        esperado["registro_id"] = ids[esperado.pop("movida")]
+    assert {k: decision.get(k) for k in esperado} == esperado
+
+
+@pytest.mark.parametrize("caso,marcas,parametros,esperado", CASOS, ids=_ids(CASOS))
+def test_decidir_checkin(caso, marcas, parametros, esperado):
+    p = {**PARAMETROS, **parametros}
+    ahora = datetime(2026, 3, 4, 10, 0, tzinfo=index.LOCAL_TZ)
+    turno = {"salida": p["salida"]} if p["salida"] else None
+    ajustes = SimpleNamespace(antirrebote=p["antirrebote"], margen_salida=0,
+                              hora_corte_entrada=p["corte"],
+                              horario={str(ahora.weekday()): turno})
+    regs = [{"id": i + 1, "tipo": tipo,
+             "fecha_hora": (ahora - timedelta(seconds=hace)).astimezone(timezone.utc).isoformat()}
+            for i, (tipo, hace) in enumerate(marcas)]
+    regs.sort(key=lambda r: (r["fecha_hora"], r["id"]))
+    decision = index.decidir_checkin(regs, ahora, ajustes, duplicado_max=p["duplicado_max"])
+    _comparar(decision, esperado, [i + 1 for i in range(len(marcas))])
+
+
+@pytest.fixture(scope="module")
+def pg():
+    dsn = os.environ.get("PRUEBAS_DATABASE_URL")
+    if not dsn:
+        pytest.skip("sin PRUEBAS_DATABASE_URL no se prueba la funcion SQL")
+    psycopg = pytest.importorskip("psycopg")
+    con = psycopg.connect(dsn)
+    try:
+        with open(os.path.join(RAIZ, "sql", "checkin_decidir.sql"), encoding="utf-8") as f:
+            con.execute(f.read())
+        yield con
+    finally:
+        con.rollback()
+        con.close()
+
+
+@pytest.mark.parametrize("caso,marcas,parametros,esperado", CASOS, ids=_ids(CASOS))
+def test_checkin_decidir_sql(pg, caso, marcas, parametros, esperado):
+    p = {**PARAMETROS, **parametros}
+    emp = pg.execute(
+        "insert into empleados (nombre, departamento, hora_entrada, hora_salida, token_dispositivo, activo)"
+        " values ('PRUEBA CHECKIN', 'Pruebas', '09:00', '18:00', 'disp-prueba', true) returning id"
+    ).fetchone()[0]
+    ids = [pg.execute(
+        "insert into registros (empleado_id, tipo, fecha_hora, token_usado)"
+        " values (%s, %s, now() - make_interval(secs => %s), 'qr-previo') returning id",
+        (emp, tipo, hace)).fetchone()[0] for tipo, hace in marcas]
+    decision = pg.execute(
+        "select checkin_decidir(%s, 'disp-prueba', 'qr-prueba',"
+        " now() - interval '12 hours', now() + interval '12 hours', %s, %s, 0, %s, %s, 0)",
+        (emp, p["antirrebote"], p["salida"], p["corte"], p["duplicado_max"])).fetchone()[0]
+    _comparar(decision, esperado, ids)
@@ -0,0 +1,117 @@
+"""
+NEVOX FARMA - El motor columnar contra el camino en Python.
+
+_jornadas_columnar (numpy) tiene que dar lo mismo que _jornadas_por_dia mas
+_minutos_extra, que siguen siendo la referencia, y las extras que salen de
+los dos tienen que quedar iguales despues de _aplicar_reglas_extras. Corre
+con marcas al azar (semilla fija) y con los casos raros a mano: marcas
+impares, turnos que cruzan la medianoche, mas de cuatro marcas, jornadas
+cortas, tipos desconocidos. Sin numpy se salta.
+
+    python -m pytest -q tests
+"""
+
+import os
+import random
+import sys
+from datetime import date, datetime, timedelta
+
+import pytest
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [os.path.join(RAIZ, "api")]
+
+import index  # noqa: E402
+
+np = pytest.importorskip("numpy")
+
+JORNADA_MINIMA = 30
+LUNES = date(2026, 3, 2)
+EMPLEADOS = {1: ("ANA", "Ventas"), 2: ("BETO", ""), 3: ("CARO", "Almacen")}
+REGLAS = [{"minimo": 0, "redondeo": 0}, {"minimo": 15, "redondeo": 15}, {"minimo": 30, "redondeo": 10}]
+
+
+@pytest.fixture(autouse=True)
+def ajustes(monkeypatch):
+    horario = index.normalizar_horario(index.HORARIO_SEMANAL_DEFAULT)
+    monkeypatch.setattr(index, "db_get_jornada_minima", lambda: JORNADA_MINIMA)
+    monkeypatch.setattr(index, "db_get_horario_semanal", lambda: horario)
+    return horario
+
+
+def _marca(i, eid, tipo, dia, hh, mm=0, ss=0, us=0):
+    momento = datetime.combine(LUNES + timedelta(days=dia), datetime.min.time(), tzinfo=index.LOCAL_TZ)
+    momento += timedelta(hours=hh, minutes=mm, seconds=ss, microseconds=us)
+    return index.Marca(i, eid, tipo, momento, *EMPLEADOS[eid])
+
+
+def _en_orden(marcas):
+    """Como las entrega el almacen: por (fecha_hora, id)."""
+    return sorted(marcas, key=lambda m: (m.momento, m.id))
+
+
+def _referencia(marcas, horario):
+    dias = index._jornadas_por_dia(marcas, JORNADA_MINIMA)
+    for (_eid, fecha), d in dias.items():
+        fecha_d = date.fromisoformat(fecha)
+        d["extra_bruto_min"] = index._minutos_extra(
+            d.pop("pares"), index._salida_programada(horario[str(fecha_d.weekday())], fecha_d))
+    return dias
+
+
+def _comparar(marcas, horario):
+    esperado = _referencia(marcas, horario)
+    columnar = index._jornadas_columnar(np, marcas, con_extras=True)
+    assert list(columnar) == list(esperado)
+    for clave, d in esperado.items():
+        c = columnar[clave]
+        assert c.keys() == d.keys(), clave
+        for campo in d:
+            if isinstance(d[campo], float):
+                assert c[campo] == pytest.approx(d[campo], abs=1e-9), (clave, campo)
+            else:
+                assert c[campo] == d[campo], (clave, campo)
+        for reglas in REGLAS:
+            assert index._aplicar_reglas_extras(c["extra_bruto_min"], reglas) == \
+                index._aplicar_reglas_extras(d["extra_bruto_min"], reglas), (clave, reglas)
+
+
+CASOS = {
+    "jornada normal con extra": [("entrada", 0, 7), ("salida", 0, 17, 20)],
+    "marcas impares": [("entrada", 0, 7), ("salida", 0, 12), ("entrada", 0, 13)],
+    "solo salida": [("salida", 1, 16)],
+    "dos entradas seguidas": [("entrada", 1, 7), ("entrada", 1, 8), ("salida", 1, 16, 45)],
+    "turno de noche": [("entrada", 2, 22), ("salida", 3, 6), ("entrada", 3, 22)],
+    "mas de cuatro marcas": [("entrada", 3, 7), ("salida", 3, 10), ("entrada", 3, 11), ("salida", 3, 13),
+                             ("entrada", 3, 14), ("salida", 3, 18, 5)],
+    "jornada corta": [("entrada", 4, 9), ("salida", 4, 9, 4)],
+    "fin de semana": [("entrada", 5, 8), ("salida", 5, 12, 30)],
+    "tipo desconocido": [("entrada", 0, 7), ("almuerzo", 0, 12), ("salida", 0, 16, 15)],
+    "mismo instante": [("entrada", 0, 16), ("salida", 0, 16)],
+}
+
+
+@pytest.mark.parametrize("caso", list(CASOS))
+def test_casos_borde(ajustes, caso):
+    marcas = []
+    for eid in EMPLEADOS:
+        for tipo, dia, hh, *mm in CASOS[caso]:
+            marcas.append(_marca(len(marcas) + 1, eid, tipo, dia, hh, *mm))
+    _comparar(_en_orden(marcas), ajustes)
+
+
+@pytest.mark.parametrize("semilla", range(20))
+def test_marcas_al_azar(ajustes, semilla):
+    azar = random.Random(semilla)
+    marcas = []
+    for eid in EMPLEADOS:
+        for dia in range(14):
+            for _ in range(azar.choice([0, 1, 2, 2, 2, 3, 4, 5])):
+                tipo = azar.choice(["entrada", "salida"] * 10 + ["otro"])
+                marcas.append(_marca(len(marcas) + 1, eid, tipo, dia, azar.randrange(24),
+                                     azar.randrange(60), azar.randrange(60), azar.randrange(1_000_000)))
+    _comparar(_en_orden(marcas), ajustes)
+
+
+def test_sin_marcas(ajustes):
+    assert index._jornadas_columnar(np, [], con_extras=True) == _referencia([], ajustes) == {}